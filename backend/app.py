@@ -1,20 +1,55 @@
 # app.py
 import os
+import sys
 import csv
+import json
 import random
 import string
 import base64
 import tempfile
-from typing import Dict, Any, Optional, List, Literal
+import threading
+import bisect
+import sqlite3
+import io
+import re
+import math
+import time
+import asyncio
+import hashlib
+import hmac
+import secrets
+import cProfile
+import pstats
+import contextvars
+import importlib.util
+import functools
+import wave
+from abc import ABC, abstractmethod
+from collections import deque, Counter, defaultdict, OrderedDict
+from datetime import datetime, timezone
+from contextlib import contextmanager, asynccontextmanager
+from typing import TYPE_CHECKING, Dict, Any, Optional, List, Literal, Union
 from textwrap import dedent
 
+import anyio
 import httpx
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Query, Header, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, model_validator
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Match
+from pydantic import BaseModel, Field, ValidationError, model_validator
 from dotenv import load_dotenv
-from twilio.rest import Client
-import openai
+
+if TYPE_CHECKING:
+    # Heavy SDKs are imported on first use (see _openai_async_client / _twilio_client) to keep cold starts fast
+    import openai
+    from twilio.rest import Client
+
+try:
+    import fcntl  # POSIX file locking for multi-worker deployments
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
 
 load_dotenv()  # load .env before reading env vars
 
@@ -24,24 +59,166 @@ DEFAULT_LANGUAGE = os.environ.get("HEYGEN_LANGUAGE", "en")
 DEFAULT_QUALITY = os.environ.get("HEYGEN_QUALITY", "low")  # low|medium|high
 DEFAULT_ACTIVITY_IDLE_TIMEOUT = int(os.environ.get("HEYGEN_ACTIVITY_IDLE_TIMEOUT", "180"))
 DEFAULT_TRANSPORT = os.environ.get("HEYGEN_VOICE_CHAT_TRANSPORT", "WEBSOCKET")  # or LIVEKIT
+HEYGEN_TOKEN_POOL_SIZE = int(os.environ.get("HEYGEN_TOKEN_POOL_SIZE", "2"))  # 0 disables pre-minting
+HEYGEN_TOKEN_TTL_SECONDS = float(os.environ.get("HEYGEN_TOKEN_TTL_SECONDS", "600"))
+HEYGEN_TOKEN_EXPIRY_MARGIN = float(os.environ.get("HEYGEN_TOKEN_EXPIRY_MARGIN", "60"))  # never hand out tokens this close to expiry
+KNOWLEDGE_MAX_CHARS = int(os.environ.get("KNOWLEDGE_MAX_CHARS", "20000"))  # cap on custom and merged knowledge bases
 DEBUG_EFFECTIVE_KNOWLEDGE = os.environ.get("DEBUG_EFFECTIVE_KNOWLEDGE", "0") == "1"
 
 # Twilio configuration
 TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID", "REDACTED_TWILIO_SID")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER", "+18775897184")
+TWILIO_API_BASE = os.environ.get("TWILIO_API_BASE")  # e.g. a local stand-in; defaults to https://api.twilio.com
+TWILIO_TIMEOUT = float(os.environ.get("TWILIO_TIMEOUT", "15"))
+SMS_WORKERS = int(os.environ.get("SMS_WORKERS", "2"))
+SMS_RATE_PER_SECOND = float(os.environ.get("SMS_RATE_PER_SECOND", "1"))  # Twilio long codes allow ~1 msg/s
+SMS_RATE_BURST = int(os.environ.get("SMS_RATE_BURST", "5"))
+SMS_MAX_ATTEMPTS = int(os.environ.get("SMS_MAX_ATTEMPTS", "4"))
+SMS_RETRY_BASE_SECONDS = float(os.environ.get("SMS_RETRY_BASE_SECONDS", "2"))
 
 # OpenAI configuration
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
+# Upstream connection pools (shared for the app lifetime)
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "0") == "1"  # needs the optional `h2` package
+UPSTREAM_TIMEOUTS = {
+    "heygen": float(os.environ.get("HEYGEN_TIMEOUT", "10")),
+    "openai": float(os.environ.get("OPENAI_TIMEOUT", "30")),
+}
+
+# Upstream resilience: a deadline per call (covering its retries and hedges), jittered retries for idempotent
+# calls, optional hedging once a call outlasts the upstream's recent p95, and a circuit breaker per upstream
+UPSTREAM_DEADLINES = {
+    "heygen_token": float(os.environ.get("HEYGEN_TOKEN_DEADLINE", "8")),
+    "whisper": float(os.environ.get("WHISPER_DEADLINE", "45")),
+    "chat": float(os.environ.get("CHAT_DEADLINE", "25")),
+    "twilio": float(os.environ.get("TWILIO_DEADLINE", "15")),
+}
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", "3"))  # SMS sends are never retried here (the SMS queue does)
+UPSTREAM_RETRY_BASE_SECONDS = float(os.environ.get("UPSTREAM_RETRY_BASE_SECONDS", "0.2"))
+UPSTREAM_RETRY_MAX_SECONDS = float(os.environ.get("UPSTREAM_RETRY_MAX_SECONDS", "2"))
+UPSTREAM_HEDGE = {  # upstreams that get a hedged second request; Whisper never does (one upload buffer per call)
+    name.strip() for name in os.environ.get("UPSTREAM_HEDGE", "heygen_token").split(",") if name.strip()
+}
+UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get("UPSTREAM_HEDGE_PERCENTILE", "95"))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.environ.get("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))  # no hedging until the p95 means something
+UPSTREAM_HEDGE_MIN_DELAY = float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", "5"))  # consecutive failed calls that open the circuit
+UPSTREAM_BREAKER_RESET_SECONDS = float(os.environ.get("UPSTREAM_BREAKER_RESET_SECONDS", "30"))
+
+# Per-stage concurrency limits for the audio pipeline (per worker)
+STAGE_CONCURRENCY = {
+    "whisper": int(os.environ.get("WHISPER_CONCURRENCY", "8")),
+    "cleanup": int(os.environ.get("CLEANUP_CONCURRENCY", "16")),
+}
+
+# Long transcripts are summarized map-reduce style: chunked on turn boundaries, chunks summarized concurrently
+SUMMARY_CHUNK_CHARS = int(os.environ.get("SUMMARY_CHUNK_CHARS", "12000"))
+SUMMARY_MAP_CONCURRENCY = int(os.environ.get("SUMMARY_MAP_CONCURRENCY", "4"))
+VISIT_SESSION_TTL_SECONDS = float(os.environ.get("VISIT_SESSION_TTL_SECONDS", str(4 * 3600)))  # idle visits are forgotten
+VISIT_SESSION_MAX = int(os.environ.get("VISIT_SESSION_MAX", "1000"))
+
+# Content-addressed cache for Whisper / cleanup / summary results (memory LRU + bounded disk tier)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_MEMORY_ENTRIES = int(os.environ.get("RESULT_CACHE_MEMORY_ENTRIES", "512"))
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(64 * 1024 * 1024)))
+
+# Audio upload configuration
+MAX_AUDIO_UPLOAD_BYTES = int(os.environ.get("MAX_AUDIO_UPLOAD_BYTES", str(25 * 1024 * 1024)))  # Whisper's own limit
+AUDIO_UPLOAD_CHUNK_BYTES = 256 * 1024
+MAX_PATIENT_IMPORT_BYTES = int(os.environ.get("MAX_PATIENT_IMPORT_BYTES", str(20 * 1024 * 1024)))
+PATIENT_IMPORT_INVITE_BATCH = int(os.environ.get("PATIENT_IMPORT_INVITE_BATCH", "100"))
+WHISPER_AUDIO_EXTENSIONS = {".flac", ".m4a", ".mp3", ".mp4", ".mpeg", ".mpga", ".oga", ".ogg", ".wav", ".webm"}
+# Content-Type -> extension for raw-body uploads to /api/process-audio/raw (audio/pcm and audio/l16 are raw PCM)
+AUDIO_CONTENT_TYPE_EXTENSIONS = {
+    "audio/flac": ".flac", "audio/x-flac": ".flac", "audio/mp4": ".m4a", "audio/m4a": ".m4a", "audio/x-m4a": ".m4a",
+    "audio/mpeg": ".mp3", "audio/mp3": ".mp3", "audio/ogg": ".ogg", "audio/wav": ".wav", "audio/wave": ".wav",
+    "audio/x-wav": ".wav", "audio/webm": ".webm", "audio/pcm": ".pcm", "audio/l16": ".pcm",
+}
+
+# Optional audio preprocessing before Whisper (needs the optional `numpy` package; WAV and raw PCM only)
+AUDIO_PREPROCESS = os.environ.get("AUDIO_PREPROCESS", "0") == "1"
+AUDIO_TARGET_SAMPLE_RATE = int(os.environ.get("AUDIO_TARGET_SAMPLE_RATE", "16000"))  # what Whisper uses internally
+AUDIO_VAD_FRAME_MS = int(os.environ.get("AUDIO_VAD_FRAME_MS", "30"))
+AUDIO_VAD_THRESHOLD_DBFS = float(os.environ.get("AUDIO_VAD_THRESHOLD_DBFS", "-45"))  # frames quieter than this are silence
+AUDIO_VAD_PADDING_MS = int(os.environ.get("AUDIO_VAD_PADDING_MS", "200"))  # speech margin kept around the trimmed clip
+AUDIO_RAW_PCM_EXTENSIONS = {".pcm", ".raw"}  # headerless signed 16-bit little-endian
+AUDIO_PCM_SAMPLE_RATE = int(os.environ.get("AUDIO_PCM_SAMPLE_RATE", "48000"))
+AUDIO_PCM_CHANNELS = int(os.environ.get("AUDIO_PCM_CHANNELS", "1"))
+
+# Two-phase audio processing: in "fast" mode /api/process-audio answers as soon as Whisper is done and the
+# cleanup pass finishes in the background (fetch it with GET /api/process-audio/cleanup/{cleanup_id})
+AUDIO_PIPELINE_MODE = os.environ.get("AUDIO_PIPELINE_MODE", "full")  # full | fast, for requests that don't say
+AUDIO_CLEANUP_POLICY = os.environ.get("AUDIO_CLEANUP_POLICY", "adaptive")  # adaptive | always (fast mode only)
+AUDIO_CLEANUP_MIN_WORDS = int(os.environ.get("AUDIO_CLEANUP_MIN_WORDS", "4"))  # shorter utterances are used as transcribed
+AUDIO_CLEANUP_SKIP_CONFIDENCE = float(os.environ.get("AUDIO_CLEANUP_SKIP_CONFIDENCE", "0.85"))  # Whisper mean token probability
+AUDIO_CLEANUP_TTL_SECONDS = float(os.environ.get("AUDIO_CLEANUP_TTL_SECONDS", "300"))
+AUDIO_CLEANUP_MAX_JOBS = int(os.environ.get("AUDIO_CLEANUP_MAX_JOBS", "1000"))
+AUDIO_CLEANUP_MAX_WAIT = float(os.environ.get("AUDIO_CLEANUP_MAX_WAIT", "30"))  # longest long-poll, in seconds
+
+# Incremental transcription over WebSocket (/api/transcribe/ws)
+WS_MAX_SEGMENT_BYTES = int(os.environ.get("WS_MAX_SEGMENT_BYTES", str(MAX_AUDIO_UPLOAD_BYTES)))
+WS_MAX_PENDING_SEGMENTS = int(os.environ.get("WS_MAX_PENDING_SEGMENTS", "4"))  # per connection; more waits for the oldest
+
+# Admission control (per worker): each lane caps concurrent requests and queues a bounded number more;
+# overflow, or a wait longer than ADMISSION_QUEUE_TIMEOUT, gets 429 with Retry-After. A limit of 0 disables a lane.
+ADMISSION_LANES = {  # lane: (max concurrent, max queued)
+    "audio": (int(os.environ.get("AUDIO_MAX_CONCURRENT", "8")), int(os.environ.get("AUDIO_MAX_QUEUED", "16"))),
+    "summary": (int(os.environ.get("SUMMARY_MAX_CONCURRENT", "8")), int(os.environ.get("SUMMARY_MAX_QUEUED", "16"))),
+    "priority": (int(os.environ.get("PRIORITY_MAX_CONCURRENT", "64")), int(os.environ.get("PRIORITY_MAX_QUEUED", "256"))),
+}
+ADMISSION_ROUTES = {
+    "/api/process-audio": "audio",
+    "/api/process-audio/upload": "audio",
+    "/api/process-audio/raw": "audio",
+    "/api/summarize-transcript": "summary",
+    "/api/summarize-transcript/stream": "summary",
+    "/api/session": "priority",
+    "/api/patient/{uid}": "priority",
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+PRIORITY_THREADPOOL_SIZE = int(os.environ.get("PRIORITY_THREADPOOL_SIZE", "8"))  # threads reserved for the priority lane
+# Request bodies are refused with 413 once they pass these sizes, before they are fully read
+MAX_REQUEST_BODY_BYTES = int(os.environ.get("MAX_REQUEST_BODY_BYTES", str(1024 * 1024)))
+ADMISSION_BODY_LIMITS = {
+    "/api/process-audio": 4 * math.ceil(MAX_AUDIO_UPLOAD_BYTES / 3) + 64 * 1024,  # base64 audio plus the JSON around it
+    "/api/process-audio/upload": MAX_AUDIO_UPLOAD_BYTES + 64 * 1024,  # multipart framing and form fields
+    "/api/process-audio/raw": MAX_AUDIO_UPLOAD_BYTES,
+    "/api/patients/import": MAX_PATIENT_IMPORT_BYTES + 64 * 1024,
+}
+
 # Data storage configuration
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 CSV_FILE_PATH = os.path.join(DATA_DIR, "db.csv")
+PATIENT_LOG_FILE_PATH = os.path.join(DATA_DIR, "db.log.csv")  # append-only upsert log folded into db.csv
+PATIENT_LOG_COMPACT_THRESHOLD = int(os.environ.get("PATIENT_LOG_COMPACT_THRESHOLD", "1000"))
 CONVOS_CSV_FILE_PATH = os.path.join(DATA_DIR, "convos.csv")
 MEDICAL_DATA_FILE_PATH = os.path.join(DATA_DIR, "medical_data.txt")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "csv").lower()  # csv | sqlite
+SQLITE_DB_PATH = os.environ.get("SQLITE_DB_PATH", os.path.join(DATA_DIR, "amiya.db"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+MEDICAL_CONTEXT_TOP_K = int(os.environ.get("MEDICAL_CONTEXT_TOP_K", "3"))  # knowledge sections injected per cleanup prompt
 
-# Initialize OpenAI client
-openai.api_key = OPENAI_API_KEY
+# Per-request profiling (admin only): send X-Profile: cprofile|sample with X-Admin-Token
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds between stack samples
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))  # oldest profiles are pruned beyond this
+
+# Metrics configuration
+METRICS_LATENCY_BUCKETS = [
+    float(b) for b in os.environ.get("METRICS_LATENCY_BUCKETS", "0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30").split(",")
+]
+
+# Readiness: what /api/ready loads before reporting ready (comma-separated; empty = nothing)
+READY_PREWARM = [
+    part.strip() for part in os.environ.get("READY_PREWARM", "patients,medical,upstreams").split(",") if part.strip()
+]
 
 PROFILES = {
     "alpha": {"agent_name": os.environ.get("PROFILE_ALPHA_AGENT_NAME", "Dexter"),
@@ -52,12 +229,738 @@ PROFILES = {
               "avatar_id": os.environ.get("PROFILE_GAMMA_AVATAR_ID", "Judy_Doctor_Sitting2_public")},
 }
 
-app = FastAPI(title="HeyGen SDK Backend (token + session)")
+# ---- metrics ----
+class Metrics:
+    """
+    In-process latency histograms and in-flight gauges, rendered in the Prometheus text
+    exposition format by GET /api/metrics.
+
+    Values are per worker process; with several workers, scrape each one. Thread-safe,
+    since storage timings are recorded from the threadpool.
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}  # name -> (type, help)
+        self._histograms: Dict[str, Dict[tuple, List[float]]] = {}  # labels -> bucket counts + [sum, count]
+        self._gauges: Dict[str, Dict[tuple, float]] = {}
+
+    def histogram(self, name: str, help_text: str):
+        self._meta[name] = ("histogram", help_text)
+        self._histograms.setdefault(name, {})
+
+    def gauge(self, name: str, help_text: str):
+        self._meta[name] = ("gauge", help_text)
+        self._gauges.setdefault(name, {})
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._histograms[name].get(key)
+            if series is None:
+                series = self._histograms[name][key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ("counter", help_text)
+        self._gauges.setdefault(name, {})
+
+    def add(self, name: str, delta: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges[name][key] = self._gauges[name].get(key, 0) + delta
+
+    def set(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges[name][key] = value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the duration of the block (also when it raises)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def tracking(self, name: str, **labels):
+        """Count the block in an in-flight gauge while it runs"""
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def reset(self):
+        with self._lock:
+            for series in (*self._histograms.values(), *self._gauges.values()):
+                series.clear()
+
+    @staticmethod
+    def _labels(key: tuple, extra: Optional[tuple] = None) -> str:
+        items = key + ((extra,) if extra else ())
+        if not items:
+            return ""
+        escaped = (
+            k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in items
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    for key, value in sorted(self._gauges[name].items()):
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+                    continue
+                for key, series in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + [float("inf")], series):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{self._labels(key, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {series[-2]:.6f}")
+                    lines.append(f"{name}_count{self._labels(key)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+_metrics = Metrics(METRICS_LATENCY_BUCKETS)
+_metrics.histogram("amiya_http_request_seconds", "HTTP request latency by route, method and status code.")
+_metrics.gauge("amiya_http_requests_in_flight", "HTTP requests currently being served, by route.")
+_metrics.histogram("amiya_stage_seconds", "Latency of each /api/process-audio pipeline stage.")
+_metrics.histogram("amiya_upstream_request_seconds", "Latency of calls to HeyGen, Whisper, chat completions and Twilio, by outcome.")
+_metrics.gauge("amiya_upstream_requests_in_flight", "Upstream calls currently waiting on a response.")
+_metrics.histogram("amiya_storage_seconds", "Time spent reading and writing the CSV data files.")
+_metrics.counter("amiya_upstream_retries_total", "Upstream calls retried after a timeout, connection error, 429 or 5xx.")
+_metrics.counter("amiya_upstream_hedges_total", "Hedged second requests sent after an upstream call outlasted its p95.")
+_metrics.counter("amiya_upstream_rejected_total", "Upstream calls failed fast because the upstream's circuit was open.")
+_metrics.gauge("amiya_upstream_circuit_open", "1 while an upstream's circuit breaker is open or probing, else 0.")
+_metrics.gauge("amiya_admission_queued", "Requests waiting for a slot in their admission lane.")
+_metrics.counter("amiya_admission_rejected_total", "Requests turned away by admission control, by lane and reason.")
+
+@contextmanager
+def _stage_timer(stage: str):
+    with _metrics.timer("amiya_stage_seconds", stage=stage):
+        yield
+
+@asynccontextmanager
+async def _upstream_call(upstream: str):
+    """Time one upstream call and count it as in flight; outcome is "error" if the block raises"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with _metrics.tracking("amiya_upstream_requests_in_flight", upstream=upstream):
+            yield
+        outcome = "ok"
+    except asyncio.CancelledError:
+        outcome = "cancelled"  # e.g. the losing copy of a hedged request
+        raise
+    finally:
+        _metrics.observe("amiya_upstream_request_seconds", time.perf_counter() - started, upstream=upstream, outcome=outcome)
+
+def _storage_timer(path: str, op: str):
+    return _metrics.timer("amiya_storage_seconds", file=os.path.basename(path), op=op)
+
+def _route_template(scope) -> str:
+    """The path template of the route that will serve this request, e.g. /api/patient/{uid}"""
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+class _MetricsMiddleware:
+    """ASGI middleware recording request latency and in-flight counts per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = _route_template(scope)
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            with _metrics.tracking("amiya_http_requests_in_flight", route=route):
+                await self.app(scope, receive, send_with_status)
+        finally:
+            _metrics.observe(
+                "amiya_http_request_seconds", time.perf_counter() - started,
+                route=route, method=scope["method"], status=str(status["code"]),
+            )
+
+# ---- profiling ----
+class RequestProfile:
+    """
+    Profile of a single request, written to PROFILE_DIR as `<id>.prof` (cProfile, for
+    pstats/snakeviz) or `<id>.folded` (sampled stacks in collapsed format, for flamegraphs).
+
+    Covers the event loop thread plus any threadpool work the request starts through
+    `_run_in_threadpool`. Work from other requests interleaved on the event loop while
+    this one is awaiting shows up too, so profile on a quiet worker when possible.
+    """
+
+    MODES = ("cprofile", "sample")
+
+    def __init__(self, mode: str, directory: str, sample_interval: float):
+        self.mode = mode
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}"
+        self._profiles: List[cProfile.Profile] = []
+        self._threads = set()  # thread idents doing this request's work (sampling mode)
+        self._samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, self.id + (".prof" if self.mode == "cprofile" else ".folded"))
+
+    def start(self):
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            self._profiles.append(profile)
+            profile.enable()
+        else:
+            self._threads.add(threading.get_ident())
+            self._sampler = threading.Thread(target=self._sample, name=f"profile-{self.id}", daemon=True)
+            self._sampler.start()
+
+    def run_in_thread(self, func, *args, **kwargs):
+        """Run `func` in the current (worker) thread as part of this profile"""
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            self._profiles.append(profile)
+            return profile.runcall(func, *args, **kwargs)
+        ident = threading.get_ident()
+        self._threads.add(ident)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._threads.discard(ident)
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            for ident in list(self._threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self._samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        """Stop profiling and write the profile; returns its path"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.mode == "cprofile":
+            self._profiles[0].disable()
+            stats = pstats.Stats(self._profiles[0])
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.path)
+        else:
+            self._stop.set()
+            self._sampler.join()
+            with open(self.path, "w", encoding="utf-8") as file:
+                for stack, count in self._samples.most_common():
+                    file.write(f"{stack} {count}\n")
+        _prune_profiles(self.directory, PROFILE_MAX_FILES)
+        return self.path
+
+def _prune_profiles(directory: str, keep: int):
+    entries = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+_active_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("active_profile", default=None)
+_profiling_lock = threading.Lock()  # one profiled request at a time per worker (cProfile can't nest)
+
+async def _run_in_threadpool(func, *args, **kwargs):
+    """
+    run_in_threadpool that keeps the work inside the current request's profile, if any, and
+    runs priority-lane requests on their own threads so heavy endpoints can't starve them
+    """
+    profile = _active_profile.get()
+    if profile is not None:
+        func, args = profile.run_in_thread, (func, *args)
+    if _admission_lane.get() == "priority":
+        return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=_priority_limiter())
+    return await run_in_threadpool(func, *args, **kwargs)
+
+def _is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+class _ProfilingMiddleware:
+    """ASGI middleware that profiles requests carrying `X-Profile` from an admin; replies with X-Profile-Id"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"] if k in (b"x-profile", b"x-admin-token")}
+        mode = headers.get("x-profile", "").strip().lower()
+        if not mode:
+            await self.app(scope, receive, send)
+            return
+        if not PROFILING_ENABLED or not _is_admin(headers.get("x-admin-token")):
+            await _send_plain_error(send, 403, "Profiling is disabled or the admin token is missing/invalid")
+            return
+        if mode not in RequestProfile.MODES:
+            await _send_plain_error(send, 400, f"X-Profile must be one of {list(RequestProfile.MODES)}")
+            return
+        if not _profiling_lock.acquire(blocking=False):
+            await _send_plain_error(send, 409, "Another request is being profiled; retry shortly")
+            return
+
+        profile = RequestProfile(mode, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        token = _active_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            try:
+                path = profile.stop()
+                print(f"Saved {mode} profile {profile.id} for {scope['method']} {scope['path']} to {path}")
+            finally:
+                _active_profile.reset(token)
+                _profiling_lock.release()
+
+async def _send_plain_error(send, status: int, detail: str, headers: Optional[Dict[str, str]] = None):
+    body = json.dumps({"detail": detail}).encode()
+    extra = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in (headers or {}).items()]
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *extra]})
+    await send({"type": "http.response.body", "body": body})
+
+# ---- admission control ----
+class AdmissionLane:
+    """
+    Concurrency limit with a bounded FIFO wait queue for one group of endpoints.
+
+    `acquire()` returns False instead of waiting when the queue is full or the wait runs
+    past `queue_timeout`; a released slot passes straight to the oldest waiter. Waiters
+    are plain futures of the running loop, so a lane isn't tied to one event loop.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: deque = deque()
+        self._service_seconds: Optional[float] = None  # moving average of how long a request holds a slot
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Whole seconds until a slot is likely to free up for a request arriving now"""
+        per_request = self._service_seconds or 1.0
+        return max(1, math.ceil(per_request * (self.queued + 1) / max(1, self.limit)))
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        _metrics.set("amiya_admission_queued", self.queued, lane=self.name)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just as the client went away
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            _metrics.set("amiya_admission_queued", self.queued, lane=self.name)
+
+    def release(self, held_seconds: Optional[float] = None):
+        if held_seconds is not None:
+            previous = self._service_seconds
+            self._service_seconds = held_seconds if previous is None else 0.8 * previous + 0.2 * held_seconds
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # hand the slot over; `active` stays the same
+                return
+        self.active -= 1
+
+_admission_lanes: Dict[str, AdmissionLane] = {
+    name: AdmissionLane(name, limit, queued, ADMISSION_QUEUE_TIMEOUT)
+    for name, (limit, queued) in ADMISSION_LANES.items() if limit > 0
+}
+_admission_lane: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("admission_lane", default=None)
+_threadpool_limiters: Dict[str, anyio.CapacityLimiter] = {}
+
+def _priority_limiter() -> anyio.CapacityLimiter:
+    limiter = _threadpool_limiters.get("priority")
+    if limiter is None:
+        limiter = _threadpool_limiters["priority"] = anyio.CapacityLimiter(max(1, PRIORITY_THREADPOOL_SIZE))
+    return limiter
+
+class _AdmissionMiddleware:
+    """
+    ASGI middleware applying ADMISSION_BODY_LIMITS (413 as soon as a body is known to be too
+    large, from Content-Length or from the bytes received so far) and the admission lane of
+    the matched route (429 with Retry-After when the lane is saturated).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = _route_template(scope)
+        lane = _admission_lanes.get(ADMISSION_ROUTES.get(route, ""))
+        lane_name = lane.name if lane else "none"
+        limit = ADMISSION_BODY_LIMITS.get(route, MAX_REQUEST_BODY_BYTES)
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > limit:
+            _metrics.add("amiya_admission_rejected_total", 1, lane=lane_name, reason="body_too_large")
+            await _send_plain_error(send, 413, f"Request body exceeds {limit} bytes")
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    _metrics.add("amiya_admission_rejected_total", 1, lane=lane_name, reason="body_too_large")
+                    raise HTTPException(413, f"Request body exceeds {limit} bytes")
+            return message
+
+        if lane is None:
+            await self.app(scope, limited_receive, send)
+            return
+        if not await lane.acquire():
+            _metrics.add("amiya_admission_rejected_total", 1, lane=lane_name, reason="saturated")
+            await _send_plain_error(send, 429, f"Too many {lane_name} requests in progress; retry shortly",
+                                    headers={"Retry-After": str(lane.retry_after())})
+            return
+        token = _admission_lane.set(lane_name)
+        started = time.monotonic()
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            _admission_lane.reset(token)
+            lane.release(time.monotonic() - started)
+
+# ---- upstream clients ----
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+_openai_client: Optional["openai.AsyncOpenAI"] = None
+_stage_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def _upstream_client_kwargs(upstream: str) -> Dict[str, Any]:
+    http2 = UPSTREAM_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        print("Warning: UPSTREAM_HTTP2=1 but the 'h2' package is not installed; using HTTP/1.1")
+        http2 = False
+    return {
+        "timeout": httpx.Timeout(UPSTREAM_TIMEOUTS[upstream]),
+        "limits": httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        "http2": http2,
+    }
+
+def _http_client(upstream: str) -> httpx.AsyncClient:
+    """Pooled keep-alive client for an upstream ("heygen" or "openai"), created on first use"""
+    client = _http_clients.get(upstream)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(**_upstream_client_kwargs(upstream))
+        _http_clients[upstream] = client
+    return client
+
+def _openai_async_client() -> "openai.AsyncOpenAI":
+    """Async OpenAI SDK client riding on the shared OpenAI connection pool"""
+    global _openai_client
+    http_client = _http_client("openai")
+    if _openai_client is None or _openai_client._client is not http_client:
+        import openai
+        # max_retries=0: retries and deadlines are handled by the upstream guards, not stacked on top of them
+        _openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0)
+    return _openai_client
+
+def _stage_slot(stage: str) -> asyncio.Semaphore:
+    """Concurrency limit for one pipeline stage, so a slow stage can't starve the others"""
+    semaphore = _stage_semaphores.get(stage)
+    if semaphore is None:
+        semaphore = _stage_semaphores[stage] = asyncio.Semaphore(STAGE_CONCURRENCY[stage])
+    return semaphore
+
+async def _close_upstream_clients():
+    global _openai_client
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    _openai_client = None  # shares the "openai" pool closed below
+    for client in clients:
+        await client.aclose()
+
+# ---- upstream resilience ----
+class UpstreamUnavailable(HTTPException):
+    """An upstream call failed fast: its circuit is open (503, with Retry-After) or its deadline ran out (504)"""
+
+    def __init__(self, upstream: str, status_code: int, detail: str, retry_after: Optional[float] = None):
+        headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after is not None else None
+        super().__init__(status_code, detail, headers=headers)
+        self.upstream = upstream
+
+def _upstream_error_is_retryable(error: BaseException) -> bool:
+    """Timeouts, connection failures, 429 and 5xx may clear up on retry (and count against the breaker); other 4xx won't"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    openai = sys.modules.get("openai")  # only loaded once an OpenAI call has been made
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    else:
+        status = getattr(error, "status_code", getattr(error, "status", None))  # OpenAI SDK, our own / Twilio
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. After `failure_threshold` failed calls in a row the
+    circuit opens and calls fail fast for `reset_seconds`; then a single probe call is let
+    through, and its outcome closes the circuit or opens it for another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return state == "closed"
+
+    def record(self, ok: bool):
+        self._probing = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Forget an in-flight call without a verdict (it was cancelled)"""
+        self._probing = False
+
+class UpstreamGuard:
+    """
+    Resilience policy for one upstream ("heygen_token", "whisper", "chat" or "twilio").
+
+    `call(attempt)` runs `attempt()` (a coroutine function making one request) under the
+    upstream's circuit breaker and overall deadline. Idempotent calls that fail with a
+    retryable error are retried with full-jitter exponential backoff while the deadline
+    allows; with hedging on, a second copy of an attempt is started once the first has
+    outlasted the upstream's recent p95 latency, and whichever finishes first wins.
+    """
+
+    def __init__(self, name: str, deadline: float, max_attempts: int, retry_base: float, retry_max: float,
+                 hedge: bool, breaker: CircuitBreaker, hedge_percentile: float = UPSTREAM_HEDGE_PERCENTILE,
+                 hedge_min_samples: int = UPSTREAM_HEDGE_MIN_SAMPLES, hedge_min_delay: float = UPSTREAM_HEDGE_MIN_DELAY):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.hedge = hedge
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self._latencies: deque = deque(maxlen=200)  # recent successful attempts, in seconds
+        self.retries = 0
+        self.hedges = 0
+        self.rejected = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while hedging is off or there are too few samples"""
+        if not self.hedge or len(self._latencies) < max(1, self.hedge_min_samples):
+            return None
+        ordered = sorted(self._latencies)
+        rank = max(1, math.ceil(self.hedge_percentile / 100 * len(ordered)))
+        return max(self.hedge_min_delay, ordered[rank - 1])
+
+    @asynccontextmanager
+    async def circuit(self):
+        """Fail fast while the circuit is open, and feed the block's outcome to the breaker"""
+        if not self.breaker.allow():
+            self.rejected += 1
+            _metrics.add("amiya_upstream_rejected_total", 1, upstream=self.name)
+            raise UpstreamUnavailable(self.name, 503, f"{self.name} is temporarily unavailable", self.breaker.retry_after())
+        try:
+            yield
+        except Exception as error:
+            self.breaker.record(not _upstream_error_is_retryable(error))  # a 4xx still means the upstream answered
+            raise
+        except BaseException:
+            self.breaker.release()  # cancelled, or a stream closed early (GeneratorExit): no verdict either way
+            raise
+        else:
+            self.breaker.record(True)
+        finally:
+            _metrics.set("amiya_upstream_circuit_open", 0 if self.breaker.state == "closed" else 1, upstream=self.name)
+
+    async def _timed(self, attempt):
+        started = time.monotonic()
+        result = await attempt()
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    async def _race(self, attempt, hedge: bool):
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return await self._timed(attempt)
+        tasks = [asyncio.ensure_future(self._timed(attempt))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                _metrics.add("amiya_upstream_hedges_total", 1, upstream=self.name)
+                tasks.append(asyncio.ensure_future(self._timed(attempt)))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(self, attempt, idempotent: bool = True, hedge: bool = True):
+        async with self.circuit():
+            deadline = time.monotonic() + self.deadline
+            attempts = self.max_attempts if idempotent else 1
+            for number in range(1, attempts + 1):
+                try:
+                    return await asyncio.wait_for(self._race(attempt, hedge and idempotent), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    raise UpstreamUnavailable(self.name, 504, f"{self.name} did not answer within {self.deadline:g}s")
+                except Exception as error:
+                    backoff = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** (number - 1)))
+                    if number == attempts or not _upstream_error_is_retryable(error) or time.monotonic() + backoff >= deadline:
+                        raise
+                    print(f"Retrying {self.name} in {backoff:.2f}s after: {error}")
+                    self.retries += 1
+                    _metrics.add("amiya_upstream_retries_total", 1, upstream=self.name)
+                    await asyncio.sleep(backoff)
+
+_upstream_guards: Dict[str, UpstreamGuard] = {}
+
+def _upstream_guard(name: str) -> UpstreamGuard:
+    """The resilience policy for one upstream, created on first use from the UPSTREAM_* settings"""
+    guard = _upstream_guards.get(name)
+    if guard is None:
+        guard = _upstream_guards[name] = UpstreamGuard(
+            name, UPSTREAM_DEADLINES[name], UPSTREAM_MAX_ATTEMPTS, UPSTREAM_RETRY_BASE_SECONDS, UPSTREAM_RETRY_MAX_SECONDS,
+            name in UPSTREAM_HEDGE, CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET_SECONDS),
+        )
+    return guard
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _stage_semaphores.clear()  # bind the stage limits to this event loop
+    _threadpool_limiters.clear()
+    _readiness.update(ready=False, draining=False, checks={}, lock=None)
+    # Open the pools up front so the first requests don't pay for it
+    for upstream in UPSTREAM_TIMEOUTS:
+        _http_client(upstream)
+    if HEYGEN_API_KEY:
+        _token_pool.start()
+    _sms_dispatcher.start()
+    try:
+        yield
+    finally:
+        _readiness["draining"] = True
+        await _sms_dispatcher.stop()
+        await _close_twilio_client()
+        await _token_pool.stop()
+        await _close_upstream_clients()
+
+app = FastAPI(title="HeyGen SDK Backend (token + session)", lifespan=lifespan)
+# Admission and profiling sit inside CORS so their 413/429 answers and X-Profile-Id headers get CORS headers too
+app.add_middleware(_AdmissionMiddleware)
+app.add_middleware(_ProfilingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=os.environ.get("CORS_ALLOW_ORIGINS", "*").split(","),
     allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["X-Profile-Id", "Retry-After"],  # readable from browser JS
 )
+app.add_middleware(_MetricsMiddleware)
 
 # ---- models ----
 class KnowledgeConfig(BaseModel):
@@ -110,6 +1013,21 @@ class PatientResponse(BaseModel):
     agent_name: str
     message: str
 
+class PatientImportRow(BaseModel):
+    line: int
+    status: Literal["created", "updated", "duplicate", "invalid"]
+    uid: Optional[str] = None
+    phone_number: Optional[str] = None
+    error: Optional[str] = None
+    sms: Optional[str] = None
+
+class PatientImportResponse(BaseModel):
+    created: int
+    updated: int
+    duplicates: int
+    invalid: int
+    rows: List[PatientImportRow]
+
 class PatientLookupResponse(BaseModel):
     name: str
     doctor: str
@@ -122,18 +1040,51 @@ class TranscriptSummaryRequest(BaseModel):
     uid: str = Field(..., description="Patient's UID")
     doctor_name: str = Field(..., description="Name of the doctor")
     user_name: str = Field(..., description="Name of the patient")
+    final: bool = Field(True, description="Visit is over: save the summary and close the visit. Send false for interim summaries during the visit")
 
 class TranscriptSummaryResponse(BaseModel):
     summary: str
 
+class ConversationRecord(BaseModel):
+    start_time: str
+    duration_minutes: float
+    phone_number: str
+    uid: str
+    summary: str
+    doctor_name: str
+    user_name: str
+
+class ConversationHistoryResponse(BaseModel):
+    conversations: List[ConversationRecord]
+    next_cursor: Optional[str] = None
+
 class AudioProcessRequest(BaseModel):
     audio_data: str = Field(..., description="Base64 encoded audio data")
     patient_context: Optional[str] = Field(None, description="Additional patient context")
+    mode: Optional[Literal["full", "fast"]] = Field(None, description="fast: return the raw transcript now, clean it up in the background")
+
+class AudioPreprocessStats(BaseModel):
+    bytes_in: int
+    bytes_out: int
+    bytes_saved: int
+    seconds_in: float
+    seconds_out: float
+    seconds_saved: float
+    silent: bool
 
 class AudioProcessResponse(BaseModel):
     transcribed_text: str
     processed_text: str
     success: bool
+    preprocessing: Optional[AudioPreprocessStats] = None  # only when AUDIO_PREPROCESS=1 handled the clip
+    cleanup: Optional[Literal["pending", "skipped"]] = None  # fast mode only
+    cleanup_id: Optional[str] = None  # handle for GET /api/process-audio/cleanup/{cleanup_id} while pending
+
+class AudioCleanupResponse(BaseModel):
+    cleanup_id: str
+    status: Literal["pending", "done", "failed"]
+    processed_text: Optional[str] = None
+    error: Optional[str] = None
 
 # ---- helpers ----
 def _generate_uid() -> str:
@@ -150,58 +1101,342 @@ def _extract_doctor_first_name(doctor_name: str) -> str:
     # If it doesn't start with 'Dr. ', return as is
     return doctor_name
 
-def _ensure_csv_file_exists():
-    """Ensure the CSV file exists with proper headers"""
-    if not os.path.exists(CSV_FILE_PATH):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(CSV_FILE_PATH, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(['uid', 'name', 'phone_number', 'agent_name'])
+PATIENT_FIELDS = ['uid', 'name', 'phone_number', 'agent_name']
+
+def _normalize_phone(phone_number: str) -> str:
+    """Reduce a phone number to its digits so '+1 (650) 450-6083' and '+16504506083' match"""
+    digits = ''.join(ch for ch in phone_number if ch.isdigit())
+    return digits or phone_number.strip()
+
+class _FileLock:
+    """
+    Cross-process advisory lock held on a sidecar `.lock` file.
+
+    Uses flock, which also excludes threads of the same process because every `hold()`
+    opens its own file description. Where flock is unavailable (Windows) it degrades to
+    an in-process lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fallback = threading.RLock()
+
+    @contextmanager
+    def hold(self, shared: bool = False):
+        if fcntl is None:
+            with self._fallback:
+                yield
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the flock
+
+def _fsync_dir(path: str):
+    """Persist a rename by syncing the containing directory (best effort, POSIX only)"""
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _atomic_write_csv(path: str, fieldnames: List[str], rows):
+    """Write a CSV to a temp file in the same directory, fsync it and rename it over `path`"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with _storage_timer(path, "rewrite"):
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(rows)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        _fsync_dir(path)
+
+def _append_csv_rows(path: str, fieldnames: List[str], rows: List[Dict[str, Any]]) -> int:
+    """Append rows (writing the header for a new file) with a single write + fsync; returns the new file size"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    if new_file:
+        writer.writeheader()
+    writer.writerows(rows)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _storage_timer(path, "append"):
+        with open(path, 'a', newline='', encoding='utf-8') as file:
+            file.write(buffer.getvalue())
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        if new_file:
+            _fsync_dir(path)
+    return size
+
+class _GroupCommitter:
+    """
+    Batches concurrent writers into one commit.
+
+    The first writer to arrive becomes the leader: it takes everything queued so far and
+    passes it to `commit(batch)` in a single call (one lock acquisition, one write, one
+    fsync). Writers arriving meanwhile queue up for the next round. `commit` returns one
+    result per item; if it raises, every writer in the batch sees the exception.
+    """
+
+    def __init__(self, commit):
+        self._commit = commit
+        self._cond = threading.Condition()
+        self._pending: List[Dict[str, Any]] = []
+        self._leader_active = False
+
+    def submit(self, item: Any) -> Any:
+        ticket = {'item': item, 'done': False, 'result': None, 'error': None}
+        with self._cond:
+            self._pending.append(ticket)
+            while not ticket['done']:
+                if self._leader_active:
+                    self._cond.wait()
+                    continue
+                self._leader_active = True
+                batch, self._pending = self._pending, []
+                self._cond.release()
+                try:
+                    try:
+                        results = self._commit([t['item'] for t in batch])
+                        for t, result in zip(batch, results):
+                            t['result'] = result
+                    except BaseException as e:
+                        for t in batch:
+                            t['error'] = e
+                finally:
+                    self._cond.acquire()
+                    for t in batch:
+                        t['done'] = True
+                    self._leader_active = False
+                    self._cond.notify_all()
+        if ticket['error'] is not None:
+            raise ticket['error']
+        return ticket['result']
+
+def _file_signature(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class PatientStore:
+    """
+    Patient roster kept in memory with hash indexes on uid and normalized phone number.
+
+    db.csv holds the last compacted snapshot. Every upsert is appended as a single row to
+    an append-only log, which is replayed on load and folded back into the snapshot once
+    it holds `compact_threshold` entries. Replaying an upsert is idempotent, so a crash
+    between rewriting the snapshot and removing the log loses nothing.
+
+    Safe across worker processes: writers hold an exclusive flock on `<snapshot>.lock`,
+    readers a shared one, and each process tails the log (or reloads after another process
+    compacted) before serving, so the in-memory index never goes stale. Snapshots are
+    replaced atomically and concurrent upserts are group-committed with one fsync.
+    """
+
+    def __init__(self, snapshot_path: str, log_path: str, compact_threshold: int = 1000):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_threshold = max(1, compact_threshold)
+        self._lock = threading.RLock()
+        self._file_lock = _FileLock(snapshot_path + '.lock')
+        self._committer = _GroupCommitter(self._commit_batch)
+        self._loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._rows: Dict[int, Dict[str, str]] = {}  # slot -> row, insertion-ordered like the CSV
+        self._by_uid: Dict[str, int] = {}
+        self._by_phone: Dict[str, int] = {}
+        self._next_slot = 0
+        self._log_entries = 0
+        self._snapshot_sig: Optional[tuple] = None
+        self._log_ino: Optional[int] = None
+        self._log_offset = 0
+
+    # -- loading --
+    def _refresh(self):
+        """Bring the in-memory index up to date with disk; call with the file lock held."""
+        snapshot_sig = _file_signature(self.snapshot_path)
+        if not self._loaded or snapshot_sig != self._snapshot_sig:
+            self._reload(snapshot_sig)
+            return
+        log_sig = _file_signature(self.log_path)
+        if log_sig is None:
+            if self._log_offset:
+                self._reload(snapshot_sig)
+        elif self._log_ino is not None and (log_sig[0] != self._log_ino or log_sig[2] < self._log_offset):
+            self._reload(snapshot_sig)
+        elif log_sig[2] > self._log_offset:
+            self._replay_log(header=self._log_offset == 0)
+
+    def _reload(self, snapshot_sig: Optional[tuple]):
+        self._reset()
+        if snapshot_sig is not None:
+            with _storage_timer(self.snapshot_path, "read"), open(self.snapshot_path, 'r', newline='', encoding='utf-8') as file:
+                for row in csv.DictReader(file):
+                    self._insert(row)
+        self._snapshot_sig = snapshot_sig
+        self._replay_log(header=True)
+        self._loaded = True
+
+    def _replay_log(self, header: bool):
+        try:
+            with _storage_timer(self.log_path, "read"), open(self.log_path, 'rb') as file:
+                self._log_ino = os.fstat(file.fileno()).st_ino
+                file.seek(self._log_offset)
+                chunk = file.read()
+        except FileNotFoundError:
+            return
+        self._log_offset += len(chunk)
+        reader = csv.reader(io.StringIO(chunk.decode('utf-8'), newline=''))
+        if header:
+            next(reader, None)
+        for values in reader:
+            if values:
+                self._apply_upsert(dict(zip(PATIENT_FIELDS, values)))
+                self._log_entries += 1
+
+    def _insert(self, row: Dict[str, str]) -> int:
+        row = {field: row.get(field) or '' for field in PATIENT_FIELDS}
+        slot = self._next_slot
+        self._next_slot += 1
+        self._rows[slot] = row
+        # First match wins, same as the linear scans this replaces
+        self._by_uid.setdefault(row['uid'], slot)
+        self._by_phone.setdefault(_normalize_phone(row['phone_number']), slot)
+        return slot
+
+    def _apply_upsert(self, row: Dict[str, str]) -> Optional[str]:
+        """Insert or replace the row sharing this phone number; returns the replaced uid, if any."""
+        slot = self._by_phone.get(_normalize_phone(row['phone_number']))
+        if slot is None:
+            self._insert(row)
+            return None
+        old = self._rows[slot]
+        if self._by_uid.get(old['uid']) == slot:
+            del self._by_uid[old['uid']]
+        self._rows[slot] = {field: row.get(field) or '' for field in PATIENT_FIELDS}
+        self._by_uid.setdefault(row['uid'], slot)
+        return old['uid']
+
+    @contextmanager
+    def _reading(self):
+        with self._lock, self._file_lock.hold(shared=True):
+            self._refresh()
+            yield
+
+    # -- reads --
+    def all(self) -> List[Dict[str, str]]:
+        with self._reading():
+            return [dict(row) for row in self._rows.values()]
+
+    def get_by_uid(self, uid: str) -> Optional[Dict[str, str]]:
+        with self._reading():
+            slot = self._by_uid.get(uid)
+            return dict(self._rows[slot]) if slot is not None else None
+
+    def get_by_phone(self, phone_number: str) -> Optional[Dict[str, str]]:
+        with self._reading():
+            slot = self._by_phone.get(_normalize_phone(phone_number))
+            return dict(self._rows[slot]) if slot is not None else None
+
+    def __len__(self) -> int:
+        with self._reading():
+            return len(self._rows)
+
+    # -- writes --
+    def upsert(self, row: Dict[str, str]) -> Optional[str]:
+        """Add or replace a patient by phone number; returns the replaced uid, if any."""
+        return self._committer.submit(row)
+
+    def upsert_many(self, rows: List[Dict[str, str]]) -> List[Optional[str]]:
+        """Apply many upserts in order as one locked append + fsync; returns the replaced uids."""
+        return self._commit_batch(rows) if rows else []
+
+    def _commit_batch(self, rows: List[Dict[str, str]]) -> List[Optional[str]]:
+        with self._lock, self._file_lock.hold():
+            self._refresh()
+            old_uids = [self._apply_upsert(row) for row in rows]
+            try:
+                self._log_offset = _append_csv_rows(self.log_path, PATIENT_FIELDS, rows)
+            except BaseException:
+                self._loaded = False  # memory is ahead of disk; reload on next access
+                raise
+            self._log_ino = os.stat(self.log_path).st_ino
+            self._log_entries += len(rows)
+            if self._log_entries >= self.compact_threshold:
+                self._compact()
+            return old_uids
+
+    def replace_all(self, patients: List[Dict[str, str]]):
+        """Replace the whole roster and write it out as a fresh snapshot."""
+        with self._lock, self._file_lock.hold():
+            self._reset()
+            for patient in patients:
+                self._insert(patient)
+            self._loaded = True
+            self._compact()
+
+    def compact(self):
+        with self._lock, self._file_lock.hold():
+            self._refresh()
+            self._compact()
+
+    def _compact(self):
+        _atomic_write_csv(self.snapshot_path, PATIENT_FIELDS, self._rows.values())
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self._snapshot_sig = _file_signature(self.snapshot_path)
+        self._log_entries = 0
+        self._log_ino = None
+        self._log_offset = 0
 
 def _read_patients() -> List[Dict[str, str]]:
-    """Read all patients from CSV file"""
-    _ensure_csv_file_exists()
+    """Read all patients from the storage backend"""
     patients = []
     try:
-        with open(CSV_FILE_PATH, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            patients = list(reader)
+        patients = _storage.all_patients()
     except Exception as e:
-        print(f"Error reading CSV file: {e}")
+        print(f"Error reading patients: {e}")
     return patients
 
 def _write_patients(patients: List[Dict[str, str]]):
-    """Write all patients to CSV file"""
-    _ensure_csv_file_exists()
+    """Replace all patients in the storage backend"""
     try:
-        with open(CSV_FILE_PATH, 'w', newline='', encoding='utf-8') as file:
-            if patients:
-                writer = csv.DictWriter(file, fieldnames=['uid', 'name', 'phone_number', 'agent_name'])
-                writer.writeheader()
-                writer.writerows(patients)
-            else:
-                # Write header even if no patients
-                writer = csv.DictWriter(file, fieldnames=['uid', 'name', 'phone_number', 'agent_name'])
-                writer.writeheader()
+        _storage.replace_patients(patients)
     except Exception as e:
-        print(f"Error writing CSV file: {e}")
+        print(f"Error writing patients: {e}")
         raise HTTPException(500, "Failed to save patient data")
 
 def _add_or_update_patient(name: str, phone_number: str, agent_name: str) -> PatientResponse:
     """Add new patient or update existing one by phone number"""
-    patients = _read_patients()
-    
     # Extract first name from doctor name (e.g., "Dr. Michael Rodriguez" -> "Michael")
     doctor_first_name = _extract_doctor_first_name(agent_name)
     
-    # Check if patient with this phone number already exists
-    existing_index = None
-    for i, patient in enumerate(patients):
-        if patient['phone_number'] == phone_number:
-            existing_index = i
-            break
-    
     uid = _generate_uid()
+    while _storage.get_patient_by_uid(uid) is not None:
+        uid = _generate_uid()
     new_patient = {
         'uid': uid,
         'name': name,
@@ -209,18 +1444,17 @@ def _add_or_update_patient(name: str, phone_number: str, agent_name: str) -> Pat
         'agent_name': doctor_first_name  # Store the extracted first name
     }
     
-    if existing_index is not None:
-        # Update existing patient
-        old_uid = patients[existing_index]['uid']
-        patients[existing_index] = new_patient
+    try:
+        old_uid = _storage.upsert_patient(new_patient)
+    except Exception as e:
+        print(f"Error writing patients: {e}")
+        raise HTTPException(500, "Failed to save patient data")
+    
+    if old_uid is not None:
         message = f"Updated existing patient with UID {old_uid}"
     else:
-        # Add new patient
-        patients.append(new_patient)
         message = "Added new patient"
     
-    _write_patients(patients)
-    
     return PatientResponse(
         uid=uid,
         name=name,
@@ -229,115 +1463,1131 @@ def _add_or_update_patient(name: str, phone_number: str, agent_name: str) -> Pat
         message=message
     )
 
+def _iter_import_records(file, fmt: str):
+    """Yield (line, record dict or error string) from an uploaded CSV/NDJSON file, one row at a time"""
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        if fmt == 'ndjson':
+            for line_no, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield line_no, f"Invalid JSON: {e}"
+                    continue
+                yield line_no, record if isinstance(record, dict) else "Expected a JSON object"
+            return
+        reader = csv.DictReader(text)
+        missing = [field for field in ('name', 'phone_number', 'agent_name') if field not in (reader.fieldnames or [])]
+        if missing:
+            raise HTTPException(400, f"CSV header is missing columns: {', '.join(missing)}")
+        for record in reader:
+            if any((value or '').strip() for value in record.values() if isinstance(value, str)):
+                yield reader.line_num, record
+    except UnicodeDecodeError:
+        raise HTTPException(400, "Import file must be UTF-8 encoded")
+    except csv.Error as e:
+        raise HTTPException(400, f"Malformed CSV: {e}")
+    finally:
+        text.detach()
+
+def _import_patients(file, fmt: str) -> tuple:
+    """
+    Validate, dedupe and upsert an uploaded roster in one storage transaction.
+
+    Rows are checked against the NewPatientRequest rules; a phone number seen earlier in
+    the file marks later rows as duplicates. Returns the per-row report and the invites
+    to send for the rows that were saved.
+    """
+    report: List[PatientImportRow] = []
+    accepted: List[tuple] = []  # (report row, request, patient row)
+    seen_phones: Dict[str, int] = {}
+    taken_uids = set()
+    for line, record in _iter_import_records(file, fmt):
+        if isinstance(record, str):
+            report.append(PatientImportRow(line=line, status="invalid", error=record))
+            continue
+        try:
+            req = NewPatientRequest(**{field: record.get(field) for field in ('name', 'phone_number', 'agent_name')})
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            phone = record.get('phone_number')  # NDJSON may carry a number, list, ...; report it as text
+            report.append(PatientImportRow(
+                line=line, status="invalid", phone_number=None if phone is None else str(phone), error=errors
+            ))
+            continue
+        phone_key = _normalize_phone(req.phone_number)
+        if phone_key in seen_phones:
+            report.append(PatientImportRow(
+                line=line, status="duplicate", phone_number=req.phone_number,
+                error=f"Phone number already imported on line {seen_phones[phone_key]}"
+            ))
+            continue
+        seen_phones[phone_key] = line
+        uid = _generate_uid()
+        while uid in taken_uids or _storage.get_patient_by_uid(uid) is not None:
+            uid = _generate_uid()
+        taken_uids.add(uid)
+        row = PatientImportRow(line=line, status="created", uid=uid, phone_number=req.phone_number)
+        report.append(row)
+        accepted.append((row, req, {
+            'uid': uid,
+            'name': req.name,
+            'phone_number': req.phone_number,
+            'agent_name': _extract_doctor_first_name(req.agent_name),
+        }))
+
+    old_uids = _storage.upsert_patients([patient for _, _, patient in accepted])
+    for (row, _, _), old_uid in zip(accepted, old_uids):
+        if old_uid is not None:
+            row.status = "updated"
+    # Invites use the original full doctor name, as in /api/new-patient
+    invites = [
+        (row, {'phone_number': req.phone_number, 'name': req.name, 'agent_name': req.agent_name, 'uid': row.uid})
+        for row, req, _ in accepted
+    ]
+    return report, invites
+
 def _find_patient_by_uid(uid: str) -> Optional[Dict[str, str]]:
     """Find a patient by UID; returns dict or None if not found."""
-    patients = _read_patients()
-    for patient in patients:
-        if patient.get('uid') == uid:
-            return patient
-    return None
-
-async def _send_sms(phone_number: str, name: str, agent_name: str, uid: str) -> bool:
-    """Send SMS notification to patient with meeting link"""
     try:
+        return _storage.get_patient_by_uid(uid)
+    except Exception as e:
+        print(f"Error reading patients: {e}")
+        return None
+
+_twilio: Optional["Client"] = None
+
+def _twilio_client() -> "Client":
+    """The one Twilio client for this worker, on Twilio's pooled async (aiohttp) transport"""
+    global _twilio
+    if _twilio is None:
+        from twilio.rest import Client
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        _twilio = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=AsyncTwilioHttpClient(timeout=TWILIO_TIMEOUT))
+        if TWILIO_API_BASE:
+            _twilio.api.base_url = TWILIO_API_BASE.rstrip('/')
+    return _twilio
+
+async def _close_twilio_client():
+    global _twilio
+    client, _twilio = _twilio, None
+    if client is not None and hasattr(client.http_client, "close"):
+        await client.http_client.close()
+
+async def _send_sms(phone_number: str, name: str, agent_name: str, uid: str) -> str:
+    """Send SMS notification to patient with meeting link; returns the message SID, raises on failure"""
+    # Format phone number to ensure it starts with +
+    if not phone_number.startswith('+'):
+        phone_number = '+' + phone_number
+    
+    # Create the meeting link
+    meeting_link = f"localhost:3000/u/{uid}"
+    
+    # Create the message body
+    message_body = f"Hi {name}. You were invited to a checkup with Dr. {agent_name}. Click this to join the meeting: {meeting_link}"
+    
+    # Send the SMS (once: a retried create could text the patient twice; the SMS queue retries instead)
+    async def send():
+        async with _upstream_call("twilio"):
+            return await _twilio_client().messages.create_async(
+                body=message_body,
+                from_=TWILIO_PHONE_NUMBER,
+                to=phone_number
+            )
+    
+    message = await _upstream_guard("twilio").call(send, idempotent=False)
+    
+    print(f"SMS sent successfully to {phone_number}, SID: {message.sid}")
+    return message.sid
+
+def _sms_error_is_retryable(error: Exception) -> bool:
+    """Twilio 4xx answers (bad number, unverified recipient, ...) won't succeed on retry; 429 and 5xx might"""
+    status = getattr(error, "status", None)
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+class SmsDispatcher:
+    """
+    Outbound invite queue drained by background workers, so registering a patient
+    never waits on Twilio.
+
+    Sends are paced by a token bucket (`rate_per_second`, `burst`), failures are retried
+    with exponential backoff and jitter up to `max_attempts`, and the latest delivery
+    status is kept per uid for GET /api/sms-status/{uid}.
+    """
+
+    def __init__(self, send, workers: int, rate_per_second: float, burst: int, max_attempts: int,
+                 retry_base_seconds: float, status_capacity: int = 10000):
+        self._send = send
+        self.workers = max(1, workers)
+        self.rate_per_second = rate_per_second
+        self.burst = max(1, burst)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base_seconds = retry_base_seconds
+        self.status_capacity = status_capacity
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._rate_lock: Optional[asyncio.Lock] = None
+        self._statuses: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._backlog: List[Dict[str, Any]] = []  # enqueued before start() or pending when stop() ran
+        self._retry_timers: Dict[asyncio.Task, Dict[str, Any]] = {}  # backoff sleeps -> the job they will requeue
+
+    def _set_status(self, uid: str, status: str, **fields):
+        entry = self._statuses.pop(uid, None) or {"uid": uid, "attempts": 0, "sid": None, "error": None}
+        entry.update(fields, status=status, updated_at=datetime.now(timezone.utc).isoformat())
+        self._statuses[uid] = entry
+        while len(self._statuses) > self.status_capacity:
+            self._statuses.popitem(last=False)
+
+    def status(self, uid: str) -> Optional[Dict[str, Any]]:
+        entry = self._statuses.get(uid)
+        return dict(entry) if entry is not None else None
+
+    def enqueue(self, phone_number: str, name: str, agent_name: str, uid: str) -> str:
+        """Queue an invite; returns the initial delivery status"""
         if not TWILIO_AUTH_TOKEN:
             print("Warning: TWILIO_AUTH_TOKEN not set, skipping SMS")
-            return False
-            
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        
-        # Format phone number to ensure it starts with +
-        if not phone_number.startswith('+'):
-            phone_number = '+' + phone_number
-        
-        # Create the meeting link
-        meeting_link = f"localhost:3000/u/{uid}"
-        
-        # Create the message body
-        message_body = f"Hi {name}. You were invited to a checkup with Dr. {agent_name}. Click this to join the meeting: {meeting_link}"
-        
-        # Send the SMS
-        message = client.messages.create(
-            body=message_body,
-            from_=TWILIO_PHONE_NUMBER,
-            to=phone_number
+            self._set_status(uid, "skipped", error="TWILIO_AUTH_TOKEN not set")
+            return "skipped"
+        job = {"phone_number": phone_number, "name": name, "agent_name": agent_name, "uid": uid, "attempt": 0}
+        self._set_status(uid, "queued")
+        if self._queue is None:
+            self._backlog.append(job)
+        else:
+            self._queue.put_nowait(job)
+        return "queued"
+
+    def enqueue_many(self, invites: List[Dict[str, str]]) -> List[str]:
+        return [self.enqueue(**invite) for invite in invites]
+
+    async def _acquire_send_slot(self):
+        if self.rate_per_second <= 0:
+            return
+        async with self._rate_lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate_per_second)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_per_second)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._deliver(job)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job: Dict[str, Any]):
+        await self._acquire_send_slot()
+        job["attempt"] += 1
+        uid = job["uid"]
+        self._set_status(uid, "sending", attempts=job["attempt"])
+        try:
+            sid = await self._send(job["phone_number"], job["name"], job["agent_name"], uid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if job["attempt"] >= self.max_attempts or not _sms_error_is_retryable(e):
+                print(f"Failed to send SMS to {job['phone_number']}: {str(e)}")
+                self._set_status(uid, "failed", error=str(e))
+                return
+            delay = self.retry_base_seconds * (2 ** (job["attempt"] - 1)) * random.uniform(0.5, 1.5)
+            self._set_status(uid, "retrying", error=str(e), next_attempt_in=round(delay, 2))
+            timer = asyncio.create_task(self._requeue_later(job, delay))
+            self._retry_timers[timer] = job
+            timer.add_done_callback(lambda task: self._retry_timers.pop(task, None))
+            return
+        self._set_status(uid, "sent", sid=sid, error=None)
+
+    async def _requeue_later(self, job: Dict[str, Any], delay: float):
+        await asyncio.sleep(delay)
+        if self._queue is not None:
+            self._queue.put_nowait(job)
+        else:
+            self._backlog.append(job)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._rate_lock = asyncio.Lock()
+        for job in self._backlog:
+            self._queue.put_nowait(job)
+        self._backlog = []
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def drain(self):
+        """Wait until every queued invite has been attempted (retries scheduled later are not awaited)"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self):
+        """Stop the workers; invites still queued or waiting out a retry backoff go back to the backlog"""
+        tasks, self._tasks = self._tasks, []
+        timers = {timer: job for timer, job in self._retry_timers.items() if not timer.done()}  # done ones already requeued
+        self._retry_timers = {}
+        for task in [*tasks, *timers]:
+            task.cancel()
+        await asyncio.gather(*tasks, *timers, return_exceptions=True)
+        for job in timers.values():
+            self._backlog.append(job)
+            self._set_status(job["uid"], "queued")
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._backlog.append(self._queue.get_nowait())
+        self._queue = None
+
+    def stats(self) -> Dict[str, Any]:
+        counts = Counter(entry["status"] for entry in self._statuses.values())
+        return {"queued": self._queue.qsize() if self._queue is not None else len(self._backlog), "statuses": dict(counts)}
+
+_sms_dispatcher = SmsDispatcher(
+    _send_sms, SMS_WORKERS, SMS_RATE_PER_SECOND, SMS_RATE_BURST, SMS_MAX_ATTEMPTS, SMS_RETRY_BASE_SECONDS
+)
+
+CONVO_FIELDS = [
+    'start_time', 'duration_minutes', 'phone_number', 'uid',
+    'summary', 'doctor_name', 'user_name'
+]
+
+def _parse_iso_timestamp(value: str) -> Optional[float]:
+    """Epoch seconds for an ISO timestamp ('Z' allowed, naive means UTC); None if unparseable"""
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+class ConversationLog:
+    """
+    Append-only conversations CSV shared safely between workers, with query indexes.
+
+    Appends hold an exclusive flock on `<path>.lock`, and concurrent appends are
+    group-committed so a burst of summaries costs one write and one fsync.
+
+    Rows are indexed by uid, normalized phone number and doctor name; each index entry
+    is a list of (start_time, row id) kept sorted, so a history query is a bisect plus
+    the rows it returns. The indexes are maintained incrementally: before each query
+    only the bytes appended since the last one (by any worker) are parsed.
+    """
+
+    INDEXED_FIELDS = ('uid', 'phone_number', 'doctor_name')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._file_lock = _FileLock(path + '.lock')
+        self._committer = _GroupCommitter(self._commit_batch)
+        self._reset()
+
+    def _reset(self):
+        self._rows: List[Dict[str, str]] = []
+        self._indexes: Dict[str, Dict[str, List[tuple]]] = {field: {} for field in self.INDEXED_FIELDS}
+        self._ino: Optional[int] = None
+        self._offset = 0
+
+    @staticmethod
+    def _index_key(field: str, value: str) -> str:
+        if field == 'phone_number':
+            return _normalize_phone(value)
+        if field == 'doctor_name':
+            return value.strip().lower()
+        return value.strip()
+
+    def append(self, row: Dict[str, Any]):
+        self._committer.submit(row)
+
+    def append_many(self, rows: List[Dict[str, Any]]):
+        if rows:
+            self._commit_batch(rows)
+
+    def _commit_batch(self, rows: List[Dict[str, Any]]) -> List[bool]:
+        with self._file_lock.hold():
+            _append_csv_rows(self.path, CONVO_FIELDS, rows)
+        return [True] * len(rows)
+
+    # -- indexing --
+    def _refresh(self):
+        """Index rows appended since the last refresh; call with the file lock held."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            return
+        if self._ino is not None and (st.st_ino != self._ino or st.st_size < self._offset):
+            self._reset()  # file was replaced or truncated
+        if st.st_size == self._offset:
+            return
+        with _storage_timer(self.path, "read"), open(self.path, 'rb') as file:
+            self._ino = os.fstat(file.fileno()).st_ino
+            file.seek(self._offset)
+            chunk = file.read()
+        header = self._offset == 0
+        self._offset += len(chunk)
+        reader = csv.reader(io.StringIO(chunk.decode('utf-8'), newline=''))
+        if header:
+            next(reader, None)
+        for values in reader:
+            if values:
+                self._index_row(dict(zip(CONVO_FIELDS, values)))
+
+    def _index_row(self, row: Dict[str, str]):
+        row_id = len(self._rows)
+        self._rows.append(row)
+        ts = _parse_iso_timestamp(row.get('start_time') or '')
+        entry = (ts if ts is not None else float('-inf'), row_id)
+        for field in self.INDEXED_FIELDS:
+            postings = self._indexes[field].setdefault(self._index_key(field, row.get(field) or ''), [])
+            if not postings or postings[-1] <= entry:
+                postings.append(entry)  # the common case: rows arrive in time order
+            else:
+                bisect.insort(postings, entry)
+
+    def warm(self) -> int:
+        """Build the query indexes now; returns the number of conversations"""
+        with self._lock, self._file_lock.hold(shared=True):
+            self._refresh()
+            return len(self._rows)
+
+    # -- queries --
+    def query(
+        self,
+        field: str,
+        value: str,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        limit: int = 50,
+        cursor: Optional[tuple] = None,
+    ) -> tuple:
+        """
+        Conversations whose `field` matches `value`, newest first, optionally limited
+        to start times in [start, end]. Returns (rows, cursor for the next page or None).
+        """
+        with self._lock, self._file_lock.hold(shared=True):
+            self._refresh()
+            postings = self._indexes[field].get(self._index_key(field, value), [])
+            lo = bisect.bisect_left(postings, (start, -1)) if start is not None else 0
+            hi = bisect.bisect_right(postings, (end, float('inf'))) if end is not None else len(postings)
+            if cursor is not None:
+                hi = min(hi, bisect.bisect_left(postings, cursor))
+            first = max(lo, hi - limit)
+            page = postings[first:hi][::-1]
+            rows = [dict(self._rows[row_id]) for _, row_id in page]
+            next_cursor = page[-1] if first > lo and page else None
+            return rows, next_cursor
+
+class StorageBackend(ABC):
+    """
+    Where patients and conversation summaries live. Selected with STORAGE_BACKEND
+    ("csv", the default, or "sqlite"); both implement the same semantics: patients are
+    upserted by normalized phone number, conversations are append-only and queried
+    newest first by uid / phone_number / doctor_name.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def all_patients(self) -> List[Dict[str, str]]:
+        """Every patient row, in storage order."""
+
+    @abstractmethod
+    def get_patient_by_uid(self, uid: str) -> Optional[Dict[str, str]]:
+        """The patient with this uid, or None."""
+
+    @abstractmethod
+    def get_patient_by_phone(self, phone_number: str) -> Optional[Dict[str, str]]:
+        """The patient with this phone number (compared normalized), or None."""
+
+    def upsert_patient(self, row: Dict[str, str]) -> Optional[str]:
+        """Add or replace a patient by phone number; returns the replaced uid, if any."""
+        return self.upsert_patients([row])[0]
+
+    @abstractmethod
+    def upsert_patients(self, rows: List[Dict[str, str]]) -> List[Optional[str]]:
+        """Apply upserts in order as a single transaction; returns the replaced uids."""
+
+    @abstractmethod
+    def replace_patients(self, rows: List[Dict[str, str]]):
+        """Replace the whole patient table with `rows`."""
+
+    def append_conversation(self, row: Dict[str, Any]):
+        self.append_conversations([row])
+
+    @abstractmethod
+    def append_conversations(self, rows: List[Dict[str, Any]]):
+        """Append conversation summary rows."""
+
+    @abstractmethod
+    def query_conversations(self, field: str, value: str, start: Optional[float] = None, end: Optional[float] = None,
+                            limit: int = 50, cursor: Optional[tuple] = None) -> tuple:
+        """(rows newest first, cursor for the next page or None); cursors are (start_ts, row id)"""
+
+    def warm(self) -> int:
+        """Load indexes / open connections ahead of traffic; returns the patient count"""
+        return len(self.all_patients())
+
+    def close(self):
+        pass
+
+class CsvStorageBackend(StorageBackend):
+    """db.csv (+ upsert log) and convos.csv, via PatientStore and ConversationLog"""
+
+    name = "csv"
+
+    def __init__(self, patients: PatientStore, conversations: ConversationLog):
+        self.patients = patients
+        self.conversations = conversations
+
+    def all_patients(self):
+        return self.patients.all()
+
+    def get_patient_by_uid(self, uid):
+        return self.patients.get_by_uid(uid)
+
+    def get_patient_by_phone(self, phone_number):
+        return self.patients.get_by_phone(phone_number)
+
+    def upsert_patient(self, row):
+        return self.patients.upsert(row)  # group-committed with concurrent callers
+
+    def upsert_patients(self, rows):
+        return self.patients.upsert_many(rows)
+
+    def replace_patients(self, rows):
+        self.patients.replace_all(rows)
+
+    def append_conversation(self, row):
+        self.conversations.append(row)
+
+    def append_conversations(self, rows):
+        self.conversations.append_many(rows)
+
+    def query_conversations(self, field, value, start=None, end=None, limit=50, cursor=None):
+        return self.conversations.query(field, value, start, end, limit, cursor)
+
+    def warm(self):
+        self.conversations.warm()
+        return len(self.patients)
+
+class SqliteStorageBackend(StorageBackend):
+    """
+    Patients and conversations in one SQLite database in WAL mode, so readers never
+    block the writer and several workers can share the file. Every statement is a
+    fixed parameterized string (compiled once per connection by sqlite3's statement
+    cache), batches go through executemany inside one transaction, and lookups are
+    served by indexes on uid, phone, doctor and start time.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS patients (
+        slot INTEGER PRIMARY KEY AUTOINCREMENT,
+        uid TEXT NOT NULL,
+        name TEXT NOT NULL,
+        phone_number TEXT NOT NULL,
+        phone_key TEXT NOT NULL,
+        agent_name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS patients_uid ON patients (uid);
+    CREATE INDEX IF NOT EXISTS patients_phone_key ON patients (phone_key);
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_time TEXT NOT NULL,
+        start_ts REAL NOT NULL,
+        duration_minutes REAL NOT NULL,
+        phone_number TEXT NOT NULL,
+        phone_key TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        doctor_name TEXT NOT NULL,
+        doctor_key TEXT NOT NULL,
+        user_name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS conversations_uid ON conversations (uid, start_ts, id);
+    CREATE INDEX IF NOT EXISTS conversations_phone ON conversations (phone_key, start_ts, id);
+    CREATE INDEX IF NOT EXISTS conversations_doctor ON conversations (doctor_key, start_ts, id);
+    CREATE INDEX IF NOT EXISTS conversations_start ON conversations (start_ts, id);
+    """
+
+    PATIENT_COLUMNS = "uid, name, phone_number, agent_name"
+    CONVERSATION_COLUMNS = "start_time, duration_minutes, phone_number, uid, summary, doctor_name, user_name"
+    QUERY_KEYS = {'uid': 'uid', 'phone_number': 'phone_key', 'doctor_name': 'doctor_key'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections must not be shared across threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # check_same_thread=False only so close() can run from any thread; each thread still uses its own
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # durable across app crashes; WAL fsyncs at checkpoints
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")  # take the write lock up front so read-modify-write can't race
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def connection_mode(self) -> str:
+        return self._connect().execute("PRAGMA journal_mode").fetchone()[0]
+
+    @staticmethod
+    def _patient(row: Optional[sqlite3.Row]) -> Optional[Dict[str, str]]:
+        return {field: row[field] for field in PATIENT_FIELDS} if row is not None else None
+
+    # -- patients --
+    def all_patients(self):
+        rows = self._connect().execute(f"SELECT {self.PATIENT_COLUMNS} FROM patients ORDER BY slot")
+        return [self._patient(row) for row in rows]
+
+    def get_patient_by_uid(self, uid):
+        row = self._connect().execute(
+            f"SELECT {self.PATIENT_COLUMNS} FROM patients WHERE uid = ? ORDER BY slot LIMIT 1", (uid,)
+        ).fetchone()
+        return self._patient(row)
+
+    def get_patient_by_phone(self, phone_number):
+        row = self._connect().execute(
+            f"SELECT {self.PATIENT_COLUMNS} FROM patients WHERE phone_key = ? ORDER BY slot LIMIT 1",
+            (_normalize_phone(phone_number),)
+        ).fetchone()
+        return self._patient(row)
+
+    # Stay well under SQLite's bound-parameter limit (999 on older builds) in IN (...) lookups
+    LOOKUP_CHUNK = 500
+
+    def upsert_patients(self, rows):
+        rows = [{field: row.get(field) or '' for field in PATIENT_FIELDS} for row in rows]
+        keys = [_normalize_phone(row['phone_number']) for row in rows]
+        old_uids = []
+        with self._transaction() as conn:
+            unique_keys = list(dict.fromkeys(keys))
+            slots: Dict[str, int] = {}
+            current: Dict[str, str] = {}
+            for i in range(0, len(unique_keys), self.LOOKUP_CHUNK):
+                chunk = unique_keys[i:i + self.LOOKUP_CHUNK]
+                found = conn.execute(
+                    f"SELECT slot, uid, phone_key FROM patients WHERE phone_key IN ({', '.join('?' * len(chunk))}) ORDER BY slot",
+                    chunk
+                )
+                for existing in found:
+                    if existing['phone_key'] not in slots:  # the first slot wins, as in get_patient_by_phone
+                        slots[existing['phone_key']] = existing['slot']
+                        current[existing['phone_key']] = existing['uid']
+
+            # Replay the rows in order so a phone repeated within the batch updates the earlier row
+            updates: Dict[int, tuple] = {}
+            inserts: Dict[str, tuple] = {}
+            for values, phone_key in zip(rows, keys):
+                old_uids.append(current.get(phone_key))
+                current[phone_key] = values['uid']
+                record = (values['uid'], values['name'], values['phone_number'], phone_key, values['agent_name'])
+                if phone_key in slots:
+                    updates[slots[phone_key]] = record
+                else:
+                    inserts[phone_key] = record
+
+            if updates:
+                conn.executemany(
+                    "UPDATE patients SET uid = ?, name = ?, phone_number = ?, phone_key = ?, agent_name = ? WHERE slot = ?",
+                    [record + (slot,) for slot, record in updates.items()]
+                )
+            if inserts:
+                conn.executemany(
+                    "INSERT INTO patients (uid, name, phone_number, phone_key, agent_name) VALUES (?, ?, ?, ?, ?)",
+                    list(inserts.values())
+                )
+        return old_uids
+
+    def replace_patients(self, rows):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM patients")
+            self._insert_patients(conn, rows)
+
+    @staticmethod
+    def _insert_patients(conn: sqlite3.Connection, rows):
+        conn.executemany(
+            "INSERT INTO patients (uid, name, phone_number, phone_key, agent_name) VALUES (?, ?, ?, ?, ?)",
+            [
+                (row.get('uid') or '', row.get('name') or '', row.get('phone_number') or '',
+                 _normalize_phone(row.get('phone_number') or ''), row.get('agent_name') or '')
+                for row in rows
+            ]
         )
-        
-        print(f"SMS sent successfully to {phone_number}, SID: {message.sid}")
-        return True
-        
-    except Exception as e:
-        print(f"Failed to send SMS to {phone_number}: {str(e)}")
-        return False
 
-def _ensure_convos_csv_exists():
-    """Ensure the conversations CSV file exists with proper headers"""
-    if not os.path.exists(CONVOS_CSV_FILE_PATH):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(CONVOS_CSV_FILE_PATH, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=[
-                'start_time', 'duration_minutes', 'phone_number', 'uid', 
-                'summary', 'doctor_name', 'user_name'
-            ])
-            writer.writeheader()
+    # -- conversations --
+    def append_conversations(self, rows):
+        with self._transaction() as conn:
+            self._insert_conversations(conn, rows)
 
-async def _summarize_transcript_with_openai(transcript: str) -> str:
-    """Summarize transcript using GPT-5 nano"""
+    @staticmethod
+    def _insert_conversations(conn: sqlite3.Connection, rows):
+        def values(row):
+            start_time = str(row.get('start_time') or '')
+            start_ts = _parse_iso_timestamp(start_time)
+            try:
+                duration = float(row.get('duration_minutes') or 0)
+            except ValueError:
+                duration = 0.0
+            return (
+                start_time, start_ts if start_ts is not None else float('-inf'), duration,
+                row.get('phone_number') or '', _normalize_phone(row.get('phone_number') or ''),
+                row.get('uid') or '', row.get('summary') or '',
+                row.get('doctor_name') or '', ConversationLog._index_key('doctor_name', row.get('doctor_name') or ''),
+                row.get('user_name') or '',
+            )
+        conn.executemany(
+            "INSERT INTO conversations (start_time, start_ts, duration_minutes, phone_number, phone_key, uid, summary,"
+            " doctor_name, doctor_key, user_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [values(row) for row in rows]
+        )
+
+    def query_conversations(self, field, value, start=None, end=None, limit=50, cursor=None):
+        column = self.QUERY_KEYS[field]
+        cursor_ts, cursor_id = cursor if cursor is not None else (float('inf'), 0)
+        rows = self._connect().execute(
+            f"SELECT id, start_ts, {self.CONVERSATION_COLUMNS} FROM conversations"
+            f" WHERE {column} = ? AND start_ts >= ? AND start_ts <= ?"
+            "   AND (start_ts < ? OR (start_ts = ? AND id < ?))"
+            " ORDER BY start_ts DESC, id DESC LIMIT ?",
+            (
+                ConversationLog._index_key(field, value),
+                start if start is not None else float('-inf'),
+                end if end is not None else float('inf'),
+                cursor_ts, cursor_ts, cursor_id if cursor is not None else 0,
+                limit + 1,
+            )
+        ).fetchall()
+        page = rows[:limit]
+        next_cursor = (page[-1]['start_ts'], page[-1]['id']) if len(rows) > limit else None
+        return [{field: row[field] for field in CONVO_FIELDS} for row in page], next_cursor
+
+    def warm(self):
+        return self._connect().execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+def _create_storage_backend() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorageBackend(SQLITE_DB_PATH)
+    if STORAGE_BACKEND != "csv":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}'; use 'csv' or 'sqlite'")
+    return CsvStorageBackend(
+        PatientStore(CSV_FILE_PATH, PATIENT_LOG_FILE_PATH, PATIENT_LOG_COMPACT_THRESHOLD),
+        ConversationLog(CONVOS_CSV_FILE_PATH),
+    )
+
+_storage = _create_storage_backend()
+
+def migrate_csv_to_sqlite(sqlite_path: str, csv_path: str = None, convos_path: str = None, force: bool = False) -> Dict[str, int]:
+    """
+    One-shot import of db.csv (including any pending upsert log) and convos.csv into a
+    SQLite database. Refuses to import into a database that already holds data unless
+    `force` is set, in which case existing rows are replaced.
+    """
+    csv_path = csv_path or CSV_FILE_PATH
+    convos_path = convos_path or CONVOS_CSV_FILE_PATH
+    patients = PatientStore(csv_path, os.path.join(os.path.dirname(csv_path), os.path.basename(PATIENT_LOG_FILE_PATH))).all()
+    conversations = []
+    if os.path.exists(convos_path):
+        with open(convos_path, 'r', newline='', encoding='utf-8') as file:
+            conversations = list(csv.DictReader(file))
+
+    target = SqliteStorageBackend(sqlite_path)
     try:
-        if not OPENAI_API_KEY:
-            raise HTTPException(503, "Server missing OPENAI_API_KEY")
-        
-        prompt = """Summarize the important information for healthcare providers from this patient-doctor conversation transcript in 1-4 sentences. Focus on:
+        with target._transaction() as conn:
+            existing = conn.execute("SELECT (SELECT COUNT(*) FROM patients) + (SELECT COUNT(*) FROM conversations)").fetchone()[0]
+            if existing and not force:
+                raise RuntimeError(f"{sqlite_path} already contains data; migrate with force (--force) to replace it")
+            conn.execute("DELETE FROM patients")
+            conn.execute("DELETE FROM conversations")
+            SqliteStorageBackend._insert_patients(conn, patients)
+            SqliteStorageBackend._insert_conversations(conn, conversations)
+    finally:
+        target.close()
+    return {"patients": len(patients), "conversations": len(conversations)}
+
+class ResultCache:
+    """
+    Content-addressed cache for upstream model results.
+
+    Keys are hashes of everything that determines the result (input bytes or text,
+    model, prompt version), so a client retry with identical input is answered without
+    calling OpenAI again. Results live in an in-memory LRU and in a size-bounded
+    directory of small JSON files (least recently used evicted first). Concurrent
+    requests for the same key share one in-flight upstream call.
+    """
+
+    def __init__(self, directory: Optional[str], memory_entries: int, disk_bytes: int, enabled: bool = True):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk_lock = threading.Lock()
+        self._disk_usage: Optional[Dict[str, int]] = None  # file name -> size, loaded on first disk access
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(*parts: Union[str, bytes, memoryview]) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8") if isinstance(part, str) else part
+            digest.update(len(data).to_bytes(8, "big"))  # length-prefixed so parts can't run together
+            digest.update(data)
+        return digest.hexdigest()
+
+    async def get_or_compute(self, key: str, compute) -> Any:
+        if not self.enabled:
+            return await compute()
+        while True:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # The leader was cancelled, not us: look again (and compute ourselves if nobody else has)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            found, value = await _run_in_threadpool(self._disk_get, key)
+            if found:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                value = await compute()
+                await _run_in_threadpool(self._disk_put, key, value)
+            self._remember(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved so an un-awaited failure isn't logged
+            raise
+        except BaseException:
+            future.cancel()  # cancelled (e.g. the client went away): waiters take over instead of failing with us
+            raise
+        finally:
+            del self._inflight[key]
+
+    def lookup(self, key: str) -> tuple:
+        """(found, value) from memory or disk without computing anything"""
+        if not self.enabled:
+            return False, None
+        if key in self._memory:
+            self.hits += 1
+            return True, self._memory[key]
+        found, value = self._disk_get(key)
+        if found:
+            self.disk_hits += 1
+            self._remember(key, value)
+        return found, value
+
+    def put(self, key: str, value: Any):
+        if self.enabled:
+            self._remember(key, value)
+            self._disk_put(key, value)
+
+    def _remember(self, key: str, value: Any):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # -- disk tier --
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_disk_usage(self) -> Dict[str, int]:
+        if self._disk_usage is None:
+            usage = {}
+            if os.path.isdir(self.directory):
+                entries = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+                for entry in sorted(entries, key=lambda e: e.stat().st_mtime_ns):
+                    usage[entry.name] = entry.stat().st_size
+            self._disk_usage = usage
+        return self._disk_usage
+
+    def _disk_get(self, key: str) -> tuple:
+        if not self.directory or self.disk_bytes <= 0:
+            return False, None
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as file:
+                value = json.load(file)["value"]
+            os.utime(self._path(key))  # recency for eviction
+        except (OSError, ValueError, KeyError):
+            return False, None
+        with self._disk_lock:
+            usage = self._load_disk_usage()
+            name = f"{key}.json"
+            if name in usage:
+                usage[name] = usage.pop(name)  # move to the most-recent end
+        return True, value
+
+    def _disk_put(self, key: str, value: Any):
+        if not self.directory or self.disk_bytes <= 0:
+            return
+        data = json.dumps({"value": value}).encode("utf-8")
+        if len(data) > self.disk_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, self._path(key))
+            with self._disk_lock:
+                usage = self._load_disk_usage()
+                usage.pop(f"{key}.json", None)
+                usage[f"{key}.json"] = len(data)
+                total = sum(usage.values())
+                while total > self.disk_bytes and usage:
+                    name = next(iter(usage))
+                    total -= usage.pop(name)
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+        except OSError as e:
+            print(f"Error writing result cache entry: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk_usage or {}),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+_result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MEMORY_ENTRIES, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_ENABLED)
+
+def _prompt_version(*templates: str) -> str:
+    """Short hash of the prompt text, so editing a prompt invalidates its cached results"""
+    return ResultCache.key(*templates)[:12]
+
+SUMMARY_PROMPT = """Summarize the important information for healthcare providers from this patient-doctor conversation transcript in 1-4 sentences. Focus on:
 - Patient's main symptoms or concerns
 - Doctor's recommendations or diagnosis
 - Any follow-up actions needed
 - Key medical information discussed
 
 Transcript:"""
-        
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "gpt-4o-mini",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are a medical assistant helping to summarize patient-doctor conversations for healthcare records."
-                },
-                {
-                    "role": "user", 
-                    "content": f"{prompt}\n\n{transcript}"
-                }
-            ],
-            "max_tokens": 200,
-            "temperature": 0.3
-        }
-        
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(
+
+def _openai_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+SUMMARY_SYSTEM_PROMPT = "You are a medical assistant helping to summarize patient-doctor conversations for healthcare records."
+
+SUMMARY_MAP_PROMPT = """This is part {part} of {parts} of a patient-doctor conversation transcript. Summarize the important information for healthcare providers from this part in 1-3 sentences, keeping any symptoms, recommendations, diagnoses, follow-up actions and medical details it contains.
+
+Transcript part:"""
+
+SUMMARY_REDUCE_PROMPT = """Below are summaries of consecutive parts of one patient-doctor conversation, in order. Combine them into a single summary of the important information for healthcare providers in 1-4 sentences. Focus on:
+- Patient's main symptoms or concerns
+- Doctor's recommendations or diagnosis
+- Any follow-up actions needed
+- Key medical information discussed
+
+Part summaries:"""
+
+def _summary_payload(transcript: str, stream: bool = False, prompt: str = SUMMARY_PROMPT) -> Dict[str, Any]:
+    payload = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "system",
+                "content": SUMMARY_SYSTEM_PROMPT
+            },
+            {
+                "role": "user", 
+                "content": f"{prompt}\n\n{transcript}"
+            }
+        ],
+        "max_tokens": 200,
+        "temperature": 0.3
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+def _split_transcript(transcript: str, max_chars: int) -> List[str]:
+    """
+    Split a transcript into chunks of at most `max_chars`, cutting only between turns
+    (lines) where possible, then between sentences, and as a last resort at whitespace.
+    """
+    pieces: List[str] = []
+    for turn in transcript.splitlines():
+        if len(turn) <= max_chars:
+            pieces.append(turn)
+            continue
+        sentences = _SENTENCE_END_RE.split(turn)
+        for sentence in sentences:
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            pieces.append(sentence)
+
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for piece in pieces:
+        if current and size + 1 + len(piece) > max_chars:
+            chunks.append("\n".join(current).strip())
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+async def _request_summary(payload: Dict[str, Any]) -> str:
+    async def complete() -> httpx.Response:
+        async with _upstream_call("chat"):
+            response = await _http_client("openai").post(
                 "https://api.openai.com/v1/chat/completions",
-                headers=headers,
+                headers=_openai_headers(),
                 json=payload
             )
+            response.raise_for_status()
+        return response
+
+    response = await _upstream_guard("chat").call(complete)
+    data = response.json()
+    return data['choices'][0]['message']['content'].strip()
+
+async def _map_transcript_chunks(chunks: List[str]) -> str:
+    """Summarize chunks concurrently (bounded) and return the partial summaries as reduce-step input"""
+    semaphore = asyncio.Semaphore(max(1, SUMMARY_MAP_CONCURRENCY))
+
+    async def summarize_chunk(index: int, chunk: str) -> str:
+        async with semaphore:
+            prompt = SUMMARY_MAP_PROMPT.format(part=index + 1, parts=len(chunks))
+            return await _request_summary(_summary_payload(chunk, prompt=prompt))
+
+    partials = await asyncio.gather(*(summarize_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+    return "\n\n".join(f"Part {i + 1}: {partial}" for i, partial in enumerate(partials))
+
+def _summary_cache_key(transcript: str) -> str:
+    version = _prompt_version(SUMMARY_SYSTEM_PROMPT, SUMMARY_PROMPT, SUMMARY_MAP_PROMPT, SUMMARY_REDUCE_PROMPT, str(SUMMARY_CHUNK_CHARS))
+    return ResultCache.key("summary", "gpt-4o-mini", version, transcript)
+
+async def _summarize_transcript_uncached(transcript: str) -> str:
+    if len(transcript) <= SUMMARY_CHUNK_CHARS:
+        return await _request_summary(_summary_payload(transcript))
+    
+    partials = await _map_transcript_chunks(_split_transcript(transcript, SUMMARY_CHUNK_CHARS))
+    return await _request_summary(_summary_payload(partials, prompt=SUMMARY_REDUCE_PROMPT))
+
+async def _summarize_transcript_with_openai(transcript: str) -> str:
+    """Summarize transcript using GPT-5 nano (map-reduce over chunks for long transcripts; results cached)"""
+    try:
+        if not OPENAI_API_KEY:
+            raise HTTPException(503, "Server missing OPENAI_API_KEY")
         
-        response.raise_for_status()
-        data = response.json()
-        
-        summary = data['choices'][0]['message']['content'].strip()
-        return summary
+        return await _result_cache.get_or_compute(
+            _summary_cache_key(transcript), lambda: _summarize_transcript_uncached(transcript)
+        )
         
     except httpx.HTTPError as e:
         raise HTTPException(502, f"OpenAI API error: {e}")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Failed to summarize transcript: {str(e)}")
 
+async def _stream_summary_from_openai(transcript: str):
+    """Yield summary text deltas from a streamed chat completion as they arrive (the reduce step, for long transcripts)"""
+    if not OPENAI_API_KEY:
+        raise HTTPException(503, "Server missing OPENAI_API_KEY")
+    try:
+        payload = _summary_payload(transcript, stream=True)
+        if len(transcript) > SUMMARY_CHUNK_CHARS:
+            partials = await _map_transcript_chunks(_split_transcript(transcript, SUMMARY_CHUNK_CHARS))
+            payload = _summary_payload(partials, stream=True, prompt=SUMMARY_REDUCE_PROMPT)
+        # Tokens are relayed as they arrive, so a stream can't be retried or hedged; it still honors the breaker
+        async with _upstream_guard("chat").circuit(), _upstream_call("chat"), _http_client("openai").stream(
+            "POST",
+            "https://api.openai.com/v1/chat/completions",
+            headers=_openai_headers(),
+            json=payload
+        ) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if delta:
+                    yield delta
+    except httpx.HTTPError as e:
+        raise HTTPException(502, f"OpenAI API error: {e}")
+
 def _calculate_duration_minutes(start_time: str, current_time: str) -> float:
     """Calculate duration in minutes between two ISO timestamps"""
     try:
-        from datetime import datetime
         start = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
         end = datetime.fromisoformat(current_time.replace('Z', '+00:00'))
         duration = (end - start).total_seconds() / 60
@@ -357,82 +2607,381 @@ def _save_conversation_summary(
 ) -> bool:
     """Save conversation summary to CSV"""
     try:
-        _ensure_convos_csv_exists()
-        
-        with open(CONVOS_CSV_FILE_PATH, 'a', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=[
-                'start_time', 'duration_minutes', 'phone_number', 'uid', 
-                'summary', 'doctor_name', 'user_name'
-            ])
-            writer.writerow({
-                'start_time': start_time,
-                'duration_minutes': duration_minutes,
-                'phone_number': phone_number,
-                'uid': uid,
-                'summary': summary,
-                'doctor_name': doctor_name,
-                'user_name': user_name
-            })
+        _storage.append_conversation({
+            'start_time': start_time,
+            'duration_minutes': duration_minutes,
+            'phone_number': phone_number,
+            'uid': uid,
+            'summary': summary,
+            'doctor_name': doctor_name,
+            'user_name': user_name
+        })
         
         return True
     except Exception as e:
         print(f"Error saving conversation summary: {e}")
         return False
 
-def _get_profile(pid: str) -> Dict[str, str]:
-    p = PROFILES.get(pid)
-    if not p:
-        raise HTTPException(404, f"Unknown profile '{pid}'. Use one of {list(PROFILES.keys())}.")
-    return p
+SUMMARY_UPDATE_PROMPT = """Below is the running summary of an ongoing patient-doctor conversation, followed by the part of the transcript that came after it. Rewrite the summary so it covers the whole conversation so far, in 1-4 sentences, for healthcare providers. Focus on:
+- Patient's main symptoms or concerns
+- Doctor's recommendations or diagnosis
+- Any follow-up actions needed
+- Key medical information discussed
+
+Running summary:
+{summary}
+
+New transcript:"""
+
+async def _fold_into_summary(summary: Optional[str], delta: str) -> str:
+    """Summary of the conversation so far, given the previous summary (None at the start) and the new transcript text"""
+    if summary is None:
+        return await _summarize_transcript_with_openai(delta)
+    if not OPENAI_API_KEY:
+        raise HTTPException(503, "Server missing OPENAI_API_KEY")
+    try:
+        if len(delta) > SUMMARY_CHUNK_CHARS:
+            delta = await _map_transcript_chunks(_split_transcript(delta, SUMMARY_CHUNK_CHARS))
+        prompt = SUMMARY_UPDATE_PROMPT.format(summary=summary)
+        version = _prompt_version(SUMMARY_SYSTEM_PROMPT, SUMMARY_UPDATE_PROMPT, SUMMARY_MAP_PROMPT, str(SUMMARY_CHUNK_CHARS))
+        key = ResultCache.key("summary-update", "gpt-4o-mini", version, summary, delta)
+        return await _result_cache.get_or_compute(key, lambda: _request_summary(_summary_payload(delta, prompt=prompt)))
+    except httpx.HTTPError as e:
+        raise HTTPException(502, f"OpenAI API error: {e}")
+
+class VisitSummaries:
+    """
+    Running summaries of visits in progress, keyed by (uid, start_time).
+
+    Each interim call sends the whole transcript so far; only the text past the stored
+    offset is summarized and folded into the running summary, so per-call tokens and
+    latency stay flat as the visit grows. A hash of the already-summarized prefix catches
+    a client that restarted or rewrote its transcript, which starts the visit over.
+
+    Sessions live in this worker's memory: a call that lands on another worker just
+    summarizes from scratch there. Idle sessions expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = max(1, capacity)
+        self._sessions: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.capacity and now - session['touched'] < self.ttl:
+                break
+            del self._sessions[key]
+
+    def has(self, uid: str, start_time: str) -> bool:
+        self._evict()
+        return (uid, start_time) in self._sessions
+
+    async def update(self, uid: str, start_time: str, transcript: str) -> str:
+        """Fold the transcript text not yet seen for this visit into its summary; returns the summary"""
+        key = (uid, start_time)
+        session = self._sessions.pop(key, None)
+        if session is None:
+            session = {'summary': None, 'offset': 0, 'prefix_hash': None, 'lock': asyncio.Lock()}
+        session['touched'] = time.monotonic()
+        self._sessions[key] = session  # most recently used last
+        self._evict()
+        async with session['lock']:
+            offset = session['offset']
+            if offset and (len(transcript) < offset or
+                           hashlib.sha256(transcript[:offset].encode()).hexdigest() != session['prefix_hash']):
+                print(f"Transcript for visit {uid} @ {start_time} no longer extends the summarized text; starting over")
+                session.update(summary=None, offset=0, prefix_hash=None)
+                offset = 0
+            delta = transcript[offset:]
+            if delta.strip():
+                session['summary'] = await _fold_into_summary(session['summary'], delta)
+                session['offset'] = len(transcript)
+                session['prefix_hash'] = hashlib.sha256(transcript.encode()).hexdigest()
+            return session['summary'] or ""
+
+    def close(self, uid: str, start_time: str):
+        self._sessions.pop((uid, start_time), None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+_visit_summaries = VisitSummaries(VISIT_SESSION_TTL_SECONDS, VISIT_SESSION_MAX)
+
+async def _visit_summary(req: TranscriptSummaryRequest) -> Optional[str]:
+    """Incremental summary for interim calls and for closing a visit that has a session; None means summarize in one shot"""
+    if req.final and not _visit_summaries.has(req.uid, req.start_time):
+        return None
+    return await _visit_summaries.update(req.uid, req.start_time, req.transcript)
+
+def _get_profile(pid: str) -> Dict[str, str]:
+    p = PROFILES.get(pid)
+    if not p:
+        raise HTTPException(404, f"Unknown profile '{pid}'. Use one of {list(PROFILES.keys())}.")
+    return p
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset("""
+a about an and are as at be been but by can do for from had has have he her his how i if in into is it its
+me my no not of on or our she so that the their them then there they this to too was we were what when which
+who will with you your
+""".split())
+
+def _tokenize(text: str) -> List[str]:
+    """Lowercased word tokens without stopwords, with plurals folded ('headaches' -> 'headache')"""
+    return [
+        w[:-1] if len(w) > 3 and w.endswith('s') and not w.endswith('ss') else w
+        for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS
+    ]
+
+class MedicalKnowledgeIndex:
+    """
+    medical_data.txt split into its topic sections (Back Pain, Headaches, ...) and
+    ranked with BM25, so cleanup prompts only carry the sections relevant to what
+    the patient said.
+
+    The file is parsed once and cached; its mtime and size are checked on each use so
+    edits are picked up without a restart.
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._signature = None
+        self.text: Optional[str] = None
+        self.sections: List[Dict[str, str]] = []
+        self._postings: Dict[str, List[tuple]] = {}  # term -> [(section index, term frequency)]
+        self._idf: Dict[str, float] = {}
+        self._lengths: List[int] = []
+        self._avg_length = 0.0
+
+    def refresh(self):
+        """Re-parse the knowledge file if it changed since the last load"""
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            signature = None
+        if signature == self._signature and (self.text is not None or signature is None):
+            return
+        with self._lock:
+            if signature == self._signature and (self.text is not None or signature is None):
+                return
+            text = None
+            if signature is not None:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    text = file.read()
+            self._build(text)
+            self._signature = signature
+
+    @staticmethod
+    def _split_sections(text: str) -> List[Dict[str, str]]:
+        sections: List[Dict[str, str]] = []
+        category = None
+        current = None
+        for raw in text.splitlines():
+            line = raw.strip()
+            if not line:
+                current = None
+                continue
+            is_heading = line.endswith(':') and not line.startswith('-')
+            if is_heading and line.upper() == line:
+                category, current = line[:-1].title(), None  # e.g. "COMMON SYMPTOMS AND CONDITIONS:"
+            elif is_heading:
+                current = {'title': line[:-1], 'category': category or '', 'lines': [line]}
+                sections.append(current)
+            elif line.upper() == line and not line.startswith('-'):
+                continue  # document title
+            else:
+                if current is None:
+                    # Bullets straight under a category belong to it; loose prose (preamble, disclaimer) is general
+                    bullet = line.startswith('-')
+                    current = {'title': (category if bullet else None) or 'General', 'category': (category if bullet else None) or '', 'lines': []}
+                    sections.append(current)
+                current['lines'].append(line)
+        return [
+            {'title': sec['title'], 'category': sec['category'], 'text': '\n'.join(sec['lines'])}
+            for sec in sections
+        ]
+
+    def _build(self, text: Optional[str]):
+        sections = self._split_sections(text) if text else []
+        postings: Dict[str, List[tuple]] = defaultdict(list)
+        lengths = []
+        for i, sec in enumerate(sections):
+            terms = Counter(_tokenize(f"{sec['category']} {sec['text']}"))
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings[term].append((i, tf))
+        n = len(sections)
+        self._idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in postings.items()}
+        self._postings = dict(postings)
+        self._lengths = lengths
+        self._avg_length = (sum(lengths) / n) if n else 0.0
+        self.sections = sections
+        self.text = text
+
+    def search(self, query: str, k: int) -> List[Dict[str, str]]:
+        """Top-k sections for `query` by BM25 score; sections sharing no terms are never returned"""
+        self.refresh()
+        scores: Dict[int, float] = defaultdict(float)
+        for term, qtf in Counter(_tokenize(query)).items():
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / self._avg_length)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:max(0, k)]
+        return [self.sections[i] for i, _ in ranked]
+
+_medical_index = MedicalKnowledgeIndex(MEDICAL_DATA_FILE_PATH)
 
 def _load_medical_data() -> str:
-    """Load medical knowledge base from file"""
+    """Load medical knowledge base from file (cached, reloaded when the file changes)"""
     try:
-        if os.path.exists(MEDICAL_DATA_FILE_PATH):
-            with open(MEDICAL_DATA_FILE_PATH, 'r', encoding='utf-8') as file:
-                return file.read()
+        _medical_index.refresh()
+        if _medical_index.text is not None:
+            return _medical_index.text
         else:
             return "Medical knowledge base not available."
     except Exception as e:
         print(f"Error loading medical data: {e}")
         return "Medical knowledge base not available."
 
-async def _transcribe_audio_with_whisper(audio_data: bytes) -> str:
-    """Transcribe audio using OpenAI Whisper"""
+def _medical_context_for(text: str, k: int = None) -> str:
+    """The knowledge base sections most relevant to `text`, formatted for the cleanup prompt"""
     try:
-        if not OPENAI_API_KEY:
-            raise HTTPException(503, "Server missing OPENAI_API_KEY")
-        
-        # Create a temporary file for the audio data
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_file:
-            temp_file.write(audio_data)
-            temp_file_path = temp_file.name
-        
-        try:
-            # Use OpenAI Whisper API to transcribe
-            with open(temp_file_path, "rb") as audio_file:
-                transcript = openai.Audio.transcribe(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="text"
-                )
-            
-            return transcript.strip()
-        finally:
-            # Clean up temporary file
-            os.unlink(temp_file_path)
-            
+        _medical_index.refresh()
+        if _medical_index.text is None:
+            return "Medical knowledge base not available."
+        sections = _medical_index.search(text, MEDICAL_CONTEXT_TOP_K if k is None else k)
     except Exception as e:
-        print(f"Error transcribing audio: {e}")
-        raise HTTPException(500, f"Failed to transcribe audio: {str(e)}")
+        print(f"Error loading medical data: {e}")
+        return "Medical knowledge base not available."
+    if not sections:
+        return "No closely matching entries in the medical knowledge base."
+    return "\n\n".join(sec['text'] for sec in sections)
 
-async def _process_text_with_openai(text: str, medical_context: str) -> str:
-    """Process and clean up transcribed text using GPT-4o-mini with medical context"""
-    try:
-        if not OPENAI_API_KEY:
-            raise HTTPException(503, "Server missing OPENAI_API_KEY")
-        
-        prompt = f"""Please process and clean up this transcribed audio text from a patient-doctor conversation. 
+_numpy = None
+
+def _load_numpy():
+    """NumPy, imported on first use; None (with a one-time warning) when it isn't installed"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            print("Warning: AUDIO_PREPROCESS=1 but numpy is not installed; sending audio to Whisper as-is")
+            _numpy = False
+    return _numpy or None
+
+def _decode_pcm(data: bytes, raw_pcm: bool):
+    """(float32 samples shaped (frames, channels) in [-1, 1], sample rate), or None if not WAV/PCM"""
+    np = _numpy
+    if raw_pcm:
+        width, rate, channels, frames = 2, AUDIO_PCM_SAMPLE_RATE, AUDIO_PCM_CHANNELS, data
+    elif data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        try:
+            with wave.open(io.BytesIO(data)) as wav:
+                width, rate, channels = wav.getsampwidth(), wav.getframerate(), wav.getnchannels()
+                frames = wav.readframes(wav.getnframes())
+        except (wave.Error, EOFError):
+            return None  # not plain integer PCM (e.g. float or compressed WAV)
+    else:
+        return None
+    if rate <= 0 or channels <= 0:
+        return None  # a header (or AUDIO_PCM_* setting) we can't make sense of
+    usable = len(frames) - len(frames) % (width * channels)
+    raw = np.frombuffer(frames[:usable], dtype=np.uint8)
+    if width == 1:
+        samples = (raw.astype(np.float32) - 128) / 128
+    elif width == 3:
+        triples = raw.reshape(-1, 3).astype(np.int32)
+        ints = triples[:, 0] | (triples[:, 1] << 8) | (triples[:, 2] << 16)
+        samples = np.where(ints >= 1 << 23, ints - (1 << 24), ints).astype(np.float32) / (1 << 23)
+    elif width in (2, 4):
+        samples = raw.view(f"<i{width}").astype(np.float32) / (1 << (8 * width - 1))
+    else:
+        return None
+    return samples.reshape(-1, channels), rate
+
+def _voiced_span(mono, rate: int) -> Optional[tuple]:
+    """[start, end) sample range between the first and last frame above the VAD threshold (plus padding)"""
+    np = _numpy
+    frame = max(1, rate * AUDIO_VAD_FRAME_MS // 1000)
+    count = -(-len(mono) // frame)
+    padded = np.zeros(count * frame, dtype=np.float32)
+    padded[:len(mono)] = mono
+    rms = np.sqrt(np.mean(padded.reshape(count, frame) ** 2, axis=1))
+    voiced = np.flatnonzero(20 * np.log10(rms + 1e-10) > AUDIO_VAD_THRESHOLD_DBFS)
+    if voiced.size == 0:
+        return None
+    pad = rate * AUDIO_VAD_PADDING_MS // 1000
+    return max(0, voiced[0] * frame - pad), min(len(mono), (voiced[-1] + 1) * frame + pad)
+
+def _resample(mono, rate: int, target: int):
+    """Downsample `mono` from `rate` to `target`; clips already at or below `target` are returned as they are"""
+    np = _numpy
+    if rate <= target or len(mono) == 0:
+        return mono
+    width = int(round(rate / target))
+    if width > 1:  # box low-pass so the downsampled clip doesn't alias
+        mono = np.convolve(mono, np.ones(width, dtype=np.float32) / width, mode="same")
+    length = max(1, int(round(len(mono) * target / rate)))
+    return np.interp(np.arange(length) * (rate / target), np.arange(len(mono)), mono).astype(np.float32)
+
+def _preprocess_audio(data: bytes, raw_pcm: bool = False) -> Optional[tuple]:
+    """
+    Decode WAV/PCM, downmix to mono, trim leading and trailing silence with an energy VAD
+    and downsample to AUDIO_TARGET_SAMPLE_RATE (lower rates are kept) as 16-bit WAV.
+    Returns (wav bytes, or None when the whole clip is silence, stats), or None when the
+    clip can't be decoded here (webm/opus, mp3, ...), in which case it goes to Whisper
+    unchanged. A WAV is never made bigger: if the result would be, the original is sent.
+    """
+    np = _load_numpy()
+    if np is None:
+        return None
+    decoded = _decode_pcm(data, raw_pcm)
+    if decoded is None:
+        return None
+    samples, rate = decoded
+    seconds_in = len(samples) / rate
+    mono = samples.mean(axis=1)
+    span = _voiced_span(mono, rate)
+    if span is None:
+        out, seconds_out = None, 0.0
+    else:
+        out_rate = min(rate, AUDIO_TARGET_SAMPLE_RATE)
+        clip = _resample(mono[span[0]:span[1]], rate, out_rate)
+        pcm = (np.clip(clip, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(out_rate)
+            wav.writeframes(pcm)
+        out, seconds_out = buffer.getvalue(), len(clip) / out_rate
+        if not raw_pcm and len(out) >= len(data):
+            out, seconds_out = data, seconds_in  # e.g. 8-bit or already-tight audio: the original is smaller
+    bytes_out = len(out) if out is not None else 0
+    stats = AudioPreprocessStats(
+        bytes_in=len(data), bytes_out=bytes_out, bytes_saved=len(data) - bytes_out,
+        seconds_in=round(seconds_in, 3), seconds_out=round(seconds_out, 3),
+        seconds_saved=round(seconds_in - seconds_out, 3), silent=out is None,
+    )
+    return out, stats
+
+WHISPER_PROMPT_VERSION = "1"  # bump if transcription request parameters change
+
+CLEANUP_SYSTEM_PROMPT = "You are a medical transcription assistant. Clean up and correct transcribed audio while maintaining accuracy and medical context."
+
+CLEANUP_PROMPT = """Please process and clean up this transcribed audio text from a patient-doctor conversation. 
 
 MEDICAL CONTEXT:
 {medical_context}
@@ -449,36 +2998,176 @@ Please:
 
 Return only the cleaned text without any additional commentary."""
 
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
+def _whisper_confidence(transcription) -> Optional[float]:
+    """Mean token probability of a verbose_json transcription, weighting segments by duration (None without segments)"""
+    segments = getattr(transcription, "segments", None) or []
+    weights = [max(segment.end - segment.start, 0.0) for segment in segments]
+    if not segments:
+        return None
+    if not sum(weights):
+        weights = [1.0] * len(segments)
+    mean_logprob = sum(segment.avg_logprob * w for segment, w in zip(segments, weights)) / sum(weights)
+    return round(math.exp(mean_logprob), 4)
+
+async def _transcribe_audio_with_whisper(audio_data: Union[bytes, io.BytesIO], filename: str = "audio.webm",
+                                         detailed: bool = False) -> Union[str, Dict[str, Any]]:
+    """
+    Transcribe audio using OpenAI Whisper, straight from memory (Whisper infers the format from `filename`; results cached).
+    With `detailed`, returns {"text", "confidence"} from a verbose_json transcription instead of the bare text.
+    """
+    try:
+        if not OPENAI_API_KEY:
+            raise HTTPException(503, "Server missing OPENAI_API_KEY")
         
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a medical transcription assistant. Clean up and correct transcribed audio while maintaining accuracy and medical context."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=500,
-            temperature=0.1
-        )
+        response_format = "verbose_json" if detailed else "text"
+        audio_view = audio_data.getbuffer() if isinstance(audio_data, io.BytesIO) else audio_data
+        try:
+            key = ResultCache.key("whisper", "whisper-1", WHISPER_PROMPT_VERSION, response_format,
+                                  os.path.splitext(filename)[1], audio_view)
+        finally:
+            if isinstance(audio_view, memoryview):
+                audio_view.release()
+        
+        async def transcribe_once() -> str:
+            async with _upstream_call("whisper"):
+                return await _openai_async_client().audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(filename, audio_data),  # httpx rewinds a BytesIO before each upload
+                    response_format=response_format
+                )
+        
+        async def transcribe() -> Union[str, Dict[str, Any]]:
+            async with _stage_slot("whisper"):
+                transcript = await _upstream_guard("whisper").call(transcribe_once, hedge=False)
+            if detailed:
+                return {"text": transcript.text.strip(), "confidence": _whisper_confidence(transcript)}
+            return transcript.strip()
+        
+        return await _result_cache.get_or_compute(key, transcribe)
+            
+    except UpstreamUnavailable:
+        raise
+    except Exception as e:
+        print(f"Error transcribing audio: {e}")
+        raise HTTPException(500, f"Failed to transcribe audio: {str(e)}")
+
+async def _process_text_with_openai(text: str, medical_context: str) -> str:
+    """Process and clean up transcribed text using GPT-4o-mini with medical context (results cached)"""
+    try:
+        if not OPENAI_API_KEY:
+            raise HTTPException(503, "Server missing OPENAI_API_KEY")
+        
+        prompt = CLEANUP_PROMPT.format(medical_context=medical_context, text=text)
+        key = ResultCache.key("cleanup", "gpt-4o-mini", _prompt_version(CLEANUP_SYSTEM_PROMPT, CLEANUP_PROMPT), medical_context, text)
+
+        async def clean_up_once():
+            async with _upstream_call("chat"):
+                return await _openai_async_client().chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": CLEANUP_SYSTEM_PROMPT
+                        },
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    max_tokens=500,
+                    temperature=0.1
+                )
+        
+        async def clean_up() -> str:
+            async with _stage_slot("cleanup"):
+                response = await _upstream_guard("chat").call(clean_up_once)
+            return response.choices[0].message.content.strip()
         
-        processed_text = response.choices[0].message.content.strip()
-        return processed_text
+        return await _result_cache.get_or_compute(key, clean_up)
         
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         print(f"Error processing text with OpenAI: {e}")
         raise HTTPException(500, f"Failed to process text: {str(e)}")
 
-def _build_knowledge(user_name: str, agent_name: str, cfg=None) -> str:
+async def _clean_up_transcript(text: str) -> str:
+    """The cleanup pass of the audio pipeline: pick the relevant medical context, then clean up with GPT-4o-mini"""
+    with _stage_timer("medical_context"):
+        medical_context = _medical_context_for(text)
+    with _stage_timer("cleanup"):
+        return await _process_text_with_openai(text, medical_context)
+
+def _needs_cleanup(text: str, confidence: Optional[float]) -> bool:
+    """Adaptive policy: short utterances and ones Whisper was confident about are used as transcribed"""
+    if AUDIO_CLEANUP_POLICY == "always":
+        return bool(text)
+    if len(text.split()) <= AUDIO_CLEANUP_MIN_WORDS:
+        return False
+    return confidence is None or confidence < AUDIO_CLEANUP_SKIP_CONFIDENCE
+
+class CleanupJobs:
     """
-    Build a simple system prompt using just agent_name and user_name.
+    Cleanup passes deferred by fast-mode /api/process-audio, addressed by an opaque id.
+
+    Each job runs as a background task on this worker; its result is kept for `ttl`
+    seconds (at most `capacity` jobs, oldest dropped first) for clients to poll, or
+    long-poll by passing `wait`. Like visit summaries, jobs are per worker.
     """
-    return dedent(f"""
+
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = max(1, capacity)
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._jobs:
+            job_id, job = next(iter(self._jobs.items()))
+            if len(self._jobs) <= self.capacity and now - job['created'] < self.ttl:
+                break
+            del self._jobs[job_id]
+
+    def start(self, text: str) -> str:
+        job_id = secrets.token_urlsafe(12)
+        job = {'status': 'pending', 'processed_text': None, 'error': None, 'done': asyncio.Event(), 'created': time.monotonic()}
+        self._jobs[job_id] = job
+        self._evict()
+        _spawn(self._run(job, text))
+        return job_id
+
+    async def _run(self, job: Dict[str, Any], text: str):
+        try:
+            job['processed_text'] = await _clean_up_transcript(text)
+            job['status'] = 'done'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = e.detail if isinstance(e, HTTPException) else str(e)
+            print(f"Deferred cleanup failed: {job['error']}")
+        finally:
+            job['done'].set()
+
+    async def get(self, job_id: str, wait: float = 0) -> Optional[AudioCleanupResponse]:
+        """The job's current state, after waiting up to `wait` seconds for it to finish; None if unknown or expired"""
+        self._evict()
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if wait > 0 and job['status'] == 'pending':
+            try:
+                await asyncio.wait_for(job['done'].wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        return AudioCleanupResponse(cleanup_id=job_id, status=job['status'],
+                                    processed_text=job['processed_text'], error=job['error'])
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+_cleanup_jobs = CleanupJobs(AUDIO_CLEANUP_TTL_SECONDS, AUDIO_CLEANUP_MAX_JOBS)
+
+# Session system prompt; {agent_name} is filled in once per profile, {user_name} per session
+_KNOWLEDGE_TEMPLATE = dedent("""
  ROLE & PERSONA:
 You are Dr. {agent_name}, a compassionate and experienced family physician specializing in telehealth consultations for seniors. You provide care while maintaining clinical accuracy and building trust through genuine human connection.​
 
@@ -543,23 +3232,203 @@ End warmly: "Take care of yourself, and don't hesitate to reach out if you have
 
     """).strip()
 
+class KnowledgeTemplateRegistry:
+    """
+    Session knowledge bases, compiled ahead of time.
+
+    The base template is compiled once per agent (profiles are compiled at startup) into
+    the literal chunks around `{user_name}`, so rendering a session is a single join.
+    Clinic-supplied knowledge bases are compiled the same way and cached by content hash,
+    so sessions sharing the same custom knowledge reuse one compiled copy.
+    """
+
+    PLACEHOLDER = "{user_name}"
+
+    def __init__(self, template: str, max_chars: int, cache_size: int = 256):
+        self.template = template
+        self.max_chars = max_chars
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._base: Dict[str, tuple] = {}
+        self._custom: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def compile_agent(self, agent_name: str) -> tuple:
+        compiled = self._base.get(agent_name)
+        if compiled is None:
+            compiled = tuple(self.template.replace("{agent_name}", agent_name).split(self.PLACEHOLDER))
+            self._base[agent_name] = compiled
+        return compiled
+
+    def _compile_custom(self, knowledge_base: str, agent_name: str) -> tuple:
+        key = hashlib.sha256(f"{agent_name}\0{knowledge_base}".encode("utf-8")).hexdigest()
+        with self._lock:
+            compiled = self._custom.get(key)
+            if compiled is not None:
+                self._custom.move_to_end(key)
+                return compiled
+        # Plain replace rather than str.format: clinic text may contain stray braces
+        compiled = tuple(knowledge_base.strip().replace("{agent_name}", agent_name).split(self.PLACEHOLDER))
+        with self._lock:
+            self._custom[key] = compiled
+            while len(self._custom) > self.cache_size:
+                self._custom.popitem(last=False)
+        return compiled
+
+    def render(self, user_name: str, agent_name: str, cfg: Optional[KnowledgeConfig] = None) -> str:
+        name = user_name if cfg is None or cfg.inject_user_name else "there"
+        base = self.compile_agent(agent_name)
+        if cfg is None or not (cfg.knowledge_base or "").strip():
+            return name.join(base)
+        if len(cfg.knowledge_base) > self.max_chars:
+            raise HTTPException(413, f"knowledge_base exceeds {self.max_chars} characters")
+        custom = name.join(self._compile_custom(cfg.knowledge_base, agent_name))
+        if cfg.merge_strategy == "replace":
+            return custom
+        merged = f"{name.join(base)}\n\n{custom}"
+        if len(merged) > self.max_chars:
+            raise HTTPException(413, f"Merged knowledge base exceeds {self.max_chars} characters; use merge_strategy='replace' or shorten it")
+        return merged
+
+_knowledge_templates = KnowledgeTemplateRegistry(_KNOWLEDGE_TEMPLATE, KNOWLEDGE_MAX_CHARS)
+for _profile in PROFILES.values():
+    _knowledge_templates.compile_agent(_profile["agent_name"])
+
+def _build_knowledge(user_name: str, agent_name: str, cfg: Optional[KnowledgeConfig] = None) -> str:
+    """
+    Build the session system prompt for agent_name and user_name, merging in any
+    clinic-supplied knowledge base from `cfg` (append or replace).
+    """
+    return _knowledge_templates.render(user_name, agent_name, cfg)
+
 async def _mint_token() -> str:
     if not HEYGEN_API_KEY:
         raise HTTPException(503, "Server missing HEYGEN_API_KEY")
     url = f"{HEYGEN_API_BASE}/streaming.create_token"
     headers = {"x-api-key": HEYGEN_API_KEY}
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.post(url, headers=headers)
+
+    async def mint() -> httpx.Response:
+        async with _upstream_call("heygen_token"):
+            r = await _http_client("heygen").post(url, headers=headers)
+            r.raise_for_status()
+        return r
+
     try:
-        r.raise_for_status()
-    except httpx.HTTPError as e:
-        raise HTTPException(502, f"HeyGen token HTTP error: {e}; body={r.text}")
+        r = await _upstream_guard("heygen_token").call(mint)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(502, f"HeyGen token HTTP error: {e}; body={e.response.text}")
     data = r.json()
     token = data.get("access_token") or data.get("token") or (data.get("data") or {}).get("token") or (data.get("data") or {}).get("access_token")
     if not token:
         raise HTTPException(502, f"HeyGen token response missing token field: {data}")
     return token
 
+class TokenPool:
+    """
+    Background-refilled pool of pre-minted HeyGen streaming tokens.
+
+    `acquire()` pops a token without a network round trip and wakes the refill task;
+    only when the pool is empty does it mint on demand. Tokens are dropped once they
+    get within `expiry_margin` seconds of `ttl`, so a popped token is always usable.
+    """
+
+    def __init__(self, mint, target_size: int, ttl: float, expiry_margin: float):
+        self._mint = mint
+        self.target_size = max(0, target_size)
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self._tokens: deque = deque()  # (token, usable_until), oldest first
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.minted = 0
+        self.mint_failures = 0
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._tokens and self._tokens[0][1] <= now:
+            self._tokens.popleft()
+            self.expired += 1
+
+    def take(self) -> Optional[str]:
+        """Pop a ready token, or None if the pool is empty"""
+        self._prune()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if not self._tokens:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._tokens.popleft()[0]
+
+    async def acquire(self) -> str:
+        token = self.take()
+        if token is None:
+            token = await self._mint()
+        return token
+
+    async def _refill(self):
+        backoff = 1.0
+        while True:
+            self._prune()
+            if len(self._tokens) < self.target_size:
+                try:
+                    token = await self._mint()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.mint_failures += 1
+                    print(f"Token pool refill failed, retrying in {backoff:.0f}s: {e}")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                backoff = 1.0
+                self.minted += 1
+                self._tokens.append((token, time.monotonic() + self.ttl - self.expiry_margin))
+                continue
+            # Full: sleep until a token is taken or the oldest one goes stale
+            timeout = self._tokens[0][1] - time.monotonic() if self._tokens else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.target_size <= 0 or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._wakeup = None
+        self._tokens.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        lookups = self.hits + self.misses
+        return {
+            "target_size": self.target_size,
+            "size": len(self._tokens),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "expired": self.expired,
+            "minted": self.minted,
+            "mint_failures": self.mint_failures,
+            "refilling": self._task is not None,
+        }
+
+_token_pool = TokenPool(_mint_token, HEYGEN_TOKEN_POOL_SIZE, HEYGEN_TOKEN_TTL_SECONDS, HEYGEN_TOKEN_EXPIRY_MARGIN)
+
 def _session_payload(profile: Dict[str, str], req: StartRequest, knowledge: str) -> SessionPayload:
     return SessionPayload(
         avatarName=profile["avatar_id"],
@@ -584,15 +3453,102 @@ def _greeting(req: StartRequest) -> Optional[str]:
 async def health():
     return {"ok": True, "has_api_key": bool(HEYGEN_API_KEY), "profiles": list(PROFILES.keys())}
 
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Request, pipeline-stage, upstream and storage latency histograms plus in-flight gauges,
+    in the Prometheus text exposition format (per worker process).
+    """
+    return PlainTextResponse(_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+_PROFILE_ID_RE = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Download a saved request profile by the ID returned in X-Profile-Id (admin token required).
+    """
+    if not _is_admin(x_admin_token):
+        raise HTTPException(403, "Admin token missing or invalid")
+    if _PROFILE_ID_RE.match(profile_id):
+        for ext in (".prof", ".folded"):
+            path = os.path.join(PROFILE_DIR, profile_id + ext)
+            if os.path.exists(path):
+                return FileResponse(path, filename=profile_id + ext, media_type="application/octet-stream")
+    raise HTTPException(404, f"No profile '{profile_id}'")
+
+_readiness: Dict[str, Any] = {"ready": False, "draining": False, "checks": {}, "lock": None}
+
+async def _timed_check(name: str, check) -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        result = {"ok": True, "detail": await check()}
+    except Exception as e:
+        print(f"Readiness check {name} failed: {e}")
+        result = {"ok": False, "detail": str(e)}
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+async def _warm_patients():
+    return {"backend": _storage.name, "patients": await _run_in_threadpool(_storage.warm)}
+
+async def _warm_medical():
+    await _run_in_threadpool(_medical_index.refresh)
+    if _medical_index.text is None:
+        raise RuntimeError(f"{MEDICAL_DATA_FILE_PATH} not found")
+    return {"sections": len(_medical_index.sections)}
+
+async def _warm_upstreams():
+    """Import the SDKs off the event loop and open a keep-alive connection to each upstream"""
+    await run_in_threadpool(importlib.import_module, "openai")
+    await run_in_threadpool(importlib.import_module, "twilio.rest")
+    _openai_async_client()
+    probes = {"heygen": HEYGEN_API_BASE, "openai": "https://api.openai.com/v1/models"}
+    results = await asyncio.gather(*(_http_client(name).head(url) for name, url in probes.items()), return_exceptions=True)
+    failed = {name: str(r) for name, r in zip(probes, results) if isinstance(r, Exception)}
+    if failed:
+        raise RuntimeError(f"could not reach {failed}")
+    return {name: "connected" for name in probes}
+
+_READINESS_CHECKS = {"patients": _warm_patients, "medical": _warm_medical, "upstreams": _warm_upstreams}
+
+@app.get("/api/ready")
+async def ready():
+    """
+    Readiness probe: on first call, loads what READY_PREWARM lists (patient index, medical
+    knowledge index, upstream SDKs + connections) and reports each step. 200 once the
+    patient store loaded; failed medical/upstream warmups are reported but don't block
+    traffic. 503 while warming fails or once shutdown has begun. Use /api/health for liveness.
+    """
+    if not _readiness["draining"] and not _readiness["ready"]:
+        if _readiness["lock"] is None:
+            _readiness["lock"] = asyncio.Lock()
+        async with _readiness["lock"]:
+            if not _readiness["ready"]:
+                names = [name for name in READY_PREWARM if name in _READINESS_CHECKS]
+                results = await asyncio.gather(*(_timed_check(name, _READINESS_CHECKS[name]) for name in names))
+                _readiness["checks"] = dict(zip(names, results))
+                _readiness["ready"] = _readiness["checks"].get("patients", {"ok": True})["ok"]
+    ok = _readiness["ready"] and not _readiness["draining"]
+    return JSONResponse(
+        status_code=200 if ok else 503,
+        content={"ready": ok, "draining": _readiness["draining"], "checks": _readiness["checks"]},
+    )
+
 @app.get("/api/profiles", response_model=List[ProfileOut])
 async def profiles():
     return [ProfileOut(id=k, agent_name=v["agent_name"], avatar_id=v["avatar_id"]) for k, v in PROFILES.items()]
 
+@app.get("/api/token-pool")
+async def token_pool_stats():
+    """Pre-minted HeyGen token pool size and hit/miss counters, for sizing HEYGEN_TOKEN_POOL_SIZE."""
+    return _token_pool.stats()
+
 @app.post("/api/session", response_model=SessionResponse)
 async def session(req: StartRequest):
     profile = _get_profile(req.profile_id)
     knowledge = _build_knowledge(req.user_name, profile["agent_name"], req.knowledge)
-    token = await _mint_token()
+    token = await _token_pool.acquire()
     session = _session_payload(profile, req, knowledge)
     greeting = _greeting(req)
     return SessionResponse(
@@ -613,27 +3569,89 @@ async def new_patient(req: NewPatientRequest):
     
     If a patient with the same phone number exists, their data will be updated.
     A random 6-character UID will be generated for each patient.
-    An SMS with the meeting link will be sent to the patient's phone number.
+    An SMS with the meeting link is queued for the patient's phone number and sent in the
+    background; poll /api/sms-status/{uid} for delivery status.
     """
     try:
-        result = _add_or_update_patient(req.name, req.phone_number, req.agent_name)
+        # Storage waits on file locks and fsync; keep it off the event loop so concurrent
+        # registrations can be group-committed
+        result = await _run_in_threadpool(_add_or_update_patient, req.name, req.phone_number, req.agent_name)
         
-        # Send SMS notification with meeting link (use original full doctor name for SMS)
-        sms_sent = await _send_sms(req.phone_number, req.name, req.agent_name, result.uid)
-        if not sms_sent:
-            # Log warning but don't fail the request
-            print(f"Warning: SMS could not be sent to {req.phone_number}")
+        # Queue SMS notification with meeting link (use original full doctor name for SMS)
+        _sms_dispatcher.enqueue(req.phone_number, req.name, req.agent_name, result.uid)
         
         return result
     except Exception as e:
         raise HTTPException(500, f"Failed to process patient data: {str(e)}")
 
+@app.post("/api/patients/import", response_model=PatientImportResponse)
+async def import_patients(
+    file: UploadFile = File(..., description="Patient roster as CSV (name,phone_number,agent_name header) or NDJSON"),
+    format: Optional[Literal["csv", "ndjson"]] = Query(None, description="Defaults from the file extension / content type, else csv"),
+    send_invites: bool = Query(True, description="Queue the meeting-link SMS for every saved patient"),
+):
+    """
+    Add or update many patients from one upload, e.g. when onboarding a clinic.
+    
+    Each row follows the /api/new-patient rules and upserts by phone number. The file is
+    parsed row by row from the upload's spool file, all saved rows are written in one
+    storage transaction, and invites are queued in batches of PATIENT_IMPORT_INVITE_BATCH.
+    Returns a per-row report: created, updated, duplicate (phone number repeated within the
+    file; the first row wins) or invalid.
+    """
+    try:
+        if file.size is not None and file.size > MAX_PATIENT_IMPORT_BYTES:
+            raise HTTPException(413, f"Import file exceeds {MAX_PATIENT_IMPORT_BYTES} bytes")
+        if format is None:
+            ext = os.path.splitext(file.filename or "")[1].lower()
+            content_type = (file.content_type or "").lower()
+            format = "ndjson" if ext in ('.ndjson', '.jsonl') or 'ndjson' in content_type else "csv"
+        
+        # Parsing and the storage transaction block on file I/O; keep them off the event loop
+        report, invites = await _run_in_threadpool(_import_patients, file.file, format)
+        
+        if send_invites:
+            for start in range(0, len(invites), PATIENT_IMPORT_INVITE_BATCH):
+                batch = invites[start:start + PATIENT_IMPORT_INVITE_BATCH]
+                statuses = _sms_dispatcher.enqueue_many([invite for _, invite in batch])
+                for (row, _), status in zip(batch, statuses):
+                    row.sms = status
+                await asyncio.sleep(0)  # let other requests in between batches
+        
+        counts = Counter(row.status for row in report)
+        return PatientImportResponse(
+            created=counts["created"],
+            updated=counts["updated"],
+            duplicates=counts["duplicate"],
+            invalid=counts["invalid"],
+            rows=report,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Failed to import patients: {str(e)}")
+    finally:
+        await file.close()
+
+@app.get("/api/sms-status/{uid}")
+async def sms_status(uid: str):
+    """
+    Delivery status of the invite SMS for a patient UID: queued, sending, retrying, sent, failed or skipped.
+    
+    Statuses are kept in the memory of the worker process that queued the invite; with
+    several workers, a request landing on another worker gets 404.
+    """
+    status = _sms_dispatcher.status(uid)
+    if status is None:
+        raise HTTPException(404, f"No SMS recorded for uid '{uid}'")
+    return status
+
 @app.get("/api/patient/{uid}", response_model=PatientLookupResponse)
 async def get_patient(uid: str):
     """
     Look up a patient by UID and return their name and assigned doctor.
     """
-    patient = _find_patient_by_uid(uid)
+    patient = await _run_in_threadpool(_find_patient_by_uid, uid)
     if not patient:
         raise HTTPException(404, f"No patient found for uid '{uid}'")
     return PatientLookupResponse(name=patient.get('name', ''), doctor=patient.get('agent_name', ''))
@@ -651,17 +3669,28 @@ async def summarize_transcript(req: TranscriptSummaryRequest):
     - **doctor_name**: Name of the doctor
     - **user_name**: Name of the patient
     
-    Returns a summary focused on healthcare-relevant information and saves the data to convos.csv.
+    - **final**: false for interim summaries during the visit (default true)
+    
+    Returns a summary focused on healthcare-relevant information. During a visit, send
+    `final: false` with the transcript so far: only the text added since the previous
+    call is summarized and folded into the visit's running summary. The data is saved
+    to convos.csv once, on the final call, which also closes the visit.
     """
     try:
         # Calculate call duration
         duration_minutes = _calculate_duration_minutes(req.start_time, req.current_time)
         
-        # Summarize transcript using GPT-5 nano
-        summary = await _summarize_transcript_with_openai(req.transcript)
+        # Summarize transcript using GPT-5 nano (just the new part, for visits in progress)
+        summary = await _visit_summary(req)
+        if summary is None:
+            summary = await _summarize_transcript_with_openai(req.transcript)
+        if not req.final:
+            return TranscriptSummaryResponse(summary=summary)
+        _visit_summaries.close(req.uid, req.start_time)
         
         # Save to conversations CSV
-        saved = _save_conversation_summary(
+        saved = await _run_in_threadpool(
+            _save_conversation_summary,
             start_time=req.start_time,
             duration_minutes=duration_minutes,
             phone_number=req.phone_number,
@@ -673,42 +3702,474 @@ async def summarize_transcript(req: TranscriptSummaryRequest):
         
         return TranscriptSummaryResponse(summary=summary)
         
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Failed to process transcript summary: {str(e)}")
 
-@app.post("/api/process-audio", response_model=AudioProcessResponse)
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+_background_tasks: set = set()  # strong refs so fire-and-forget tasks aren't garbage collected
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+@app.post("/api/summarize-transcript/stream")
+async def summarize_transcript_stream(req: TranscriptSummaryRequest):
+    """
+    Streaming variant of /api/summarize-transcript, as server-sent events.
+    
+    Emits `token` events (`{"text": ...}`) as the summary is generated, then one `done`
+    event (`{"summary": ..., "saved": ...}`) once the full summary has been saved to
+    convos.csv, or an `error` event (`{"detail": ...}`) if the upstream call fails.
+    The summary is still saved if the client disconnects mid-stream.
+    
+    Interim calls (`final: false`) and the final call of a visit with interim summaries
+    use the visit's running summary, sent as a single `token` event; only final calls save.
+    """
+    if not OPENAI_API_KEY:
+        raise HTTPException(503, "Server missing OPENAI_API_KEY")
+    duration_minutes = _calculate_duration_minutes(req.start_time, req.current_time)
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def relay():
+        # Runs independently of the response so the summary is persisted even if the client goes away
+        parts: List[str] = []
+        cache_key = _summary_cache_key(req.transcript)
+        try:
+            summary = await _visit_summary(req)
+            found = summary is not None
+            if not found:
+                found, summary = await _run_in_threadpool(_result_cache.lookup, cache_key)
+            if found:
+                # A visit's running summary, or a retry of an already-summarized transcript: send it as one token
+                events.put_nowait(_sse_event("token", {"text": summary}))
+            else:
+                async for delta in _stream_summary_from_openai(req.transcript):
+                    parts.append(delta)
+                    events.put_nowait(_sse_event("token", {"text": delta}))
+                summary = "".join(parts).strip()
+                await _run_in_threadpool(_result_cache.put, cache_key, summary)
+            if not req.final:
+                events.put_nowait(_sse_event("done", {"summary": summary, "saved": False}))
+                return
+            _visit_summaries.close(req.uid, req.start_time)
+            saved = await _run_in_threadpool(
+                _save_conversation_summary,
+                start_time=req.start_time,
+                duration_minutes=duration_minutes,
+                phone_number=req.phone_number,
+                uid=req.uid,
+                summary=summary,
+                doctor_name=req.doctor_name,
+                user_name=req.user_name
+            )
+            events.put_nowait(_sse_event("done", {"summary": summary, "saved": saved}))
+        except HTTPException as e:
+            events.put_nowait(_sse_event("error", {"detail": e.detail}))
+        except Exception as e:
+            events.put_nowait(_sse_event("error", {"detail": f"Failed to process transcript summary: {str(e)}"}))
+        finally:
+            events.put_nowait(None)
+
+    _spawn(relay())
+
+    async def event_stream():
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _encode_history_cursor(cursor: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(cursor)).encode()).decode()
+
+def _decode_history_cursor(cursor: str) -> tuple:
+    try:
+        ts, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (float(ts), int(row_id))
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+def _conversation_record(row: Dict[str, str]) -> ConversationRecord:
+    try:
+        duration = float(row.get('duration_minutes') or 0)
+    except ValueError:
+        duration = 0.0
+    return ConversationRecord(
+        start_time=row.get('start_time', ''),
+        duration_minutes=duration,
+        phone_number=row.get('phone_number', ''),
+        uid=row.get('uid', ''),
+        summary=row.get('summary', ''),
+        doctor_name=row.get('doctor_name', ''),
+        user_name=row.get('user_name', ''),
+    )
+
+async def _conversation_history(field: str, value: str, start: Optional[str], end: Optional[str],
+                                limit: int, cursor: Optional[str]) -> ConversationHistoryResponse:
+    bounds = []
+    for name, raw in (("start", start), ("end", end)):
+        ts = _parse_iso_timestamp(raw) if raw is not None else None
+        if raw is not None and ts is None:
+            raise HTTPException(400, f"'{name}' must be an ISO timestamp")
+        bounds.append(ts)
+    position = _decode_history_cursor(cursor) if cursor else None
+    rows, next_position = await _run_in_threadpool(
+        _storage.query_conversations, field, value, bounds[0], bounds[1], limit, position
+    )
+    return ConversationHistoryResponse(
+        conversations=[_conversation_record(row) for row in rows],
+        next_cursor=_encode_history_cursor(next_position) if next_position else None,
+    )
+
+@app.get("/api/conversations/uid/{uid}", response_model=ConversationHistoryResponse)
+async def conversations_by_uid(
+    uid: str,
+    start: Optional[str] = Query(None, description="Only visits starting at or after this ISO time"),
+    end: Optional[str] = Query(None, description="Only visits starting at or before this ISO time"),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+):
+    """
+    Visit summaries for one patient UID, newest first, with optional time range and cursor pagination.
+    """
+    return await _conversation_history('uid', uid, start, end, limit, cursor)
+
+@app.get("/api/conversations/phone/{phone_number}", response_model=ConversationHistoryResponse)
+async def conversations_by_phone(
+    phone_number: str,
+    start: Optional[str] = Query(None, description="Only visits starting at or after this ISO time"),
+    end: Optional[str] = Query(None, description="Only visits starting at or before this ISO time"),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+):
+    """
+    Visit summaries for one phone number (any formatting), newest first, with optional time range and cursor pagination.
+    """
+    return await _conversation_history('phone_number', phone_number, start, end, limit, cursor)
+
+@app.get("/api/conversations/doctor/{doctor_name}", response_model=ConversationHistoryResponse)
+async def conversations_by_doctor(
+    doctor_name: str,
+    start: Optional[str] = Query(None, description="Only visits starting at or after this ISO time"),
+    end: Optional[str] = Query(None, description="Only visits starting at or before this ISO time"),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+):
+    """
+    Visit summaries for one doctor (case-insensitive), newest first, with optional time range and cursor pagination.
+    """
+    return await _conversation_history('doctor_name', doctor_name, start, end, limit, cursor)
+
+async def _run_audio_pipeline(audio: Union[bytes, io.BytesIO], filename: str = "audio.webm",
+                              raw_pcm: bool = False, on_transcript=None, mode: str = "full") -> AudioProcessResponse:
+    """
+    Optional preprocessing, Whisper transcription and GPT-4o-mini cleanup, shared by the
+    JSON, upload and WebSocket endpoints. `on_transcript(text)`, if given, is awaited with
+    the raw transcript before cleanup starts. In "fast" mode the raw transcript is returned
+    right after Whisper, with cleanup either skipped (see `_needs_cleanup`) or left running
+    as a CleanupJobs job.
+    """
+    preprocessing = None
+    if raw_pcm and not AUDIO_PREPROCESS:
+        raise HTTPException(400, "Raw PCM audio needs AUDIO_PREPROCESS=1; send WAV or another format Whisper accepts")
+    if AUDIO_PREPROCESS:
+        data = audio.getvalue() if isinstance(audio, io.BytesIO) else audio
+        with _stage_timer("preprocess"):
+            result = await _run_in_threadpool(_preprocess_audio, data, raw_pcm)
+        if result is not None:
+            audio, preprocessing = result
+            print(f"Audio preprocessing saved {preprocessing.bytes_saved} bytes, {preprocessing.seconds_saved}s")
+            if audio is None:
+                # Nothing but silence: no transcript to get, skip both upstream calls
+                return AudioProcessResponse(transcribed_text="", processed_text="", success=True, preprocessing=preprocessing)
+            filename = "audio.wav"
+        elif raw_pcm:
+            raise HTTPException(400, "Raw PCM audio can't be converted here (numpy missing or bad AUDIO_PCM_* settings); send WAV instead")
+    
+    # Transcribe audio using Whisper
+    fast = mode == "fast"
+    with _stage_timer("whisper"):
+        if fast:
+            transcription = await _transcribe_audio_with_whisper(audio, filename, detailed=True)
+            transcribed_text, confidence = transcription["text"], transcription["confidence"]
+        else:
+            transcribed_text = await _transcribe_audio_with_whisper(audio, filename)
+    if on_transcript is not None:
+        await on_transcript(transcribed_text)
+    
+    if fast:
+        # Answer with the raw transcript now; the cleaned text, if any, follows via the cleanup handle
+        if not _needs_cleanup(transcribed_text, confidence):
+            return AudioProcessResponse(transcribed_text=transcribed_text, processed_text=transcribed_text,
+                                        success=True, preprocessing=preprocessing, cleanup="skipped")
+        return AudioProcessResponse(transcribed_text=transcribed_text, processed_text=transcribed_text,
+                                    success=True, preprocessing=preprocessing, cleanup="pending",
+                                    cleanup_id=_cleanup_jobs.start(transcribed_text))
+    
+    # Pick the relevant medical context and clean up with OpenAI GPT-4o-mini
+    processed_text = await _clean_up_transcript(transcribed_text)
+    
+    return AudioProcessResponse(
+        transcribed_text=transcribed_text,
+        processed_text=processed_text,
+        success=True,
+        preprocessing=preprocessing
+    )
+
+async def _read_upload(file: UploadFile, limit: int) -> io.BytesIO:
+    """Copy an upload into memory chunk by chunk, failing with 413 as soon as it exceeds `limit` bytes"""
+    if file.size is not None and file.size > limit:
+        raise HTTPException(413, f"Audio upload exceeds {limit} bytes")
+    buffer = io.BytesIO()
+    while True:
+        chunk = await file.read(AUDIO_UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        if buffer.tell() + len(chunk) > limit:
+            raise HTTPException(413, f"Audio upload exceeds {limit} bytes")
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+async def _read_request_body(request: Request, limit: int) -> io.BytesIO:
+    """Like _read_upload, for a request whose body is the audio itself"""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(413, f"Audio upload exceeds {limit} bytes")
+    buffer = io.BytesIO()
+    async for chunk in request.stream():
+        if buffer.tell() + len(chunk) > limit:
+            raise HTTPException(413, f"Audio upload exceeds {limit} bytes")
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+def _whisper_filename(upload_name: Optional[str]) -> str:
+    ext = os.path.splitext(upload_name or "")[1].lower()
+    return f"audio{ext}" if ext in WHISPER_AUDIO_EXTENSIONS else "audio.webm"
+
+@app.post("/api/process-audio", response_model=AudioProcessResponse, response_model_exclude_none=True)
 async def process_audio(req: AudioProcessRequest):
     """
     Process audio input using OpenAI Whisper for transcription and GPT-4o-mini for text cleanup.
     
     - **audio_data**: Base64 encoded audio data
     - **patient_context**: Optional additional patient context
+    - **mode**: "full" (default, AUDIO_PIPELINE_MODE) or "fast"
     
-    Returns the transcribed and processed text ready for HeyGen.
+    Returns the transcribed and processed text ready for HeyGen. With AUDIO_PREPROCESS=1,
+    WAV clips are trimmed, downmixed and resampled first (all-silence clips skip Whisper),
+    and `preprocessing` reports the bytes and seconds saved.
+    
+    In fast mode the response comes back as soon as Whisper is done, with `processed_text`
+    equal to the raw transcript. `cleanup` is "skipped" when the utterance is short or
+    Whisper was confident about it; otherwise it is "pending" and the cleaned text can be
+    fetched (or long-polled) from GET /api/process-audio/cleanup/{cleanup_id}.
     """
     try:
         # Decode base64 audio data
         try:
-            audio_bytes = base64.b64decode(req.audio_data)
+            with _stage_timer("base64_decode"):
+                audio_bytes = base64.b64decode(req.audio_data)
         except Exception as e:
             raise HTTPException(400, f"Invalid base64 audio data: {str(e)}")
         
-        # Load medical context
-        medical_context = _load_medical_data()
-        
-        # Transcribe audio using Whisper
-        transcribed_text = await _transcribe_audio_with_whisper(audio_bytes)
-        
-        # Process text with OpenAI GPT-4o-mini
-        processed_text = await _process_text_with_openai(transcribed_text, medical_context)
-        
-        return AudioProcessResponse(
-            transcribed_text=transcribed_text,
-            processed_text=processed_text,
-            success=True
-        )
+        return await _run_audio_pipeline(audio_bytes, mode=req.mode or AUDIO_PIPELINE_MODE)
         
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(500, f"Failed to process audio: {str(e)}")
\ No newline at end of file
+        raise HTTPException(500, f"Failed to process audio: {str(e)}")
+
+@app.post("/api/process-audio/upload", response_model=AudioProcessResponse, response_model_exclude_none=True)
+async def process_audio_upload(
+    file: UploadFile = File(..., description="Raw audio clip (webm, wav, mp3, m4a, ...)"),
+    patient_context: Optional[str] = Form(None, description="Additional patient context"),
+    mode: Optional[Literal["full", "fast"]] = Form(None, description="fast: return the raw transcript now, clean it up in the background"),
+):
+    """
+    Same pipeline as /api/process-audio, but takes the audio as a multipart file upload.
+    
+    - **file**: Raw audio bytes; no base64 encoding. Limited to MAX_AUDIO_UPLOAD_BYTES.
+      `.pcm`/`.raw` files are headerless 16-bit PCM (needs AUDIO_PREPROCESS=1, else 400).
+    - **patient_context**: Optional additional patient context
+    - **mode**: "full" (default, AUDIO_PIPELINE_MODE) or "fast", as for /api/process-audio
+    
+    Skips the base64 decode and its 33% size overhead. Starlette's multipart parser
+    spools the file part (to a temporary file once it passes 1 MiB); it is then copied in
+    chunks, with the size cap checked as it goes, into one in-memory buffer handed to
+    Whisper. Use /api/process-audio/raw to skip the spooling as well. Raw PCM uploads are
+    rejected with 400 unless AUDIO_PREPROCESS can turn them into WAV.
+    """
+    try:
+        with _stage_timer("upload_read"):
+            audio = await _read_upload(file, MAX_AUDIO_UPLOAD_BYTES)
+        raw_pcm = os.path.splitext(file.filename or "")[1].lower() in AUDIO_RAW_PCM_EXTENSIONS
+        return await _run_audio_pipeline(audio, _whisper_filename(file.filename), raw_pcm, mode=mode or AUDIO_PIPELINE_MODE)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Failed to process audio: {str(e)}")
+    finally:
+        await file.close()
+
+@app.post("/api/process-audio/raw", response_model=AudioProcessResponse, response_model_exclude_none=True)
+async def process_audio_raw(
+    request: Request,
+    patient_context: Optional[str] = Query(None, description="Additional patient context"),
+    mode: Optional[Literal["full", "fast"]] = Query(None, description="fast: return the raw transcript now, clean it up in the background"),
+):
+    """
+    Same pipeline as /api/process-audio/upload, but the request body is the audio clip
+    itself, with an audio/* Content-Type (audio/webm, audio/wav, audio/mpeg, ...).
+    
+    - **body**: Raw audio bytes, limited to MAX_AUDIO_UPLOAD_BYTES. `audio/pcm` and
+      `audio/L16` bodies are headerless 16-bit PCM (needs AUDIO_PREPROCESS=1, else 400).
+    - **patient_context**, **mode**: query parameters, as for the multipart upload
+    
+    Nothing is spooled to disk: the body is streamed from the socket straight into the
+    buffer handed to Whisper, with the size cap checked as it arrives. Other content
+    types are rejected with 415.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if not content_type.startswith("audio/"):
+        raise HTTPException(415, "Send the clip as the request body with an audio/* Content-Type")
+    ext = AUDIO_CONTENT_TYPE_EXTENSIONS.get(content_type, ".webm")
+    try:
+        with _stage_timer("upload_read"):
+            audio = await _read_request_body(request, MAX_AUDIO_UPLOAD_BYTES)
+        raw_pcm = ext in AUDIO_RAW_PCM_EXTENSIONS
+        return await _run_audio_pipeline(audio, _whisper_filename(f"audio{ext}"), raw_pcm, mode=mode or AUDIO_PIPELINE_MODE)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Failed to process audio: {str(e)}")
+
+@app.get("/api/process-audio/cleanup/{cleanup_id}", response_model=AudioCleanupResponse, response_model_exclude_none=True)
+async def process_audio_cleanup(cleanup_id: str, wait: float = Query(0, ge=0, description="Seconds to wait for a pending cleanup")):
+    """
+    Result of a cleanup pass deferred by fast-mode /api/process-audio: pending, done (with
+    `processed_text`) or failed (with `error`). With `wait`, holds the request until the
+    cleanup finishes or `wait` seconds (at most AUDIO_CLEANUP_MAX_WAIT) pass.
+    """
+    job = await _cleanup_jobs.get(cleanup_id, min(wait, AUDIO_CLEANUP_MAX_WAIT))
+    if job is None:
+        raise HTTPException(404, f"No cleanup '{cleanup_id}' (unknown or expired)")
+    return job
+
+@app.websocket("/api/transcribe/ws")
+async def transcribe_ws(websocket: WebSocket):
+    """
+    Incremental transcription during a visit.
+    
+    Client -> server:
+    - binary messages: audio bytes, appended to the current segment
+    - {"type": "config", "filename": "audio.wav"}: container of the segments to come (default audio.webm; .pcm = raw 16-bit PCM)
+    - {"type": "segment_end"}: the buffered bytes form one complete clip; transcribe it
+    - {"type": "stop"}: transcribe what's buffered, wait for everything and close
+    
+    Server -> client, per segment `seq` (segments run concurrently, so they may arrive out of order):
+    - {"type": "partial", "seq", "text"}: raw Whisper text, as soon as it is available
+    - {"type": "segment", "seq", "text", "processed_text"}: after GPT-4o-mini cleanup
+    - {"type": "error", "seq", "detail"}
+    and finally {"type": "final", "transcript", "processed_text"} with all segments in order.
+    
+    Each segment must be decodable on its own (e.g. restart MediaRecorder per utterance, or send WAV/PCM).
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    filename, raw_pcm = "audio.webm", False
+    buffer = bytearray()
+    pending: Dict[int, asyncio.Task] = {}
+    results: Dict[int, AudioProcessResponse] = {}
+    next_seq = 0
+
+    async def send(message: Dict[str, Any]):
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def run_segment(seq: int, audio: bytes, name: str, pcm: bool):
+        try:
+            try:
+                result = await _run_audio_pipeline(
+                    audio, name, pcm, on_transcript=lambda text: send({"type": "partial", "seq": seq, "text": text})
+                )
+            except HTTPException as e:
+                await send({"type": "error", "seq": seq, "detail": e.detail})
+                return
+            except Exception as e:
+                # One bad segment must not take the others (or the final message) down with it
+                print(f"WebSocket segment {seq} failed: {e!r}")
+                await send({"type": "error", "seq": seq, "detail": f"Failed to process audio: {str(e)}"})
+                return
+            results[seq] = result
+            await send({"type": "segment", "seq": seq, "text": result.transcribed_text, "processed_text": result.processed_text})
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # client went away mid-segment
+
+    async def flush():
+        nonlocal next_seq
+        if not buffer:
+            return
+        if len(pending) >= WS_MAX_PENDING_SEGMENTS:
+            await asyncio.wait(pending.values(), return_when=asyncio.FIRST_COMPLETED)
+        seq, audio = next_seq, bytes(buffer)
+        next_seq += 1
+        buffer.clear()
+        task = asyncio.create_task(run_segment(seq, audio, filename, raw_pcm))
+        pending[seq] = task
+        task.add_done_callback(lambda _: pending.pop(seq, None))
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                if len(buffer) + len(message["bytes"]) > WS_MAX_SEGMENT_BYTES:
+                    await send({"type": "error", "seq": next_seq, "detail": f"Segment exceeds {WS_MAX_SEGMENT_BYTES} bytes"})
+                    await websocket.close(code=1009)
+                    return
+                buffer.extend(message["bytes"])
+                continue
+            try:
+                control = json.loads(message.get("text") or "")
+            except ValueError:
+                control = {}
+            kind = control.get("type") if isinstance(control, dict) else None
+            if kind == "config":
+                ext = os.path.splitext(str(control.get("filename") or ""))[1].lower()
+                raw_pcm = ext in AUDIO_RAW_PCM_EXTENSIONS
+                filename = _whisper_filename(control.get("filename"))
+            elif kind == "segment_end":
+                await flush()
+            elif kind == "stop":
+                await flush()
+                break
+            else:
+                await send({"type": "error", "seq": None, "detail": "Expected binary audio or a config/segment_end/stop message"})
+
+        if pending:
+            await asyncio.gather(*pending.values(), return_exceptions=True)
+        ordered = [results[seq] for seq in sorted(results)]
+        await send({
+            "type": "final",
+            "transcript": " ".join(r.transcribed_text for r in ordered if r.transcribed_text),
+            "processed_text": " ".join(r.processed_text for r in ordered if r.processed_text),
+        })
+        await websocket.close()
+    except WebSocketDisconnect:
+        for task in pending.values():
+            task.cancel()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark / load test for the API. HeyGen and OpenAI are replaced by local
+respx routes and Twilio by a stand-in transport, each with configurable injected
+latency, so runs are repeatable and never touch the network or backend/data.
+
+Every scenario is driven in-process through the ASGI app (with its lifespan running)
+at a fixed concurrency, once per patient-store size, and reported as p50/p95/p99
+latency and requests/sec. `--tail-fraction` makes that share of HeyGen/OpenAI calls take
+`--tail-latency` instead, to see how the upstream deadlines, retries and hedges shape p99.
+
+    python bench.py [--requests 200] [--concurrency 16] [--patients 100,10000]
+                    [--scenarios session,new-patient,...] [--openai-latency 0.3] [--json out.json]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import respx
+from twilio.rest import Client
+
+import app
+
+WHISPER_URL = "https://api.openai.com/v1/audio/transcriptions"
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+TRANSCRIPT = "\n".join(
+    f"Doctor: How has your {part} been this week?\nPatient: A little sore in the mornings, better after walking."
+    for part in ("back", "knee", "shoulder", "sleep", "appetite")
+)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class TwilioStandIn:
+    """Answers Twilio message creates locally after `latency` seconds"""
+
+    def __init__(self, latency: float):
+        from twilio.http import AsyncHttpClient
+        from twilio.http.response import Response
+
+        stand_in = self
+        self.latency = latency
+        self.sent = 0
+
+        class Transport(AsyncHttpClient):
+            async def request(self, method, uri, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+                await asyncio.sleep(stand_in.latency)
+                stand_in.sent += 1
+                return Response(201, json.dumps({"sid": f"SM{stand_in.sent:032d}", "status": "queued"}))
+
+        self.transport = Transport(logger=None, is_async=True)
+
+
+def mock_upstreams(latency: Dict[str, float], tail_fraction: float = 0.0, tail_latency: float = 5.0) -> respx.MockRouter:
+    """respx routes for HeyGen and OpenAI that answer after the injected latency (or, for `tail_fraction` of calls, `tail_latency`)"""
+
+    def delayed(seconds: float, respond: Callable[[httpx.Request], httpx.Response]):
+        async def side_effect(request):
+            await asyncio.sleep(tail_latency if random.random() < tail_fraction else seconds)
+            return respond(request)
+        return side_effect
+
+    def chat(request):
+        return httpx.Response(200, json={
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Patient reports mild soreness."}}],
+        })
+
+    router = respx.mock(assert_all_called=False)
+    router.post(f"{app.HEYGEN_API_BASE}/streaming.create_token").mock(
+        side_effect=delayed(latency["heygen"], lambda request: httpx.Response(200, json={"data": {"token": "bench-token"}})))
+    router.post(WHISPER_URL).mock(
+        side_effect=delayed(latency["whisper"], lambda request: httpx.Response(200, text="my back is sore in the mornings")))
+    router.post(OPENAI_CHAT_URL).mock(side_effect=delayed(latency["openai"], chat))
+    return router
+
+
+def seed_storage(directory: str, patients: int) -> List[str]:
+    """Point the app at a fresh CSV store under `directory` holding `patients` rows; returns their uids"""
+    rows = [
+        {'uid': f'B{i:05d}', 'name': f'Patient {i}', 'phone_number': f'1555{i:07d}', 'agent_name': 'Dexter'}
+        for i in range(patients)
+    ]
+    snapshot = f"{directory}/db.csv"
+    app._atomic_write_csv(snapshot, app.PATIENT_FIELDS, rows)
+    app._storage = app.CsvStorageBackend(
+        app.PatientStore(snapshot, f"{directory}/db.log.csv"),
+        app.ConversationLog(f"{directory}/convos.csv"),
+    )
+    return [row['uid'] for row in rows]
+
+
+def scenarios(uids: List[str]) -> Dict[str, Callable[[httpx.AsyncClient, int], Any]]:
+    """Request factories keyed by scenario name; `i` makes each request distinct (no cache hits)"""
+    return {
+        "session": lambda client, i: client.post("/api/session", json={"profile_id": "alpha", "user_name": "Ada"}),
+        "new-patient": lambda client, i: client.post("/api/new-patient", json={
+            "name": f"New {i}", "phone_number": f"1666{i:07d}", "agent_name": "Dr. Michael Rodriguez"}),
+        "patient-lookup": lambda client, i: client.get(f"/api/patient/{random.choice(uids) if uids else 'NOPE00'}"),
+        "summarize": lambda client, i: client.post("/api/summarize-transcript", json={
+            "transcript": f"{TRANSCRIPT}\nVisit {i}.", "start_time": "2024-01-15T10:00:00Z",
+            "current_time": "2024-01-15T10:15:00Z", "phone_number": "15550000001", "uid": "B00001",
+            "doctor_name": "Dexter", "user_name": "Patient 1"}),
+        "process-audio": lambda client, i: client.post("/api/process-audio", json={
+            "audio_data": base64.b64encode(f"bench clip {i}".encode()).decode()}),
+    }
+
+
+async def drive(client: httpx.AsyncClient, request: Callable[[httpx.AsyncClient, int], Any],
+                total: int, concurrency: int) -> Dict[str, Any]:
+    """Issue `total` requests with at most `concurrency` in flight; returns latency stats"""
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            r = await request(client, i)
+            latencies.append(time.perf_counter() - started)
+            if r.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "rps": round(total / elapsed, 1) if elapsed > 0 else float("inf"),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+async def run(patient_sizes: List[int], names: Optional[List[str]], total: int, concurrency: int,
+              latency: Dict[str, float], use_cache: bool = False,
+              tail_fraction: float = 0.0, tail_latency: float = 5.0) -> List[Dict[str, Any]]:
+    """Run the selected scenarios once per patient-store size; returns one result row per pair"""
+    app.HEYGEN_API_KEY = app.HEYGEN_API_KEY or "bench-heygen-key"
+    app.OPENAI_API_KEY = app.OPENAI_API_KEY or "bench-openai-key"
+    app.TWILIO_AUTH_TOKEN = app.TWILIO_AUTH_TOKEN or "bench-twilio-token"
+    results = []
+    for size in patient_sizes:
+        with tempfile.TemporaryDirectory(prefix="amiya-bench-") as directory:
+            uids = seed_storage(directory, size)
+            app._result_cache = app.ResultCache(f"{directory}/cache", memory_entries=512, disk_bytes=0, enabled=use_cache)
+            twilio = TwilioStandIn(latency["twilio"])
+            app._twilio = Client("ACbench", app.TWILIO_AUTH_TOKEN, http_client=twilio.transport)
+            app._sms_dispatcher = app.SmsDispatcher(
+                app._send_sms, app.SMS_WORKERS, app.SMS_RATE_PER_SECOND, app.SMS_RATE_BURST,
+                app.SMS_MAX_ATTEMPTS, app.SMS_RETRY_BASE_SECONDS)
+            available = scenarios(uids)
+            app._upstream_guards.clear()  # fresh breakers and latency windows per store size
+            with mock_upstreams(latency, tail_fraction, tail_latency):
+                async with app.lifespan(app.app):
+                    transport = httpx.ASGITransport(app=app.app)
+                    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                        for name in names or list(available):
+                            stats = await drive(client, available[name], total, concurrency)
+                            results.append({"scenario": name, "patients": size, **stats})
+                            print(_format_row(results[-1]), flush=True)
+    return results
+
+
+def _format_row(row: Dict[str, Any]) -> str:
+    return (f"{row['scenario']:<15} patients={row['patients']:<7} conc={row['concurrency']:<4} "
+            f"rps={row['rps']:<9} p50={row['p50_ms']:<8} p95={row['p95_ms']:<8} p99={row['p99_ms']:<8} "
+            f"errors={row['errors']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and store size")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--patients", default="100,10000", help="comma-separated patient-store sizes")
+    parser.add_argument("--scenarios", default=None, help="comma-separated subset of: " + ", ".join(scenarios([])))
+    parser.add_argument("--heygen-latency", type=float, default=0.15, help="seconds per HeyGen token mint")
+    parser.add_argument("--whisper-latency", type=float, default=0.5, help="seconds per Whisper transcription")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="seconds per chat completion")
+    parser.add_argument("--twilio-latency", type=float, default=0.2, help="seconds per SMS send")
+    parser.add_argument("--tail-fraction", type=float, default=0.0, help="share of HeyGen/OpenAI calls that stall")
+    parser.add_argument("--tail-latency", type=float, default=5.0, help="seconds a stalled call takes")
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on (off by default)")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    names = args.scenarios.split(",") if args.scenarios else None
+    unknown = set(names or []) - set(scenarios([]))
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    latency = {"heygen": args.heygen_latency, "whisper": args.whisper_latency,
+               "openai": args.openai_latency, "twilio": args.twilio_latency}
+    sizes = [int(size) for size in args.patients.split(",")]
+
+    results = asyncio.run(run(sizes, names, args.requests, args.concurrency, latency, use_cache=args.cache,
+                              tail_fraction=args.tail_fraction, tail_latency=args.tail_latency))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    return 1 if any(row["errors"] for row in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
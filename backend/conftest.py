@@ -0,0 +1,30 @@
+"""
+Shared fixtures: keep every test away from the real backend/data directory.
+"""
+
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture(autouse=True)
+def isolated_result_cache(tmp_path, monkeypatch):
+    cache = app_module.ResultCache(str(tmp_path / "cache"), memory_entries=64, disk_bytes=1024 * 1024)
+    monkeypatch.setattr(app_module, "_result_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_storage(tmp_path, monkeypatch):
+    storage = app_module.CsvStorageBackend(
+        app_module.PatientStore(str(tmp_path / "db.csv"), str(tmp_path / "db.log.csv")),
+        app_module.ConversationLog(str(tmp_path / "convos.csv")),
+    )
+    monkeypatch.setattr(app_module, "_storage", storage)
+    return storage
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream_guards(monkeypatch):
+    """Circuit breakers and latency windows start empty in every test"""
+    monkeypatch.setattr(app_module, "_upstream_guards", {})
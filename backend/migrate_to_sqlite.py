@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of the CSV data files (db.csv + pending upsert log, convos.csv)
+into the SQLite storage backend. Afterwards run the API with STORAGE_BACKEND=sqlite.
+
+    python migrate_to_sqlite.py [--db data/amiya.db] [--patients data/db.csv] [--convos data/convos.csv] [--force]
+"""
+
+import argparse
+import sys
+
+import app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=app.SQLITE_DB_PATH, help="SQLite database to create or fill")
+    parser.add_argument("--patients", default=app.CSV_FILE_PATH, help="patients CSV (db.csv)")
+    parser.add_argument("--convos", default=app.CONVOS_CSV_FILE_PATH, help="conversations CSV (convos.csv)")
+    parser.add_argument("--force", action="store_true", help="replace data already in the database")
+    args = parser.parse_args(argv)
+
+    try:
+        counts = app.migrate_csv_to_sqlite(args.db, args.patients, args.convos, force=args.force)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+    print(f"✅ Imported {counts['patients']} patients and {counts['conversations']} conversations into {args.db}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Tests for session setup and other request handling in app.py that needs no stored data.
+"""
+
+import pytest
+
+import app as app_module
+
+
+def test_knowledge_template_renders_profile_and_user():
+    knowledge = app_module._build_knowledge("Ada", "Dexter")
+    assert knowledge.startswith("ROLE & PERSONA:\nYou are Dr. Dexter,")
+    assert '"Hello Ada, I\'m Dr. Dexter.' in knowledge
+    assert "{user_name}" not in knowledge and "{agent_name}" not in knowledge
+
+
+def test_knowledge_config_append_replace_and_name_injection():
+    cfg = app_module.KnowledgeConfig(knowledge_base="Clinic hours for {user_name}: 9-5 {weekdays}", merge_strategy="append")
+    appended = app_module._build_knowledge("Ada", "Ann", cfg)
+    assert appended.startswith("ROLE & PERSONA:")
+    assert appended.endswith("\n\nClinic hours for Ada: 9-5 {weekdays}")
+
+    cfg = app_module.KnowledgeConfig(knowledge_base="Clinic hours for {user_name}", merge_strategy="replace", inject_user_name=False)
+    assert app_module._build_knowledge("Ada", "Ann", cfg) == "Clinic hours for there"
+
+
+def test_identical_custom_knowledge_is_compiled_once():
+    registry = app_module.KnowledgeTemplateRegistry("Dr. {agent_name} greets {user_name}", max_chars=1000)
+    cfg = app_module.KnowledgeConfig(knowledge_base="Notes for {user_name}", merge_strategy="replace")
+    first = registry._compile_custom(cfg.knowledge_base, "Ann")
+    assert registry.render("Bo", "Ann", cfg) == "Notes for Bo"
+    assert registry._compile_custom(cfg.knowledge_base, "Ann") is first
+    assert len(registry._custom) == 1
+
+
+def test_oversized_knowledge_is_rejected():
+    registry = app_module.KnowledgeTemplateRegistry("Dr. {agent_name} greets {user_name}", max_chars=30)
+    with pytest.raises(app_module.HTTPException) as exc:
+        registry.render("Ada", "Ann", app_module.KnowledgeConfig(knowledge_base="x" * 25))
+    assert exc.value.status_code == 413
+    assert registry.render("Ada", "Ann", app_module.KnowledgeConfig(knowledge_base="x" * 25, merge_strategy="replace")) == "x" * 25
+
+
+@pytest.fixture
+def profiling(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(app_module, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(app_module, "PROFILE_SAMPLE_INTERVAL", 0.001)
+    return tmp_path / "profiles"
+
+
+def test_cprofile_header_profiles_one_request_including_threadpool_work(profiling, monkeypatch):
+    import pstats
+
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app_module.app)
+    r = client.post(
+        "/api/new-patient", json={"name": "Ada", "phone_number": "16504506083", "agent_name": "Dexter"},
+        headers={"X-Profile": "cprofile", "X-Admin-Token": "admin-secret", "Origin": "http://localhost:3000"},
+    )
+    assert r.status_code == 200
+    profile_id = r.headers["x-profile-id"]
+    assert r.headers["access-control-allow-origin"] == "*"
+    assert "X-Profile-Id" in r.headers["access-control-expose-headers"]  # browsers can read the id
+    functions = {name for _, _, name in pstats.Stats(str(profiling / f"{profile_id}.prof")).stats}
+    assert "_add_or_update_patient" in functions  # ran in a worker thread
+
+    assert "x-profile-id" not in client.get("/api/health").headers
+    download = client.get(f"/api/admin/profiles/{profile_id}", headers={"X-Admin-Token": "admin-secret"})
+    assert download.status_code == 200 and download.content == (profiling / f"{profile_id}.prof").read_bytes()
+    assert client.get(f"/api/admin/profiles/{profile_id}").status_code == 403
+
+
+def test_sampling_profile_writes_folded_stacks(profiling, monkeypatch):
+    import time
+
+    from fastapi.testclient import TestClient
+
+    def slow_lookup(uid):
+        time.sleep(0.05)
+        return {"name": "Ada", "agent_name": "Dexter"}
+
+    monkeypatch.setattr(app_module, "_find_patient_by_uid", slow_lookup)
+    r = TestClient(app_module.app).get("/api/patient/AAA111", headers={"X-Profile": "sample", "X-Admin-Token": "admin-secret"})
+    assert r.status_code == 200
+    folded = (profiling / f"{r.headers['x-profile-id']}.folded").read_text()
+    assert "slow_lookup (test_app.py:" in folded
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded.splitlines())
+
+
+def test_profiling_requires_enablement_and_the_admin_token(profiling, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app_module.app)
+    assert client.get("/api/health", headers={"X-Profile": "cprofile", "X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/api/health", headers={"X-Profile": "flame", "X-Admin-Token": "admin-secret"}).status_code == 400
+    monkeypatch.setattr(app_module, "PROFILING_ENABLED", False)
+    assert client.get("/api/health", headers={"X-Profile": "cprofile", "X-Admin-Token": "admin-secret"}).status_code == 403
+    assert not profiling.exists()
+
+
+def test_import_stays_within_the_cold_start_budget():
+    import os
+    import subprocess
+    import sys
+
+    budget = float(os.environ.get("IMPORT_TIME_BUDGET_SECONDS", "2.0"))
+    script = (
+        "import sys, time; started = time.perf_counter(); import app; elapsed = time.perf_counter() - started; "
+        "print(elapsed, *[m for m in ('openai', 'twilio', 'aiohttp') if m in sys.modules])"
+    )
+    out = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(app_module.__file__),
+                         capture_output=True, text=True, check=True).stdout.split()
+    assert out[1:] == []  # upstream SDKs load on first use, not at import
+    assert float(out[0]) < budget
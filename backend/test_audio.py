@@ -0,0 +1,582 @@
+"""
+Tests for the /api/process-audio pipeline in app.py.
+OpenAI is mocked locally with respx (including injected latency); nothing here touches the network.
+"""
+
+import asyncio
+import base64
+import json
+import os
+
+import httpx
+import pytest
+import respx
+
+import app as app_module
+
+WHISPER_URL = "https://api.openai.com/v1/audio/transcriptions"
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+def _chat_response(content):
+    return httpx.Response(200, json={
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    })
+
+
+@pytest.fixture(autouse=True)
+def api_keys(monkeypatch):
+    monkeypatch.setattr(app_module, "OPENAI_API_KEY", "test-openai-key")
+    monkeypatch.setattr(app_module, "_stage_semaphores", {})
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _asgi_client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app_module.app), base_url="http://test")
+
+
+def test_pipeline_stages_are_async_and_individually_limited(monkeypatch):
+    monkeypatch.setitem(app_module.STAGE_CONCURRENCY, "whisper", 1)
+    in_whisper = {"now": 0, "peak": 0}
+
+    async def slow_whisper(request):
+        in_whisper["now"] += 1
+        in_whisper["peak"] = max(in_whisper["peak"], in_whisper["now"])
+        await asyncio.sleep(0.2)
+        in_whisper["now"] -= 1
+        return httpx.Response(200, text="  my back hurts \n")
+
+    async def scenario():
+        async with await _asgi_client() as client:
+            body = {"audio_data": base64.b64encode(b"fake-webm").decode()}
+            audio = [asyncio.create_task(client.post("/api/process-audio", json=body)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            # The event loop is free while Whisper is in flight
+            health = await asyncio.wait_for(client.get("/api/health"), 0.1)
+            return health, await asyncio.gather(*audio)
+
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=slow_whisper)
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("My back hurts."))
+        health, responses = _run(scenario())
+
+    assert health.status_code == 200
+    assert [r.json() for r in responses] == [
+        {"transcribed_text": "my back hurts", "processed_text": "My back hurts.", "success": True}
+    ] * 3
+    assert in_whisper["peak"] == 1
+
+
+def test_multipart_upload_goes_straight_to_whisper(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    seen = {}
+
+    def whisper(request):
+        seen["body"] = request.read()
+        return httpx.Response(200, text="hello doctor")
+
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=whisper)
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hello, doctor."))
+        r = TestClient(app_module.app).post(
+            "/api/process-audio/upload",
+            files={"file": ("clip.wav", b"RIFF....WAVEfmt raw-pcm", "audio/wav")},
+            data={"patient_context": "Ada"},
+        )
+
+    assert r.status_code == 200
+    assert r.json()["processed_text"] == "Hello, doctor."
+    assert b'filename="audio.wav"' in seen["body"]
+    assert b"RIFF....WAVEfmt raw-pcm" in seen["body"]
+
+
+def test_multipart_upload_over_the_cap_is_rejected(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(app_module, "MAX_AUDIO_UPLOAD_BYTES", 1024)
+    with respx.mock(assert_all_called=False) as mock:
+        whisper = mock.post(WHISPER_URL)
+        r = TestClient(app_module.app).post("/api/process-audio/upload", files={"file": ("clip.webm", b"x" * 4096, "audio/webm")})
+    assert r.status_code == 413
+    assert not whisper.called
+
+
+def test_raw_body_upload_streams_straight_to_whisper(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    seen = {}
+
+    def whisper(request):
+        seen["body"] = request.read()
+        return httpx.Response(200, text="hello doctor")
+
+    client = TestClient(app_module.app)
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=whisper)
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hello, doctor."))
+        r = client.post("/api/process-audio/raw", params={"patient_context": "Ada"},
+                        content=iter([b"RIFF....", b"WAVEfmt raw-pcm"]), headers={"Content-Type": "audio/wav"})
+    assert r.status_code == 200
+    assert r.json()["processed_text"] == "Hello, doctor."
+    assert b'filename="audio.wav"' in seen["body"] and b"RIFF....WAVEfmt raw-pcm" in seen["body"]
+
+    monkeypatch.setattr(app_module, "MAX_AUDIO_UPLOAD_BYTES", 1024)
+    with respx.mock(assert_all_called=False) as mock:
+        whisper_route = mock.post(WHISPER_URL)
+        assert client.post("/api/process-audio/raw", content=iter([b"x" * 4096]), headers={"Content-Type": "audio/webm"}).status_code == 413
+        assert client.post("/api/process-audio/raw", content=b"clip", headers={"Content-Type": "application/json"}).status_code == 415
+    assert not whisper_route.called
+
+
+def test_medical_index_ranks_topic_sections_and_reloads_on_change(tmp_path):
+    path = tmp_path / "medical_data.txt"
+    path.write_text(
+        "MEDICAL KNOWLEDGE BASE\n\nCOMMON SYMPTOMS:\n\nBack Pain:\n- Causes: poor posture, muscle strain\n\n"
+        "Headaches:\n- Triggers: stress, dehydration, poor sleep\n\nClosing disclaimer about medical advice.\n"
+    )
+    index = app_module.MedicalKnowledgeIndex(str(path))
+    assert [s['title'] for s in index.sections] == []  # nothing parsed until first use
+    assert [s['title'] for s in index.search("my headache got worse", 3)] == ['Headaches']
+    assert [s['title'] for s in index.sections] == ['Back Pain', 'Headaches', 'General']
+    assert index.search("quantum chromodynamics", 3) == []
+
+    path.write_text("Dizziness:\n- Causes: dehydration, inner ear problems, low blood pressure\n")
+    os.utime(path, ns=(1, 1))
+    assert [s['title'] for s in index.search("dehydration", 3)] == ['Dizziness']
+
+
+def test_cleanup_prompt_only_carries_relevant_sections():
+    from fastapi.testclient import TestClient
+
+    prompts = []
+
+    def chat(request):
+        prompts.append(json.loads(request.read())["messages"][1]["content"])
+        return _chat_response("My lower back hurts.")
+
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="my lower back hurts"))
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=chat)
+        r = TestClient(app_module.app).post("/api/process-audio", json={"audio_data": base64.b64encode(b"a").decode()})
+
+    assert r.status_code == 200
+    assert "Back Pain:" in prompts[0]
+    assert "Telehealth Benefits:" not in prompts[0]
+
+
+def test_retried_audio_is_served_from_the_result_cache(isolated_result_cache):
+    from fastapi.testclient import TestClient
+
+    body = {"audio_data": base64.b64encode(b"same clip").decode()}
+    with respx.mock() as mock:
+        whisper = mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="my back hurts"))
+        chat = mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("My back hurts."))
+        client = TestClient(app_module.app)
+        first = client.post("/api/process-audio", json=body).json()
+        second = client.post("/api/process-audio", json=body).json()
+        other = client.post("/api/process-audio", json={"audio_data": base64.b64encode(b"new clip").decode()})
+
+    assert first == second
+    assert other.status_code == 200
+    assert whisper.call_count == 2 and chat.call_count == 1  # same transcript -> cleanup cached too
+    assert isolated_result_cache.stats()["hits"] == 3
+
+
+def test_concurrent_duplicates_share_one_upstream_call(isolated_result_cache):
+    async def slow_whisper(request):
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, text="hello")
+
+    async def scenario():
+        return await asyncio.gather(*(app_module._transcribe_audio_with_whisper(b"clip") for _ in range(5)))
+
+    with respx.mock() as mock:
+        route = mock.post(WHISPER_URL).mock(side_effect=slow_whisper)
+        assert _run(scenario()) == ["hello"] * 5
+    assert route.call_count == 1
+    assert isolated_result_cache.stats()["coalesced"] == 4
+
+
+def test_cancelled_leader_hands_the_computation_to_a_waiter(isolated_result_cache):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return f"value {len(calls)}"
+
+    async def scenario():
+        leader = asyncio.create_task(isolated_result_cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.02)
+        waiter = asyncio.create_task(isolated_result_cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.02)
+        leader.cancel()  # e.g. the leader's client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert _run(scenario()) == "value 2"
+    assert len(calls) == 2 and isolated_result_cache.lookup("k") == (True, "value 2")
+
+
+def test_disk_tier_survives_restarts_and_stays_under_its_size_bound(tmp_path):
+    cache = app_module.ResultCache(str(tmp_path / "cache"), memory_entries=1, disk_bytes=200)
+    for i in range(10):
+        cache.put(f"k{i}", f"value {i} " * 3)
+    sizes = sum(p.stat().st_size for p in (tmp_path / "cache").iterdir())
+    assert 0 < sizes <= 200
+
+    restarted = app_module.ResultCache(str(tmp_path / "cache"), memory_entries=1, disk_bytes=200)
+    assert restarted.lookup("k9") == (True, "value 9 " * 3)
+    assert restarted.lookup("k0") == (False, None)
+
+
+def test_metrics_endpoint_reports_stage_upstream_and_storage_latency():
+    from fastapi.testclient import TestClient
+
+    app_module._metrics.reset()
+    client = TestClient(app_module.app)
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="my back hurts"))
+        mock.post(OPENAI_CHAT_URL).mock(return_value=httpx.Response(500, json={"error": "boom"}))
+        r = client.post("/api/process-audio", json={"audio_data": base64.b64encode(b"clip").decode()})
+    assert r.status_code == 500
+    client.post("/api/new-patient", json={"name": "Ada", "phone_number": "16504506083", "agent_name": "Dexter"})
+
+    r = client.get("/api/metrics")
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = r.text.splitlines()
+    assert "# TYPE amiya_stage_seconds histogram" in lines
+    for stage in ("base64_decode", "whisper", "medical_context", "cleanup"):
+        assert f'amiya_stage_seconds_count{{stage="{stage}"}} 1' in lines
+    assert 'amiya_upstream_request_seconds_count{outcome="ok",upstream="whisper"} 1' in lines
+    assert any(line.startswith('amiya_upstream_request_seconds_count{outcome="error",upstream="chat"}') for line in lines)
+    assert 'amiya_upstream_requests_in_flight{upstream="whisper"} 0' in lines
+    assert 'amiya_storage_seconds_count{file="db.log.csv",op="append"} 1' in lines
+    assert 'amiya_http_request_seconds_count{method="POST",route="/api/process-audio",status="500"} 1' in lines
+    assert 'amiya_http_requests_in_flight{route="/api/metrics"} 1' in lines  # the scrape itself
+    assert 'amiya_http_request_seconds_bucket{method="POST",route="/api/new-patient",status="200",le="+Inf"} 1' in lines
+
+
+def _wav(seconds_silence, seconds_tone, rate=48000, channels=2):
+    import io
+    import math
+    import struct
+    import wave
+
+    samples = []
+    for i in range(int(rate * (2 * seconds_silence + seconds_tone))):
+        t = i / rate
+        value = int(12000 * math.sin(2 * math.pi * 440 * t)) if seconds_silence <= t < seconds_silence + seconds_tone else 0
+        samples.extend([value] * channels)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(struct.pack(f"<{len(samples)}h", *samples))
+    return buffer.getvalue()
+
+
+def test_preprocessing_trims_downmixes_and_resamples_wav(monkeypatch):
+    import io
+    import wave
+
+    from fastapi.testclient import TestClient
+
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(app_module, "AUDIO_PREPROCESS", True)
+    sent = {}
+
+    def whisper(request):
+        body = request.read()
+        sent["wav"] = body[body.index(b"RIFF"):]
+        return httpx.Response(200, text="hello")
+
+    clip = _wav(seconds_silence=1.0, seconds_tone=1.0)
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=whisper)
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hello."))
+        r = TestClient(app_module.app).post("/api/process-audio", json={"audio_data": base64.b64encode(clip).decode()})
+
+    stats = r.json()["preprocessing"]
+    assert stats["seconds_in"] == 3.0 and 1.3 <= stats["seconds_out"] <= 1.5  # 1s of speech + 200ms padding each side
+    assert stats["bytes_in"] == len(clip) and stats["bytes_saved"] == len(clip) - stats["bytes_out"] > 0.9 * len(clip)
+    with wave.open(io.BytesIO(sent["wav"].split(b"\r\n--")[0])) as wav:
+        assert (wav.getnchannels(), wav.getframerate(), wav.getsampwidth()) == (1, 16000, 2)
+
+
+def test_preprocessing_never_upsamples_or_grows_the_clip(monkeypatch):
+    import io
+    import wave
+
+    from fastapi.testclient import TestClient
+
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(app_module, "AUDIO_PREPROCESS", True)
+    sent = []
+
+    def whisper(request):
+        body = request.read()
+        sent.append(body[body.index(b"RIFF"):].split(b"\r\n--")[0])
+        return httpx.Response(200, text="hello")
+
+    narrowband = _wav(seconds_silence=0.5, seconds_tone=1.0, rate=8000, channels=1)
+    tight = _wav(seconds_silence=0.0, seconds_tone=1.0, rate=8000, channels=1)
+    client = TestClient(app_module.app)
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=whisper)
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hello."))
+        trimmed = client.post("/api/process-audio", json={"audio_data": base64.b64encode(narrowband).decode()}).json()
+        unchanged = client.post("/api/process-audio", json={"audio_data": base64.b64encode(tight).decode()}).json()
+
+    with wave.open(io.BytesIO(sent[0])) as wav:
+        assert wav.getframerate() == 8000
+    assert 0 < trimmed["preprocessing"]["bytes_out"] < len(narrowband)
+    assert unchanged["preprocessing"]["bytes_saved"] == 0 and sent[1] == tight
+
+
+def test_wav_with_a_zero_framerate_is_passed_through_undecoded(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(app_module, "AUDIO_PREPROCESS", True)
+    clip = bytearray(_wav(seconds_silence=0.0, seconds_tone=0.1, rate=8000, channels=1))
+    clip[24:32] = bytes(8)  # sample rate and byte rate
+    assert app_module._decode_pcm(bytes(clip), raw_pcm=False) is None
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="hello"))
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hello."))
+        r = TestClient(app_module.app).post("/api/process-audio", json={"audio_data": base64.b64encode(bytes(clip)).decode()})
+    assert r.status_code == 200 and "preprocessing" not in r.json()
+
+
+def test_all_silence_skips_whisper_and_other_formats_pass_through(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(app_module, "AUDIO_PREPROCESS", True)
+    client = TestClient(app_module.app)
+    with respx.mock(assert_all_called=False) as mock:
+        whisper = mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="hi"))
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Hi."))
+        silent = client.post("/api/process-audio/upload", files={"file": ("clip.pcm", b"\x03\x00" * 48000, "audio/pcm")}).json()
+        assert not whisper.called
+        webm = client.post("/api/process-audio", json={"audio_data": base64.b64encode(b"webm bytes").decode()}).json()
+
+    assert silent["transcribed_text"] == "" and silent["preprocessing"]["silent"] is True
+    assert silent["preprocessing"]["seconds_saved"] == 1.0 and silent["preprocessing"]["bytes_out"] == 0
+    assert webm == {"transcribed_text": "hi", "processed_text": "Hi.", "success": True}
+
+
+def test_websocket_streams_partial_and_cleaned_text_per_segment():
+    from fastapi.testclient import TestClient
+
+    async def whisper(request):
+        body = request.read()
+        if b"first" in body:
+            await asyncio.sleep(0.1)  # later segments may finish first
+            return httpx.Response(200, text="my knee hurts")
+        return httpx.Response(200, text="since tuesday")
+
+    def chat(request):
+        text = json.loads(request.read())["messages"][1]["content"].split("TRANSCRIBED TEXT:\n")[1].split("\n")[0]
+        return _chat_response(text.capitalize() + ".")
+
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(side_effect=whisper)
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=chat)
+        with TestClient(app_module.app).websocket_connect("/api/transcribe/ws") as ws:
+            ws.send_json({"type": "config", "filename": "clip.ogg"})
+            ws.send_bytes(b"first ")
+            ws.send_bytes(b"segment")
+            ws.send_json({"type": "segment_end"})
+            ws.send_bytes(b"second segment")
+            ws.send_json({"type": "stop"})
+            messages = []
+            while not messages or messages[-1]["type"] != "final":
+                messages.append(ws.receive_json())
+
+    by_seq = {seq: [m["type"] for m in messages if m.get("seq") == seq] for seq in (0, 1)}
+    assert by_seq == {0: ["partial", "segment"], 1: ["partial", "segment"]}
+    assert messages.index({"type": "partial", "seq": 1, "text": "since tuesday"}) < messages.index(
+        {"type": "segment", "seq": 0, "text": "my knee hurts", "processed_text": "My knee hurts."})
+    assert messages[-1] == {"type": "final", "transcript": "my knee hurts since tuesday",
+                            "processed_text": "My knee hurts. Since tuesday."}
+
+
+def test_websocket_failed_segment_reports_an_error_and_still_sends_final(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    pipeline = app_module._run_audio_pipeline
+
+    async def flaky_pipeline(audio, *args, **kwargs):
+        if audio == b"bad clip":
+            raise ZeroDivisionError("division by zero")
+        return await pipeline(audio, *args, **kwargs)
+
+    monkeypatch.setattr(app_module, "_run_audio_pipeline", flaky_pipeline)
+    with respx.mock() as mock:
+        mock.post(WHISPER_URL).mock(return_value=httpx.Response(200, text="my knee hurts"))
+        mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("My knee hurts."))
+        with TestClient(app_module.app).websocket_connect("/api/transcribe/ws") as ws:
+            ws.send_bytes(b"bad clip")
+            ws.send_json({"type": "segment_end"})
+            ws.send_bytes(b"good clip")
+            ws.send_json({"type": "stop"})
+            messages = []
+            while not messages or messages[-1]["type"] != "final":
+                messages.append(ws.receive_json())
+
+    assert {"type": "error", "seq": 0, "detail": "Failed to process audio: division by zero"} in messages
+    assert messages[-1] == {"type": "final", "transcript": "my knee hurts", "processed_text": "My knee hurts."}
+
+
+def test_websocket_rejects_oversized_segments(monkeypatch):
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+
+    monkeypatch.setattr(app_module, "WS_MAX_SEGMENT_BYTES", 8)
+    with TestClient(app_module.app).websocket_connect("/api/transcribe/ws") as ws:
+        ws.send_json({"type": "nope"})
+        assert ws.receive_json()["detail"].startswith("Expected binary audio")
+        ws.send_bytes(b"x" * 9)
+        assert ws.receive_json() == {"type": "error", "seq": 0, "detail": "Segment exceeds 8 bytes"}
+        with pytest.raises(WebSocketDisconnect) as exc:
+            ws.receive_json()
+    assert exc.value.code == 1009
+
+
+def test_oversized_bodies_are_refused_before_they_are_read(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setitem(app_module.ADMISSION_BODY_LIMITS, "/api/process-audio", 100)
+    calls = []
+    monkeypatch.setattr(app_module, "_run_audio_pipeline", lambda *args, **kwargs: calls.append(args))
+    client = TestClient(app_module.app)
+    body = json.dumps({"audio_data": base64.b64encode(b"x" * 200).decode()}).encode()
+
+    declared = client.post("/api/process-audio", content=body, headers={"content-type": "application/json"})
+    chunked = client.post("/api/process-audio", content=iter([body[:60], body[60:]]), headers={"content-type": "application/json"})
+    assert declared.status_code == chunked.status_code == 413
+    assert calls == []
+
+
+def test_saturated_lane_queues_then_sheds_while_the_priority_lane_stays_open(monkeypatch):
+    lanes = {name: app_module.AdmissionLane(name, 1, 1, queue_timeout=5) for name in ("audio", "priority")}
+    monkeypatch.setattr(app_module, "_admission_lanes", lanes)
+    monkeypatch.setattr(app_module, "_find_patient_by_uid", lambda uid: {"name": "Ada", "agent_name": "Dexter"})
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_pipeline(audio, *args, **kwargs):
+            await release.wait()
+            return app_module.AudioProcessResponse(transcribed_text="t", processed_text="c", success=True)
+
+        monkeypatch.setattr(app_module, "_run_audio_pipeline", slow_pipeline)
+        payload = {"audio_data": base64.b64encode(b"clip").decode()}
+        async with await _asgi_client() as client:
+            running = asyncio.create_task(client.post("/api/process-audio", json=payload))
+            while lanes["audio"].active == 0:
+                await asyncio.sleep(0.01)
+            queued = asyncio.create_task(client.post("/api/process-audio", json=payload))
+            while lanes["audio"].queued == 0:
+                await asyncio.sleep(0.01)
+            shed = await client.post("/api/process-audio", json=payload)
+            lookup = await client.get("/api/patient/AAA111")
+            release.set()
+            return shed, lookup, await running, await queued
+
+    shed, lookup, running, queued = _run(scenario())
+    assert shed.status_code == 429 and int(shed.headers["retry-after"]) >= 1
+    assert lookup.status_code == 200
+    assert running.status_code == queued.status_code == 200
+    assert lanes["audio"].active == 0 and lanes["audio"].queued == 0
+
+
+def test_lane_gives_up_on_waiters_after_the_queue_timeout():
+    lane = app_module.AdmissionLane("summary", limit=1, queue_size=4, queue_timeout=0.05)
+
+    async def scenario():
+        assert await lane.acquire()
+        assert not await lane.acquire()  # timed out in the queue
+        lane.release(0.5)
+        assert await lane.acquire()  # the freed slot wasn't handed to the departed waiter
+
+    _run(scenario())
+    assert lane.active == 1 and lane.queued == 0 and lane.retry_after() == 1
+
+
+def _verbose_transcription(text, avg_logprob):
+    return httpx.Response(200, json={"task": "transcribe", "language": "english", "duration": 2.0, "text": text, "segments": [
+        {"id": 0, "seek": 0, "start": 0.0, "end": 2.0, "text": text, "tokens": [1], "temperature": 0.0,
+         "avg_logprob": avg_logprob, "compression_ratio": 1.0, "no_speech_prob": 0.01},
+    ]})
+
+
+def test_fast_mode_answers_after_whisper_and_delivers_the_cleanup_later():
+    async def slow_cleanup(request):
+        await asyncio.sleep(0.5)
+        return _chat_response("My lower back has hurt since Tuesday.")
+
+    async def scenario():
+        async with await _asgi_client() as client:
+            payload = {"audio_data": base64.b64encode(b"fast clip").decode(), "mode": "fast"}
+            started = asyncio.get_running_loop().time()
+            first = await client.post("/api/process-audio", json=payload)
+            answered_in = asyncio.get_running_loop().time() - started
+            pending = await client.get(f"/api/process-audio/cleanup/{first.json()['cleanup_id']}")
+            done = await client.get(f"/api/process-audio/cleanup/{first.json()['cleanup_id']}", params={"wait": 5})
+            missing = await client.get("/api/process-audio/cleanup/nope")
+            return first, answered_in, pending, done, missing
+
+    raw = "um my lower back has been hurting since uh tuesday"
+    with respx.mock() as mock:
+        whisper = mock.post(WHISPER_URL).mock(return_value=_verbose_transcription(raw, -0.7))
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=slow_cleanup)
+        first, answered_in, pending, done, missing = _run(scenario())
+
+    assert first.status_code == 200 and answered_in < 0.5
+    body = first.json()
+    assert body["transcribed_text"] == body["processed_text"] == raw and body["cleanup"] == "pending"
+    assert b'name="response_format"\r\n\r\nverbose_json' in whisper.calls[0].request.content
+    assert pending.json() == {"cleanup_id": body["cleanup_id"], "status": "pending"}
+    assert done.json()["status"] == "done" and done.json()["processed_text"] == "My lower back has hurt since Tuesday."
+    assert missing.status_code == 404
+
+
+@pytest.mark.parametrize("text, avg_logprob, expected", [
+    ("yes thank you", -1.5, "skipped"),  # short
+    ("my knee has been stiff every morning this week", -0.05, "skipped"),  # Whisper was confident
+    ("my knee has been stiff every morning this week", -0.9, "pending"),
+])
+def test_adaptive_policy_skips_cleanup_for_short_or_confident_utterances(text, avg_logprob, expected):
+    from fastapi.testclient import TestClient
+
+    with respx.mock(assert_all_called=False) as mock:
+        mock.post(WHISPER_URL).mock(return_value=_verbose_transcription(text, avg_logprob))
+        chat = mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_response("Cleaned."))
+        with TestClient(app_module.app) as client:
+            r = client.post("/api/process-audio/upload", files={"file": ("clip.webm", b"clip", "audio/webm")}, data={"mode": "fast"})
+            if expected == "pending":
+                assert client.get(f"/api/process-audio/cleanup/{r.json()['cleanup_id']}", params={"wait": 5}).json()["status"] == "done"
+    assert r.json()["cleanup"] == expected and r.json()["processed_text"] == text
+    assert chat.called == (expected == "pending")
+    assert ("cleanup_id" in r.json()) == (expected == "pending")
+
+
+def test_raw_pcm_upload_is_rejected_without_preprocessing(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(app_module, "AUDIO_PREPROCESS", False)
+    with respx.mock(assert_all_called=False) as mock:
+        whisper = mock.post(WHISPER_URL)
+        r = TestClient(app_module.app).post("/api/process-audio/upload", files={"file": ("clip.pcm", b"\x00\x01" * 800, "application/octet-stream")})
+    assert r.status_code == 400 and "AUDIO_PREPROCESS" in r.json()["detail"]
+    assert not whisper.called
@@ -0,0 +1,34 @@
+"""
+Smoke test for the offline benchmark in bench.py: a tiny run with all upstreams stubbed.
+"""
+
+import asyncio
+
+import pytest
+
+import app as app_module
+import bench
+
+
+def test_percentile_uses_nearest_rank():
+    samples = [float(i) for i in range(1, 101)]
+    assert (bench.percentile(samples, 50), bench.percentile(samples, 95), bench.percentile(samples, 99)) == (50.0, 95.0, 99.0)
+    assert bench.percentile([0.3], 99) == 0.3
+
+
+@pytest.mark.parametrize("patients", [0, 500])
+def test_every_scenario_runs_offline_without_errors(monkeypatch, patients):
+    # bench.run swaps module globals; let monkeypatch put them back
+    for name in ("HEYGEN_API_KEY", "OPENAI_API_KEY", "TWILIO_AUTH_TOKEN", "_twilio", "_sms_dispatcher"):
+        monkeypatch.setattr(app_module, name, getattr(app_module, name))
+    latency = {"heygen": 0.01, "whisper": 0.02, "openai": 0.01, "twilio": 0.0}
+
+    results = asyncio.run(bench.run([patients], None, total=6, concurrency=3, latency=latency))
+
+    assert [row["scenario"] for row in results] == ["session", "new-patient", "patient-lookup", "summarize", "process-audio"]
+    lookup = results[2]
+    assert lookup["errors"] == (6 if patients == 0 else 0)  # an empty store can only 404
+    assert all(row["errors"] == 0 for row in results if row["scenario"] != "patient-lookup")
+    audio = results[-1]
+    assert audio["p50_ms"] >= 30 and audio["p50_ms"] <= audio["p95_ms"] <= audio["p99_ms"] <= audio["max_ms"]
+    assert audio["rps"] > 0
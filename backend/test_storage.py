@@ -0,0 +1,298 @@
+"""
+Tests for the CSV-backed patient and conversation storage in app.py.
+All tests run against temporary copies of the data files, never backend/data.
+"""
+
+import csv
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+
+def _write_csv(path, fieldnames, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _read_csv(path):
+    with open(path, 'r', newline='', encoding='utf-8') as file:
+        return list(csv.DictReader(file))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    snapshot = tmp_path / "db.csv"
+    _write_csv(snapshot, app_module.PATIENT_FIELDS, [
+        {'uid': 'AAA111', 'name': 'Ada', 'phone_number': '+16504506083', 'agent_name': 'Dexter'},
+        {'uid': 'BBB222', 'name': 'Bob', 'phone_number': '1234567890', 'agent_name': 'Ann'},
+    ])
+    patient_store = app_module.PatientStore(str(snapshot), str(tmp_path / "db.log.csv"), compact_threshold=3)
+    monkeypatch.setattr(app_module, "_storage", app_module.CsvStorageBackend(
+        patient_store, app_module.ConversationLog(str(tmp_path / "convos.csv"))))
+    return patient_store
+
+
+def test_lookup_by_uid_and_normalized_phone(store):
+    assert store.get_by_uid('BBB222')['name'] == 'Bob'
+    assert store.get_by_phone('+1 (650) 450-6083')['uid'] == 'AAA111'
+    assert store.get_by_uid('NOPE00') is None
+
+
+def test_upsert_appends_to_log_and_keeps_roster_order(store, tmp_path):
+    assert store.upsert({'uid': 'CCC333', 'name': 'Ada L', 'phone_number': '16504506083', 'agent_name': 'Judy'}) == 'AAA111'
+    assert store.get_by_uid('AAA111') is None
+    assert [p['uid'] for p in store.all()] == ['CCC333', 'BBB222']
+    # Snapshot untouched until compaction, change lives in the log
+    assert [r['uid'] for r in _read_csv(tmp_path / "db.csv")] == ['AAA111', 'BBB222']
+    assert [r['uid'] for r in _read_csv(tmp_path / "db.log.csv")] == ['CCC333']
+
+
+def test_log_replays_on_reload_and_compacts_at_threshold(store, tmp_path):
+    store.upsert({'uid': 'CCC333', 'name': 'Cy', 'phone_number': '5550000001', 'agent_name': 'Ann'})
+    store.upsert({'uid': 'DDD444', 'name': 'Di', 'phone_number': '5550000002', 'agent_name': 'Ann'})
+
+    reloaded = app_module.PatientStore(store.snapshot_path, store.log_path, compact_threshold=3)
+    assert [p['uid'] for p in reloaded.all()] == ['AAA111', 'BBB222', 'CCC333', 'DDD444']
+
+    store.upsert({'uid': 'EEE555', 'name': 'Bo', 'phone_number': '1234567890', 'agent_name': 'Judy'})
+    assert not (tmp_path / "db.log.csv").exists()
+    assert [r['uid'] for r in _read_csv(tmp_path / "db.csv")] == ['AAA111', 'EEE555', 'CCC333', 'DDD444']
+
+
+def test_new_patient_and_lookup_endpoints(store):
+    client = TestClient(app_module.app)
+    r = client.post("/api/new-patient", json={"name": "Bob B", "phone_number": "1234567890", "agent_name": "Dr. Michael Rodriguez"})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["message"] == "Updated existing patient with UID BBB222"
+
+    r = client.get(f"/api/patient/{body['uid']}")
+    assert r.json() == {"name": "Bob B", "doctor": "Michael"}
+    assert client.get("/api/patient/BBB222").status_code == 404
+
+
+def test_bulk_import_validates_dedupes_and_writes_once(store, monkeypatch):
+    dispatcher = app_module.SmsDispatcher(app_module._send_sms, workers=1, rate_per_second=0, burst=1, max_attempts=1, retry_base_seconds=0)
+    monkeypatch.setattr(app_module, "_sms_dispatcher", dispatcher)
+    monkeypatch.setattr(app_module, "TWILIO_AUTH_TOKEN", "test-twilio-token")
+    monkeypatch.setattr(app_module, "PATIENT_IMPORT_INVITE_BATCH", 1)
+    commits = []
+    commit = store._commit_batch
+    monkeypatch.setattr(store, "_commit_batch", lambda rows: (commits.append(len(rows)), commit(rows))[1])
+
+    roster = (
+        "name,phone_number,agent_name\n"
+        "Cy,5550000001,Dr. Michael Rodriguez\n"
+        "Bob B,+1 234 567 890,Ann\n"
+        ",5550000002,Ann\n"
+        "Cy again,(555) 000-0001,Ann\n"
+        "\n"
+        "Di,5550000003,Judy\n"
+    )
+    r = TestClient(app_module.app).post("/api/patients/import", files={"file": ("roster.csv", roster.encode(), "text/csv")})
+
+    assert r.status_code == 200
+    body = r.json()
+    assert (body["created"], body["updated"], body["duplicates"], body["invalid"]) == (2, 1, 1, 1)
+    assert [(row["line"], row["status"]) for row in body["rows"]] == [
+        (2, "created"), (3, "updated"), (4, "invalid"), (5, "duplicate"), (7, "created")]
+    assert "name" in body["rows"][2]["error"]
+    assert commits == [3]
+    cy = store.get_by_phone('5550000001')
+    assert (cy['uid'], cy['agent_name']) == (body["rows"][0]["uid"], 'Michael')
+    assert store.get_by_uid('BBB222') is None
+    assert [row.get("sms") for row in body["rows"]] == ["queued", "queued", None, None, "queued"]
+    assert dispatcher.stats()["queued"] == 3
+
+
+def test_bulk_import_accepts_ndjson_and_rejects_bad_headers(store):
+    client = TestClient(app_module.app)
+    lines = '{"name": "Cy", "phone_number": "5550000001", "agent_name": "Ann"}\nnot json\n["x"]\n'
+    r = client.post("/api/patients/import?send_invites=false", files={"file": ("roster.ndjson", lines.encode(), "application/x-ndjson")})
+    assert [(row["line"], row["status"], row["sms"]) for row in r.json()["rows"]] == [
+        (1, "created", None), (2, "invalid", None), (3, "invalid", None)]
+    assert len(store) == 3
+
+    r = client.post("/api/patients/import", files={"file": ("roster.csv", b"name,phone\nCy,5550000009\n", "text/csv")})
+    assert r.status_code == 400
+    assert "phone_number, agent_name" in r.json()["detail"]
+
+
+def test_bulk_import_reports_non_string_fields_per_row_and_rejects_malformed_csv(store):
+    client = TestClient(app_module.app)
+    lines = '{"name": "A", "phone_number": 6505551234, "agent_name": "Ann"}\n{"name": "B", "phone_number": "6505550000", "agent_name": "Ann"}\n'
+    r = client.post("/api/patients/import?send_invites=false", files={"file": ("roster.ndjson", lines.encode(), "application/x-ndjson")})
+    assert r.status_code == 200
+    assert [(row["status"], row["phone_number"]) for row in r.json()["rows"]] == [("invalid", "6505551234"), ("created", "6505550000")]
+
+    roster = "name,phone_number,agent_name\n" + "A" * 200_000 + ",5550000001,Ann\n"  # over the csv module's field limit
+    r = client.post("/api/patients/import", files={"file": ("roster.csv", roster.encode(), "text/csv")})
+    assert r.status_code == 400 and r.json()["detail"].startswith("Malformed CSV")
+
+
+def _upsert_range(snapshot, log, prefix, count):
+    patient_store = app_module.PatientStore(snapshot, log, compact_threshold=7)
+    for i in range(count):
+        patient_store.upsert({'uid': f'{prefix}{i:04d}', 'name': prefix, 'phone_number': f'{prefix}-{i}', 'agent_name': 'Ann'})
+
+
+def test_concurrent_processes_do_not_lose_upserts(store):
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_upsert_range, args=(store.snapshot_path, store.log_path, f'{n}', 25)) for n in range(1, 5)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(30)
+        assert w.exitcode == 0
+
+    # The fixture's store was loaded before the workers ran; it must catch up from disk
+    assert len(store) == 2 + 4 * 25
+    assert store.get_by_uid('40024')['phone_number'] == '4-24'
+
+
+def test_concurrent_threads_are_group_committed(store, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    batches = []
+    commit = store._commit_batch
+    monkeypatch.setattr(store._committer, "_commit", lambda rows: (batches.append(len(rows)), commit(rows))[1])
+    rows = [{'uid': f'T{i:05d}', 'name': 'T', 'phone_number': f'555{i:07d}', 'agent_name': 'Ann'} for i in range(200)]
+    with ThreadPoolExecutor(16) as pool:
+        assert list(pool.map(store.upsert, rows)) == [None] * 200
+
+    assert sum(batches) == 200
+    assert len(store) == 202
+
+
+def test_conversation_appends_are_atomic_rows(tmp_path):
+    log = app_module.ConversationLog(str(tmp_path / "convos.csv"))
+    summary = 'line one, with comma\nline "two"'
+    log.append({'start_time': '2024-01-15T10:00:00Z', 'duration_minutes': 3.5, 'phone_number': '1', 'uid': 'AAA111',
+                'summary': summary, 'doctor_name': 'Dexter', 'user_name': 'Ada'})
+    rows = _read_csv(tmp_path / "convos.csv")
+    assert rows[0]['summary'] == summary
+    assert list(rows[0]) == app_module.CONVO_FIELDS
+
+
+@pytest.fixture
+def conversations(tmp_path, monkeypatch):
+    path = tmp_path / "convos.csv"
+    rows = [
+        {'start_time': f'2024-01-{day:02d}T10:00:00Z', 'duration_minutes': '10.0', 'phone_number': phone,
+         'uid': uid, 'summary': f'visit {day}', 'doctor_name': doctor, 'user_name': 'Ada'}
+        for day, uid, phone, doctor in [
+            (1, 'AAA111', '+16504506083', 'Dexter'),
+            (3, 'BBB222', '1234567890', 'Ann'),
+            (2, 'AAA111', '16504506083', 'Dexter'),  # out of order on disk
+            (5, 'AAA111', '+16504506083', 'Ann'),
+            (4, 'AAA111', '+16504506083', 'Dexter'),
+        ]
+    ]
+    _write_csv(path, app_module.CONVO_FIELDS, rows)
+    log = app_module.ConversationLog(str(path))
+    monkeypatch.setattr(app_module, "_storage", app_module.CsvStorageBackend(
+        app_module.PatientStore(str(tmp_path / "db.csv"), str(tmp_path / "db.log.csv")), log))
+    return log
+
+
+def test_history_by_uid_is_newest_first_and_paginates(conversations):
+    client = TestClient(app_module.app)
+    page = client.get("/api/conversations/uid/AAA111", params={"limit": 3}).json()
+    assert [c['summary'] for c in page['conversations']] == ['visit 5', 'visit 4', 'visit 2']
+    page = client.get("/api/conversations/uid/AAA111", params={"limit": 3, "cursor": page['next_cursor']}).json()
+    assert [c['summary'] for c in page['conversations']] == ['visit 1']
+    assert page['next_cursor'] is None
+
+
+def test_history_filters_by_phone_doctor_and_time_range(conversations):
+    client = TestClient(app_module.app)
+    by_phone = client.get("/api/conversations/phone/(650) 450-6083", params={"start": "2024-01-02T00:00:00Z", "end": "2024-01-04T23:00:00"}).json()
+    assert [c['summary'] for c in by_phone['conversations']] == []  # different digits: no leading 1
+    by_phone = client.get("/api/conversations/phone/1-650-450-6083", params={"start": "2024-01-02T00:00:00Z", "end": "2024-01-04T23:00:00"}).json()
+    assert [c['summary'] for c in by_phone['conversations']] == ['visit 4', 'visit 2']
+    by_doctor = client.get("/api/conversations/doctor/ann").json()
+    assert [c['summary'] for c in by_doctor['conversations']] == ['visit 5', 'visit 3']
+    assert client.get("/api/conversations/doctor/ann", params={"start": "yesterday"}).status_code == 400
+
+
+def test_history_indexes_rows_appended_after_the_first_query(conversations):
+    assert len(conversations.query('uid', 'CCC333')[0]) == 0
+    offset = conversations._offset
+    app_module._save_conversation_summary('2024-02-01T09:00:00Z', 5.0, '5550001111', 'CCC333', 'new visit', 'Judy', 'Cy')
+    rows, cursor = conversations.query('uid', 'CCC333')
+    assert [r['summary'] for r in rows] == ['new visit'] and cursor is None
+    assert conversations._offset > offset and len(conversations._rows) == 6
+
+
+def test_sqlite_backend_matches_csv_upsert_semantics(tmp_path):
+    backend = app_module.SqliteStorageBackend(str(tmp_path / "amiya.db"))
+    try:
+        assert backend.upsert_patients([
+            {'uid': 'AAA111', 'name': 'Ada', 'phone_number': '+16504506083', 'agent_name': 'Dexter'},
+            {'uid': 'BBB222', 'name': 'Bob', 'phone_number': '1234567890', 'agent_name': 'Ann'},
+            {'uid': 'CCC333', 'name': 'Ada L', 'phone_number': '1 650 450 6083', 'agent_name': 'Judy'},
+        ]) == [None, None, 'AAA111']
+        assert [p['uid'] for p in backend.all_patients()] == ['CCC333', 'BBB222']
+        assert backend.get_patient_by_uid('AAA111') is None
+        assert backend.get_patient_by_phone('16504506083')['name'] == 'Ada L'
+        assert backend.connection_mode() == 'wal'
+
+        # Existing phones are looked up in chunks, then updated and inserted in one batch each
+        backend.LOOKUP_CHUNK = 1
+        assert backend.upsert_patients([
+            {'uid': 'DDD444', 'name': 'Di', 'phone_number': '5550000002', 'agent_name': 'Ann'},
+            {'uid': 'BBB223', 'name': 'Bob', 'phone_number': '1234567890', 'agent_name': 'Ann'},
+            {'uid': 'DDD445', 'name': 'Di', 'phone_number': '555-000-0002', 'agent_name': 'Judy'},
+            {'uid': 'CCC334', 'name': 'Ada', 'phone_number': '16504506083', 'agent_name': 'Judy'},
+        ]) == [None, 'BBB222', 'DDD444', 'CCC333']
+        assert [p['uid'] for p in backend.all_patients()] == ['CCC334', 'BBB223', 'DDD445']
+        assert backend.get_patient_by_phone('5550000002')['agent_name'] == 'Judy'
+    finally:
+        backend.close()
+
+
+def test_migration_imports_csv_files_and_queries_match(tmp_path, store, conversations):
+    store.upsert({'uid': 'DDD444', 'name': 'Di', 'phone_number': '5550000002', 'agent_name': 'Ann'})  # still in the log
+    db = str(tmp_path / "amiya.db")
+    counts = app_module.migrate_csv_to_sqlite(db, store.snapshot_path, conversations.path)
+    assert counts == {'patients': 3, 'conversations': 5}
+    with pytest.raises(RuntimeError):
+        app_module.migrate_csv_to_sqlite(db, store.snapshot_path, conversations.path)
+
+    sqlite_backend = app_module.SqliteStorageBackend(db)
+    csv_backend = app_module.CsvStorageBackend(store, conversations)
+    try:
+        assert sqlite_backend.all_patients() == csv_backend.all_patients()
+        for field, value in [('uid', 'AAA111'), ('phone_number', '+1 650 450 6083'), ('doctor_name', 'DEXTER')]:
+            for backend in (sqlite_backend, csv_backend):
+                first, cursor = backend.query_conversations(field, value, limit=2)
+                rest, end = backend.query_conversations(field, value, limit=10, cursor=cursor)
+                assert end is None
+                assert [r['summary'] for r in first + rest] == [r['summary'] for r in csv_backend.query_conversations(field, value, limit=10)[0]]
+            ranged = sqlite_backend.query_conversations(field, value, start=app_module._parse_iso_timestamp('2024-01-02'),
+                                                        end=app_module._parse_iso_timestamp('2024-01-04T10:00:00Z'))[0]
+            assert [r['summary'] for r in ranged] == [r['summary'] for r in csv_backend.query_conversations(
+                field, value, start=app_module._parse_iso_timestamp('2024-01-02'), end=app_module._parse_iso_timestamp('2024-01-04T10:00:00Z'))[0]]
+    finally:
+        sqlite_backend.close()
+
+
+def test_sqlite_backend_serves_the_api_from_worker_threads(tmp_path, monkeypatch):
+    backend = app_module.SqliteStorageBackend(str(tmp_path / "amiya.db"))
+    monkeypatch.setattr(app_module, "_storage", backend)
+    client = TestClient(app_module.app)
+    try:
+        created = client.post("/api/new-patient", json={"name": "Ada", "phone_number": "6504506083", "agent_name": "Dr. Ann Lee"}).json()
+        assert client.get(f"/api/patient/{created['uid']}").json() == {"name": "Ada", "doctor": "Ann"}
+        app_module._save_conversation_summary('2024-03-01T09:00:00Z', 5.0, '6504506083', created['uid'], 'checkup', 'Ann', 'Ada')
+        history = client.get(f"/api/conversations/uid/{created['uid']}").json()
+        assert [c['summary'] for c in history['conversations']] == ['checkup']
+        assert history['conversations'][0]['duration_minutes'] == 5.0
+    finally:
+        backend.close()
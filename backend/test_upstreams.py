@@ -0,0 +1,513 @@
+"""
+Tests for the upstream (HeyGen / OpenAI / Twilio) call paths in app.py.
+Upstreams are mocked locally with respx (Twilio with a stand-in transport); nothing here touches the network.
+"""
+
+import csv
+import json
+import time
+
+import httpx
+import pytest
+import respx
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+HEYGEN_TOKEN_URL = f"{app_module.HEYGEN_API_BASE}/streaming.create_token"
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+@pytest.fixture(autouse=True)
+def api_keys(monkeypatch):
+    monkeypatch.setattr(app_module, "HEYGEN_API_KEY", "test-heygen-key")
+    monkeypatch.setattr(app_module, "OPENAI_API_KEY", "test-openai-key")
+
+
+def test_lifespan_shares_one_pooled_client_per_upstream(monkeypatch):
+    monkeypatch.setattr(app_module._token_pool, "target_size", 0)
+    with respx.mock(assert_all_called=True) as mock:
+        route = mock.post(HEYGEN_TOKEN_URL).mock(return_value=httpx.Response(200, json={"data": {"token": "tok"}}))
+        with TestClient(app_module.app) as client:
+            heygen = app_module._http_clients["heygen"]
+            for _ in range(2):
+                r = client.post("/api/session", json={"profile_id": "alpha", "user_name": "Ada"})
+                assert r.status_code == 200
+                assert r.json()["token"] == "tok"
+            assert app_module._http_clients["heygen"] is heygen
+        assert route.call_count == 2
+    assert heygen.is_closed
+    assert app_module._http_clients == {}
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_session_pops_pre_minted_tokens_and_counts_hits(monkeypatch):
+    pool = app_module.TokenPool(app_module._mint_token, target_size=2, ttl=600, expiry_margin=60)
+    monkeypatch.setattr(app_module, "_token_pool", pool)
+    tokens = iter(f"tok-{i}" for i in range(100))
+    with respx.mock() as mock:
+        route = mock.post(HEYGEN_TOKEN_URL).mock(side_effect=lambda request: httpx.Response(200, json={"token": next(tokens)}))
+        with TestClient(app_module.app) as client:
+            _wait_for(lambda: pool.stats()["size"] == 2)
+            r = client.post("/api/session", json={"profile_id": "beta", "user_name": "Ada"})
+            assert r.json()["token"] == "tok-0"
+            _wait_for(lambda: pool.stats()["size"] == 2)  # refilled in the background
+            stats = client.get("/api/token-pool").json()
+        assert stats["hits"] == 1 and stats["misses"] == 0 and stats["minted"] == 3
+        assert route.call_count == 3
+    assert pool.stats()["refilling"] is False
+
+
+def test_empty_or_expired_pool_falls_back_to_on_demand_minting(monkeypatch):
+    pool = app_module.TokenPool(app_module._mint_token, target_size=1, ttl=10, expiry_margin=10)
+    pool._tokens.append(("stale", time.monotonic() - 1))
+    monkeypatch.setattr(app_module, "_token_pool", pool)
+    with respx.mock() as mock:
+        mock.post(HEYGEN_TOKEN_URL).mock(return_value=httpx.Response(200, json={"access_token": "fresh"}))
+        r = TestClient(app_module.app).post("/api/session", json={"profile_id": "gamma", "user_name": "Ada"})
+    assert r.json()["token"] == "fresh"
+    assert pool.stats()["misses"] == 1 and pool.stats()["expired"] == 1
+
+
+def _sse_body(chunks):
+    lines = [
+        "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": c}}]}) + "\n\n"
+        for c in chunks
+    ]
+    return "".join(lines) + "data: [DONE]\n\n"
+
+
+SUMMARY_REQUEST = {
+    "transcript": "Doctor: How are you? Patient: My head hurts.",
+    "start_time": "2024-01-15T10:00:00Z",
+    "current_time": "2024-01-15T10:15:00Z",
+    "phone_number": "+16504506083",
+    "uid": "ABC123",
+    "doctor_name": "Dexter",
+    "user_name": "John Smith",
+}
+
+
+def test_streamed_summary_relays_tokens_and_persists(tmp_path):
+    with respx.mock() as mock:
+        route = mock.post(OPENAI_CHAT_URL).mock(return_value=httpx.Response(
+            200, text=_sse_body(["Patient reports ", "a headache."]), headers={"content-type": "text/event-stream"}))
+        with TestClient(app_module.app).stream("POST", "/api/summarize-transcript/stream", json=SUMMARY_REQUEST) as r:
+            assert r.headers["content-type"].startswith("text/event-stream")
+            events = [
+                (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+                for block in r.read().decode().strip().split("\n\n")
+            ]
+
+    assert json.loads(route.calls[0].request.content)["stream"] is True
+    assert events == [
+        ("token", {"text": "Patient reports "}),
+        ("token", {"text": "a headache."}),
+        ("done", {"summary": "Patient reports a headache.", "saved": True}),
+    ]
+    with open(tmp_path / "convos.csv", newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+    assert rows[0]["summary"] == "Patient reports a headache."
+    assert rows[0]["duration_minutes"] == "15.0"
+
+
+def test_streamed_summary_reports_upstream_errors_as_events(tmp_path):
+    with respx.mock() as mock:
+        mock.post(OPENAI_CHAT_URL).mock(return_value=httpx.Response(429, json={"error": "rate limited"}))
+        r = TestClient(app_module.app).post("/api/summarize-transcript/stream", json=SUMMARY_REQUEST)
+    assert r.text.startswith("event: error\n")
+    assert not (tmp_path / "convos.csv").exists()
+
+
+def test_split_transcript_prefers_turn_then_sentence_boundaries():
+    transcript = "Doctor: Hello there.\nPatient: " + "My knee hurts. " * 10 + "\nDoctor: Rest it."
+    chunks = app_module._split_transcript(transcript, 60)
+    assert all(len(c) <= 60 for c in chunks)
+    assert chunks[0].startswith("Doctor: Hello there.\nPatient: My knee hurts.")
+    assert chunks[-1].endswith("Doctor: Rest it.")
+    assert "".join(chunks).replace("\n", "").replace(" ", "") == transcript.replace("\n", "").replace(" ", "")
+
+
+def test_long_transcripts_are_map_reduced_with_bounded_concurrency(monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(app_module, "SUMMARY_CHUNK_CHARS", 100)
+    monkeypatch.setattr(app_module, "SUMMARY_MAP_CONCURRENCY", 2)
+    active = {"now": 0, "peak": 0}
+    prompts = []
+
+    async def chat(request):
+        content = json.loads(request.content)["messages"][1]["content"]
+        prompts.append(content)
+        if content.startswith("Below are summaries"):
+            return _chat_json("Final summary.")
+        active["now"] += 1
+        active["peak"] = max(active["peak"], active["now"])
+        await asyncio.sleep(0.05)
+        active["now"] -= 1
+        return _chat_json(f"partial {len(prompts)}")
+
+    transcript = "\n".join(f"Patient: symptom number {i} has been bothering me for a while." for i in range(12))
+    with respx.mock() as mock:
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=chat)
+        summary = asyncio.run(app_module._summarize_transcript_with_openai(transcript))
+
+    assert summary == "Final summary."
+    map_prompts, reduce_prompt = prompts[:-1], prompts[-1]
+    assert len(map_prompts) == len(app_module._split_transcript(transcript, 100)) > 2
+    assert active["peak"] == 2
+    assert "Part 1: partial" in reduce_prompt
+
+
+def test_short_transcripts_keep_the_single_call_path():
+    import asyncio
+
+    with respx.mock() as mock:
+        route = mock.post(OPENAI_CHAT_URL).mock(return_value=_chat_json("Short."))
+        assert asyncio.run(app_module._summarize_transcript_with_openai("Patient: fine.")) == "Short."
+    assert route.call_count == 1
+
+
+def _chat_json(content):
+    return httpx.Response(200, json={"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]})
+
+
+class _TwilioStandIn:
+    """Local Twilio transport: answers message creates with the queued statuses, records send times"""
+
+    def __init__(self, statuses):
+        from twilio.http import AsyncHttpClient
+
+        stand_in = self
+        self.statuses = list(statuses)
+        self.sent_at = []
+
+        class Transport(AsyncHttpClient):
+            async def request(self, method, uri, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+                from twilio.http.response import Response
+
+                stand_in.sent_at.append(time.monotonic())
+                status = stand_in.statuses.pop(0) if stand_in.statuses else 201
+                body = {"sid": f"SM{len(stand_in.sent_at)}", "status": "queued"} if status < 400 else {"code": 21211, "message": "nope", "status": status}
+                return Response(status, json.dumps(body))
+
+        self.transport = Transport(logger=None, is_async=True)
+
+
+@pytest.fixture
+def twilio(monkeypatch):
+    from twilio.rest import Client
+
+    def install(*statuses):
+        stand_in = _TwilioStandIn(statuses)
+        monkeypatch.setattr(app_module, "TWILIO_AUTH_TOKEN", "test-twilio-token")
+        monkeypatch.setattr(app_module, "_twilio", Client("ACtest", "test-twilio-token", http_client=stand_in.transport))
+        return stand_in
+
+    return install
+
+
+def _dispatcher(**overrides):
+    options = dict(workers=2, rate_per_second=0, burst=5, max_attempts=3, retry_base_seconds=0.01)
+    options.update(overrides)
+    return app_module.SmsDispatcher(app_module._send_sms, **options)
+
+
+def test_new_patient_queues_the_invite_instead_of_waiting_on_twilio(monkeypatch, twilio):
+    import asyncio
+
+    stand_in = twilio()
+    dispatcher = _dispatcher()
+    monkeypatch.setattr(app_module, "_sms_dispatcher", dispatcher)
+    monkeypatch.setattr(app_module._token_pool, "target_size", 0)
+
+    async def scenario():
+        dispatcher.start()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_module.app), base_url="http://test") as client:
+            r = await client.post("/api/new-patient", json={"name": "Ada", "phone_number": "16504506083", "agent_name": "Dexter Smith"})
+            uid = r.json()["uid"]
+            queued = (await client.get(f"/api/sms-status/{uid}")).json()
+            await dispatcher.drain()
+            sent = (await client.get(f"/api/sms-status/{uid}")).json()
+            missing = await client.get("/api/sms-status/NOPE00")
+        await dispatcher.stop()
+        return queued, sent, missing
+
+    queued, sent, missing = asyncio.run(scenario())
+    assert queued["status"] == "queued"
+    assert sent["status"] == "sent" and sent["sid"] == "SM1" and sent["attempts"] == 1
+    assert missing.status_code == 404
+    assert len(stand_in.sent_at) == 1
+
+
+def test_invites_retry_server_errors_and_give_up_on_client_errors(twilio):
+    import asyncio
+
+    twilio(503, 201, 400)
+    dispatcher = _dispatcher(workers=1)
+
+    async def scenario():
+        dispatcher.start()
+        dispatcher.enqueue("+16504506083", "Ada", "Dexter", "AAA111")
+        await dispatcher.drain()
+        deadline = time.monotonic() + 5
+        while dispatcher.status("AAA111")["status"] != "sent":
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.01)
+        dispatcher.enqueue("+10000000000", "Bob", "Dexter", "BBB222")
+        await dispatcher.drain()
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert dispatcher.status("AAA111")["attempts"] == 2
+    failed = dispatcher.status("BBB222")
+    assert failed["status"] == "failed" and failed["attempts"] == 1
+    assert dispatcher.stats()["statuses"] == {"sent": 1, "failed": 1}
+
+
+def test_invites_are_paced_by_the_token_bucket(twilio):
+    import asyncio
+
+    stand_in = twilio()
+    dispatcher = _dispatcher(workers=4, rate_per_second=20, burst=2)
+
+    async def scenario():
+        dispatcher.enqueue_many([
+            {"phone_number": "1555000000" + str(i), "name": "P", "agent_name": "Dexter", "uid": f"UID00{i}"} for i in range(6)
+        ])
+        dispatcher.start()  # invites queued before startup are not lost
+        await dispatcher.drain()
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert len(stand_in.sent_at) == 6
+    # 2 go out in the initial burst, the other 4 at 20/s
+    assert stand_in.sent_at[-1] - stand_in.sent_at[0] >= 0.18
+
+
+def test_invites_are_skipped_without_twilio_credentials(monkeypatch):
+    monkeypatch.setattr(app_module, "TWILIO_AUTH_TOKEN", None)
+    dispatcher = _dispatcher()
+    assert dispatcher.enqueue("+16504506083", "Ada", "Dexter", "AAA111") == "skipped"
+    assert dispatcher.stats() == {"queued": 0, "statuses": {"skipped": 1}}
+
+
+def test_ready_prewarms_indexes_and_upstream_connections(monkeypatch, isolated_storage):
+    monkeypatch.setattr(app_module._token_pool, "target_size", 0)
+    isolated_storage.upsert_patient({"uid": "AAA111", "name": "Ada", "phone_number": "16504506083", "agent_name": "Dexter"})
+    with respx.mock() as mock:
+        heygen = mock.head(app_module.HEYGEN_API_BASE).mock(return_value=httpx.Response(404))
+        mock.head("https://api.openai.com/v1/models").mock(side_effect=httpx.ConnectError("unreachable"))
+        with TestClient(app_module.app) as client:
+            r = client.get("/api/ready")
+            assert r.status_code == 200
+            checks = r.json()["checks"]
+            assert checks["patients"]["detail"] == {"backend": "csv", "patients": 1}
+            assert checks["medical"]["ok"] and checks["medical"]["detail"]["sections"] > 0
+            assert not checks["upstreams"]["ok"] and "openai" in checks["upstreams"]["detail"]  # reported, not fatal
+            assert client.get("/api/ready").json()["checks"] == checks  # warmed once
+        assert heygen.call_count == 1
+        assert app_module._readiness["draining"] is True
+        assert TestClient(app_module.app).get("/api/ready").status_code == 503
+
+
+def test_ready_fails_until_the_patient_store_loads(monkeypatch):
+    def broken():
+        raise OSError("db.csv unreadable")
+
+    monkeypatch.setattr(app_module, "READY_PREWARM", ["patients"])
+    monkeypatch.setattr(app_module._storage, "warm", broken)
+    monkeypatch.setitem(app_module._readiness, "ready", False)
+    monkeypatch.setitem(app_module._readiness, "draining", False)
+    monkeypatch.setitem(app_module._readiness, "lock", None)
+    r = TestClient(app_module.app).get("/api/ready")
+    assert r.status_code == 503
+    check = r.json()["checks"]["patients"]
+    assert (check["ok"], check["detail"]) == (False, "db.csv unreadable")
+
+
+def test_interim_summaries_only_send_the_new_transcript_and_save_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "_visit_summaries", app_module.VisitSummaries(ttl=600, capacity=10))
+    prompts = []
+
+    def chat(request):
+        prompts.append(json.loads(request.content)["messages"][1]["content"])
+        return _chat_json(f"summary {len(prompts)}")
+
+    turns = ["Doctor: How are you?\n", "Patient: My head hurts.\n", "Doctor: Drink water and rest.\n"]
+    client = TestClient(app_module.app)
+    with respx.mock() as mock:
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=chat)
+        first = client.post("/api/summarize-transcript", json={**SUMMARY_REQUEST, "transcript": turns[0], "final": False})
+        second = client.post("/api/summarize-transcript", json={**SUMMARY_REQUEST, "transcript": "".join(turns[:2]), "final": False})
+        assert not (tmp_path / "convos.csv").exists()
+        final = client.post("/api/summarize-transcript", json={**SUMMARY_REQUEST, "transcript": "".join(turns)})
+
+    assert [r.json()["summary"] for r in (first, second, final)] == ["summary 1", "summary 2", "summary 3"]
+    assert prompts[0].startswith(app_module.SUMMARY_PROMPT) and prompts[0].endswith(turns[0])
+    assert prompts[1].startswith("Below is the running summary") and "Running summary:\nsummary 1\n" in prompts[1]
+    assert prompts[1].endswith("New transcript:\n\n" + turns[1]) and turns[0] not in prompts[1]
+    assert prompts[2].endswith("New transcript:\n\n" + turns[2]) and "summary 2" in prompts[2]
+    with open(tmp_path / "convos.csv", newline="", encoding="utf-8") as file:
+        assert [row["summary"] for row in csv.DictReader(file)] == ["summary 3"]
+    assert len(app_module._visit_summaries) == 0
+
+
+def test_rewritten_transcript_restarts_the_visit_summary(monkeypatch):
+    import asyncio
+
+    visits = app_module.VisitSummaries(ttl=600, capacity=10)
+    prompts = []
+
+    def chat(request):
+        prompts.append(json.loads(request.content)["messages"][1]["content"])
+        return _chat_json(f"summary {len(prompts)}")
+
+    async def scenario():
+        await visits.update("ABC123", "t0", "Patient: my knee hurts.")
+        await visits.update("ABC123", "t0", "Patient: my knee hurts.")  # nothing new: no upstream call
+        return await visits.update("ABC123", "t0", "Patient: my back hurts, actually.")
+
+    with respx.mock() as mock:
+        mock.post(OPENAI_CHAT_URL).mock(side_effect=chat)
+        assert asyncio.run(scenario()) == "summary 2"
+    assert len(prompts) == 2
+    assert prompts[1].startswith(app_module.SUMMARY_PROMPT) and prompts[1].endswith("my back hurts, actually.")
+
+
+def _guard(name, **overrides):
+    settings = dict(deadline=5, max_attempts=3, retry_base=0.01, retry_max=0.05, hedge=False,
+                    breaker=app_module.CircuitBreaker(failure_threshold=3, reset_seconds=60), hedge_min_samples=5)
+    settings.update(overrides)
+    guard = app_module._upstream_guards[name] = app_module.UpstreamGuard(name, **settings)
+    return guard
+
+
+def test_idempotent_calls_retry_transient_failures_but_not_client_errors(tmp_path):
+    guard = _guard("chat")
+    with respx.mock() as mock:
+        route = mock.post(OPENAI_CHAT_URL).mock(side_effect=[
+            httpx.Response(503, json={"error": "overloaded"}), httpx.ConnectError("reset"), _chat_json("Patient is fine."),
+        ])
+        r = TestClient(app_module.app).post("/api/summarize-transcript", json=SUMMARY_REQUEST)
+        assert r.status_code == 200 and r.json()["summary"] == "Patient is fine."
+        assert route.call_count == 3 and guard.retries == 2
+
+        route.side_effect = None
+        route.return_value = httpx.Response(400, json={"error": "bad request"})
+        r = TestClient(app_module.app).post("/api/summarize-transcript", json={**SUMMARY_REQUEST, "transcript": "Other."})
+    assert r.status_code == 500
+    assert route.call_count == 4 and guard.retries == 2
+    assert guard.breaker.state == "closed"  # the upstream answered; the request was at fault
+
+
+def test_slow_attempt_is_hedged_after_the_p95_and_the_faster_copy_wins():
+    import asyncio
+
+    guard = _guard("heygen_token", hedge=True)
+    for _ in range(10):
+        guard._latencies.append(0.02)
+    calls = []
+
+    async def mint(request):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            await asyncio.sleep(2)  # injected tail latency on the first copy only
+        return httpx.Response(200, json={"data": {"token": f"tok-{len(calls)}"}})
+
+    with respx.mock() as mock:
+        mock.post(HEYGEN_TOKEN_URL).mock(side_effect=mint)
+        started = time.monotonic()
+        assert asyncio.run(app_module._mint_token()) == "tok-2"
+    assert time.monotonic() - started < 1
+    assert guard.hedges == 1 and guard.hedge_delay() == 0.05
+
+
+def test_deadline_bounds_a_stalled_upstream():
+    import asyncio
+
+    _guard("heygen_token", deadline=0.2)
+    app_module._http_client("heygen")  # build the pool (and its TLS context) outside the timed call
+
+    stalled = []
+
+    async def stall(request):
+        stalled.append(request)
+        await asyncio.sleep(5)
+        return httpx.Response(200, json={"data": {"token": "late"}})
+
+    with respx.mock(assert_all_called=False) as mock:
+        mock.post(HEYGEN_TOKEN_URL).mock(side_effect=stall)
+        started = time.monotonic()
+        with pytest.raises(app_module.UpstreamUnavailable) as exc:
+            asyncio.run(app_module._mint_token())
+    assert exc.value.status_code == 504 and len(stalled) == 1
+    assert time.monotonic() - started < 1
+
+
+def test_circuit_opens_after_repeated_failures_and_a_probe_closes_it(monkeypatch):
+    guard = _guard("heygen_token", max_attempts=1)
+    client = TestClient(app_module.app)
+    monkeypatch.setattr(app_module._token_pool, "target_size", 0)
+    with respx.mock() as mock:
+        route = mock.post(HEYGEN_TOKEN_URL).mock(return_value=httpx.Response(500, json={"error": "down"}))
+        for _ in range(3):
+            assert client.post("/api/session", json={"profile_id": "alpha", "user_name": "Ada"}).status_code == 502
+        r = client.post("/api/session", json={"profile_id": "alpha", "user_name": "Ada"})
+        assert r.status_code == 503 and int(r.headers["retry-after"]) == 60
+        assert route.call_count == 3 and guard.rejected == 1
+        assert 'amiya_upstream_circuit_open{upstream="heygen_token"} 1' in client.get("/api/metrics").text
+
+        guard.breaker.opened_at -= 60  # the reset window has passed: one probe goes through
+        route.return_value = httpx.Response(200, json={"data": {"token": "tok"}})
+        assert client.post("/api/session", json={"profile_id": "alpha", "user_name": "Ada"}).status_code == 200
+    assert guard.breaker.state == "closed" and route.call_count == 4
+
+
+def test_stop_returns_invites_waiting_on_a_retry_to_the_backlog(twilio):
+    import asyncio
+
+    stand_in = twilio(503)
+    dispatcher = _dispatcher(workers=1, retry_base_seconds=30)
+
+    async def scenario():
+        dispatcher.start()
+        dispatcher.enqueue("16504506083", "Ada", "Dexter", "AAA111")
+        await dispatcher.drain()
+        retrying = dispatcher.status("AAA111")
+        await dispatcher.stop()
+        stopped = dispatcher.status("AAA111")
+        dispatcher.start()  # e.g. the next lifespan
+        await dispatcher.drain()
+        await dispatcher.stop()
+        return retrying, stopped
+
+    retrying, stopped = asyncio.run(scenario())
+    assert retrying["status"] == "retrying" and stopped["status"] == "queued"
+    assert dispatcher.status("AAA111")["status"] == "sent" and len(stand_in.sent_at) == 2
+
+
+def test_probe_stream_closed_early_lets_the_next_call_probe_again():
+    import asyncio
+
+    guard = _guard("chat")
+    guard.breaker.failures, guard.breaker.opened_at = 3, time.monotonic() - 61  # open, reset window passed
+
+    async def read_first_delta():
+        stream = app_module._stream_summary_from_openai("Patient: my head hurts.")
+        first = await stream.__anext__()
+        await stream.aclose()  # the client went away mid-stream
+        return first
+
+    with respx.mock() as mock:
+        mock.post(OPENAI_CHAT_URL).mock(return_value=httpx.Response(
+            200, text=_sse_body(["Patient ", "has a headache."]), headers={"content-type": "text/event-stream"}))
+        assert asyncio.run(read_first_delta()) == "Patient "
+    assert guard.breaker.state == "half_open"  # no verdict from an abandoned probe...
+    assert guard.breaker.allow()  # ...and the next call may probe